@@ -1,17 +1,26 @@
+import errno
+import itertools
 import os
-import shutil
-
-from datetime import datetime
+import time
 
+import bundle as bundles
+import digests
 import formatting
-try:
-    from management_tools import loggers
-except ImportError as e:
-    print "You need the 'Management Tools' module to be installed first."
-    print "https://github.com/univ-of-utah-marriott-library-apple/management_tools"
-    raise e
+import metrics as stats
+import planner
+import results
+import scanner
+import transfer
+from dedup import BlobStore
+from dircache import DirCache
+from journal import Journal
+from manifest import Manifest, MANIFEST_NAME
+import loggers
+import retention
+import scheduler
+import watcher
 
-def nested(origin, destination, replace=True, grain=3, persist=False, update_time=False, logger=None):
+def nested(origin, destination, replace=True, grain=3, persist=False, update_time=False, logger=None, jobs=1, incremental=False, recursive=False, dedup=False, dry_run=False, plan_out=None, stats_file=None, pipeline=False, bundle=None, order='name', verify=False, throttle=None):
     """
     Handles the movement of files from one location to another, but the
     destination will be organized in a nested format, e.g.
@@ -31,104 +40,53 @@ def nested(origin, destination, replace=True, grain=3, persist=False, update_tim
         destination
     :type update_time: bool
     :param logger: a Management Tools logger to record information
+    :param jobs: how many files to copy/move at the same time
+    :type jobs: int
+    :param incremental: whether to keep a manifest of archived files in the
+        destination, and skip files that haven't changed since they were
+        archived
+    :type incremental: bool
+    :param recursive: whether to archive the files in the origin's
+        subdirectories too (streaming them through without building a payload
+        list first)
+    :type recursive: bool
+    :param dedup: whether to keep the content of archived files in a
+        content-addressed store in the destination, hard linking files with
+        identical content to it instead of writing them again
+    :type dedup: bool
+    :param dry_run: whether to only plan the archival, without touching
+        anything
+    :type dry_run: bool
+    :param plan_out: if given, the plan is written to this file as JSON Lines
+    :param stats_file: if given, the run's metrics are written to this file
+        (in the Prometheus text format if it ends with '.prom', or as JSON)
+    :param pipeline: whether to overlap the work on the destination's
+        directories with the transfers (for destinations where every call is
+        a round trip to a file server)
+    :type pipeline: bool
+    :param bundle: if given, each date bucket is written as a single archive
+        of this format (one of bundle.FORMATS) instead of as files
+    :param order: the order to transfer files in (one of scheduler.ORDERS)
+    :param verify: whether to check each file that's written against its
+        original (reading it back), and keep the digests of each bucket's
+        files next to it (see digests.Sidecars)
+    :type verify: bool
+    :param throttle: if given, a throttle.Throttle limiting how fast files are
+        written
+    :return: the planner.Totals of the run (see Archiver for the result of
+        each file)
     """
     # Ensure we have some sort of logger. Prevents errors.
     if not logger:
         logger = loggers.stream_logger(1)
-    date = formatting.date(grain)
+    archiver = Archiver(origin, destination, False, grain, '.', replace, persist, update_time, logger, jobs,
+                        incremental, recursive, dedup, dry_run, plan_out, stats_file, pipeline, bundle, order, verify,
+                        throttle)
+    for result in archiver:
+        pass
+    return archiver.summary.totals
 
-    # Check that the origin actually, like... exists.
-    if not os.path.isdir(origin):
-        raise RuntimeError("No such origin directory: " + origin)
-    
-    # Destination should probably exist.
-    if not os.path.isdir(destination):
-        logger.error("Creating destination directory at: " + destination)
-        os.makedirs(destination)
-    
-    # Find everything in the origin directory.
-    logger.info("Building payload list.")
-    with ChDir(origin):
-        payload = sorted([os.path.abspath(x) for x in os.listdir('.')])
-    
-    # Do all of the archival.
-    with ChDir(destination):
-        logger.info("Creating nested directory structure in: {}".format(os.path.abspath(destination)))
-        dirs_needed     = []
-        file_paths      = {}
-        max_file_length = 0
-        for file in payload:
-            # For each file, pull its timestamp and split it into its different
-            # parts. These will be used to create the appropriate directory
-            # structure in the destination.
-            time = datetime.fromtimestamp(os.path.getmtime(file))
-            dirs = time.strftime(date).split('.')
-            leaf = os.path.join(*dirs)
-            dirs_needed.append(leaf)
-            file_paths[file] = leaf
-            # This is just used for pretty printing.
-            if len(os.path.basename(file)) > max_file_length:
-                max_file_length = len(os.path.basename(file))
-        
-        # Remove duplicates from the necessary directories. (This avoids errors
-        # where a folder already exists.) Then create the nested folders.
-        dirs_needed = uniquify(dirs_needed)
-        for dir in dirs_needed:
-            if not os.path.isdir(dir):
-                logger.info("  ./" + dir)
-                os.makedirs(dir)
-        
-        # Start moving/copying the files.
-        # (Moving is used if the files don't need to stay in the origin.)
-        logger.info("{} files to appropriate subdirectories...".format("Moving" if not persist else "Copying"))
-        for file, path in file_paths.items():
-            # Each file gets wrapped in a try/except block to ensure that flow
-            # is not interrupted if there's an issue with one of them.
-            try:
-                # Set the file's destination.
-                file_destination = os.path.join(path, os.path.basename(file))
-                # Determine whether the file should be put in the destination.
-                add = False
-                if replace:
-                    # Definitely add the file if we're okay with replacing it.
-                    add = True
-                else:
-                    # If we're not okay with replacing it, ensure that the file
-                    # does not exist in the destination already.
-                    if not os.path.isfile(file_destination):
-                        add = True
-                # If we're okay with adding the file, then do the thing!
-                if add:
-                    logger.info("  {file:>{length}} {dash}> ./{dest}".format(
-                        file   = os.path.basename(file),
-                        length = max_file_length,
-                        dest   = file_destination,
-                        dash   = '=' if persist else '-'
-                    ))
-                    # If the file exists in the destination, delete it before
-                    # attempting to move a new copy there. This also accounts
-                    # for symbolic links.
-                    if os.path.isfile(file_destination):
-                        os.remove(file_destination)
-                    # Copy if persisting data; move otherwise.
-                    if persist:
-                        shutil.copy2(file, path)
-                    else:
-                        shutil.move(file, path)
-                    # Update the time as needed.
-                    if update_time:
-                        os.utime(file_destination, None)
-            except (IOError, OSError) as e:
-                # These are the most likely errors.
-                logger.error("{}".format(repr(e)))
-                logger.error("Unable to copy file '{}' to path: {}".format(file, path))
-            except (KeyboardInterrupt, SystemExit):
-                logger.info("Quitting...")
-                break
-            except Exception as e:
-                logger.error("{}".format(repr(e)))
-
-def flat(origin, destination, replace=True, grain=3, persist=False, delimiter='.', update_time=False, logger=None):
+def flat(origin, destination, replace=True, grain=3, persist=False, delimiter='.', update_time=False, logger=None, jobs=1, incremental=False, recursive=False, dedup=False, dry_run=False, plan_out=None, stats_file=None, pipeline=False, bundle=None, order='name', verify=False, throttle=None):
     """
     Handles the movement of files from one location to another. The destination
     will not be organized; all files will just be dumped into it. The files will
@@ -150,90 +108,1012 @@ def flat(origin, destination, replace=True, grain=3, persist=False, delimiter='.
         destination
     :type update_time: bool
     :param logger: a Management Tools logger to record information
+    :param jobs: how many files to copy/move at the same time
+    :type jobs: int
+    :param incremental: whether to keep a manifest of archived files in the
+        destination, and skip files that haven't changed since they were
+        archived
+    :type incremental: bool
+    :param recursive: whether to archive the files in the origin's
+        subdirectories too (streaming them through without building a payload
+        list first)
+    :type recursive: bool
+    :param dedup: whether to keep the content of archived files in a
+        content-addressed store in the destination, hard linking files with
+        identical content to it instead of writing them again
+    :type dedup: bool
+    :param dry_run: whether to only plan the archival, without touching
+        anything
+    :type dry_run: bool
+    :param plan_out: if given, the plan is written to this file as JSON Lines
+    :param stats_file: if given, the run's metrics are written to this file
+        (in the Prometheus text format if it ends with '.prom', or as JSON)
+    :param pipeline: whether to overlap the work on the destination's
+        directories with the transfers (for destinations where every call is
+        a round trip to a file server)
+    :type pipeline: bool
+    :param bundle: if given, each date bucket is written as a single archive
+        of this format (one of bundle.FORMATS) instead of as files
+    :param order: the order to transfer files in (one of scheduler.ORDERS)
+    :param verify: whether to check each file that's written against its
+        original (reading it back), and keep the digests of each bucket's
+        files next to it (see digests.Sidecars)
+    :type verify: bool
+    :param throttle: if given, a throttle.Throttle limiting how fast files are
+        written
+    :return: the planner.Totals of the run (see Archiver for the result of
+        each file)
     """
     # Ensure we have some sort of logger. Prevents errors.
     if not logger:
         logger = loggers.stream_logger(1)
-    date = formatting.date(grain)
-    
+    archiver = Archiver(origin, destination, True, grain, delimiter, replace, persist, update_time, logger, jobs,
+                        incremental, recursive, dedup, dry_run, plan_out, stats_file, pipeline, bundle, order, verify,
+                        throttle)
+    for result in archiver:
+        pass
+    return archiver.summary.totals
+
+class Archiver(object):
+    """
+    An archival run for programs that use Archive Manager as a library. It
+    does the same as nested() or flat(), but hands back the result of each file
+    as it goes, instead of only reporting it in the log:
+
+        archiver = Archiver(origin, destination, persist=True, jobs=4)
+        for result in archiver:
+            if result.status == results.FAILED:
+                ...
+        archiver.summary.files[results.DONE]
+
+    Each result is a results.Result. The results come in the order the files
+    were planned in, or transferred in if there's an `order`, and skipped files
+    are included. With `bundle`, the skipped files come first, and then the
+    rest bucket by bucket. `summary` (a results.Summary) keeps running totals
+    of them. Once the run is over, it also has the plan's totals and the run's
+    metrics.
+
+    Without a logger, only warnings and errors are logged (see
+    loggers.quiet_logger()). No message for a file is put together unless the
+    logger would actually log it.
+
+    The current directory is never changed, so the caller is free to do as it
+    likes between results (or in other threads) while a run is going.
+
+    Each run reads what it needs of the destination afresh (its directories,
+    manifest, journal, and dedup store). To archive a few files at a time over
+    and over (as watch() does), use the archiver in a 'with' statement: what
+    was read is then kept open from one run to the next, and only what the
+    runs change is updated, until the 'with' block ends. (Only what the last
+    run used, e.g. today's buckets, is remembered about the directories, so
+    memory use doesn't grow the longer it goes on.)
+
+        with Archiver(origin, destination) as archiver:
+            for paths in batches:
+                for result in archiver.run(paths):
+                    ...
+
+    The parameters are the same as for nested() and flat(), with `flat` saying
+    which of them to do.
+    """
+    def __init__(self, origin, destination, flat=False, grain=3, delimiter='.', replace=True, persist=False, update_time=False, logger=None, jobs=1, incremental=False, recursive=False, dedup=False, dry_run=False, plan_out=None, stats_file=None, pipeline=False, bundle=None, order='name', verify=False, throttle=None):
+        self.origin      = origin
+        self.destination = destination
+        self.flat        = flat
+        self.grain       = grain
+        self.delimiter   = delimiter
+        self.replace     = replace
+        self.persist     = persist
+        self.update_time = update_time
+        self.logger      = logger or loggers.quiet_logger()
+        self.jobs        = jobs
+        self.incremental = incremental
+        self.recursive   = recursive
+        self.dedup       = dedup
+        self.dry_run     = dry_run
+        self.plan_out    = plan_out
+        self.stats_file  = stats_file
+        self.pipeline    = pipeline
+        self.bundle      = bundle
+        self.order       = order
+        self.verify      = verify
+        self.throttle    = throttle
+        self.summary     = results.Summary()
+        self.kept        = None
+
+    def __enter__(self):
+        self.kept = _Kept()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        kept, self.kept = self.kept, None
+        kept.close()
+
+    def __iter__(self):
+        return self.run()
+
+    def run(self, paths=None):
+        """
+        Does the archival (again, if it's been done already), starting with a
+        fresh summary.
+
+        :param paths: if given, only these files in the origin are archived,
+            as though they were all that was in it (see watch())
+        :return: a generator of the results.Result of each file
+        """
+        self.summary = results.Summary()
+        target_for, depth = _targets(self.flat, self.grain, self.delimiter)
+        return _archive(self.origin, self.destination, target_for, depth, self.replace, self.persist,
+                        self.update_time, self.logger, self.jobs, self.incremental, self.recursive, self.dedup,
+                        self.dry_run, self.plan_out, self.stats_file, self.pipeline, self.bundle, self.order,
+                        self.verify, self.throttle, self.summary, paths, self.kept)
+
+class _Kept(object):
+    """
+    What an Archiver keeps open in the destination between runs: its DirCache
+    (and, when bundling, its bundle.Members), manifest, journal, and dedup
+    store. Each is opened by the first run that needs it.
+    """
+    def __init__(self):
+        self.dirs     = None
+        self.existing = None
+        self.manifest = None
+        self.journal  = None
+        self.store    = None
+
+    def close(self):
+        for opened in (self.manifest, self.journal, self.store):
+            if opened is not None:
+                opened.close()
+        self.dirs = self.existing = self.manifest = self.journal = self.store = None
+
+def plan(origin, destination, flat=False, grain=3, delimiter='.', replace=True, incremental=False, recursive=False):
+    """
+    Works out what archiving would do, without touching anything.
+
+    :param origin: the originating directory
+    :param destination: the destination directory
+    :param flat: whether the destination is organized flat (True) or nested
+    :type flat: bool
+    :param grain: the granularity to organize by
+    :type grain: int
+    :param delimiter: the delimiter used in flat file names
+    :param replace: whether files already in the destination would be replaced
+    :type replace: bool
+    :param incremental: whether to leave out files the destination's manifest
+        lists as unchanged
+    :type incremental: bool
+    :param recursive: whether to include the origin's subdirectories
+    :type recursive: bool
+    :return: a generator of planner.Operations
+    """
     # Check that the origin actually, like... exists.
     if not os.path.isdir(origin):
         raise RuntimeError("No such origin directory: " + origin)
-    
+
+    target_for, depth = _targets(flat, grain, delimiter)
+    manifest = _manifest(destination, incremental, dry_run=True)
+    try:
+        for operation in _plan(origin, destination, target_for, DirCache(destination, depth), replace, manifest, recursive):
+            yield operation
+    finally:
+        if manifest is not None:
+            manifest.close()
+
+def verify_manifest(destination, logger=None):
+    """
+    Checks the manifest in the destination against the files that are actually
+    there. Records of files which have gone missing (or changed size) are
+    removed, so those files will be archived again on the next incremental run.
+
+    :param destination: the destination directory holding the manifest
+    :param logger: a Management Tools logger to record information
+    :return: the number of records that were removed
+    """
+    # Ensure we have some sort of logger. Prevents errors.
+    if not logger:
+        logger = loggers.stream_logger(1)
+
+    # (Opening one that isn't there would make an empty one.)
+    if not os.path.isfile(os.path.join(destination, MANIFEST_NAME)):
+        logger.info("No manifest in {}: nothing to verify.".format(destination))
+        return 0
+    with Manifest(destination) as manifest:
+        logger.info("Verifying {} manifest records in: {}".format(len(manifest), manifest.path))
+        dropped = manifest.verify(destination)
+    for origin in dropped:
+        logger.info("  Dropped: " + origin)
+    logger.info("{} records dropped.".format(len(dropped)))
+    return len(dropped)
+
+def prune(destination, flat=False, grain=3, delimiter='.', days=None, weeks=None, months=None, dry_run=False, logger=None):
+    """
+    Removes old date buckets from the destination, keeping only those that the
+    retention rules keep (see retention.keep()). Which bucket each file is in
+    is read from the names in the destination alone, so nothing has to be
+    stat'ed, and whole directories are removed at once wherever possible.
+
+    :param destination: the destination directory
+    :param flat: whether the destination is organized flat (True) or nested
+    :type flat: bool
+    :param grain: the granularity the destination was archived with
+    :type grain: int
+    :param delimiter: the delimiter used in flat file names
+    :param days: keep every bucket from this many days back
+    :param weeks: keep the newest bucket of each week this many weeks back
+    :param months: keep the newest bucket of each month this many months back
+    :param dry_run: whether to only report what would be removed
+    :type dry_run: bool
+    :param logger: a Management Tools logger to record information
+    :return: the list of paths (relative to the destination) that were removed
+    """
+    # Ensure we have some sort of logger. Prevents errors.
+    if not logger:
+        logger = loggers.stream_logger(1)
+
     if not os.path.isdir(destination):
-        logger.error("Creating destination directory at: " + destination)
-        os.makedirs(destination)
-    
-    # Find everything in the origin directory.
-    logger.info("Building payload list.")
-    with ChDir(origin):
-        payload = sorted([os.path.abspath(x) for x in os.listdir('.')])
+        raise RuntimeError("No such destination directory: " + destination)
+
+    logger.info("{} buckets in: {}".format("Would prune" if dry_run else "Pruning", destination))
+    kept, pruned, removed = retention.prune(destination, flat, grain, delimiter, days, weeks, months, dry_run)
+    for path in removed:
+        logger.info("  ./" + path)
+    logger.info("{} buckets kept, {} {}.".format(kept, pruned, "would be removed" if dry_run else "removed"))
+    return removed
+
+def watch(origin, destination, flat=False, grain=3, delimiter='.', window=1.0, replace=True, persist=False, update_time=False, logger=None, jobs=1, incremental=False, recursive=False, dedup=False, stats_file=None, pipeline=False, bundle=None, poll=False, order='name', verify=False, throttle=None):
+    """
+    Keeps archiving files as they arrive in the origin, until interrupted.
+
+    The origin is watched (see watcher.start()) rather than read over and over:
+    with inotify, nothing at all is done while it's idle. Nor is the
+    destination: what's been read of it (its directories, manifest, journal,
+    and dedup store) is kept from one group to the next (see Archiver). A file is only
+    archived once whatever was writing it has finished with it. Files that are
+    ready within `window` seconds of each other are archived together, each
+    group being placed exactly as nested() or flat() would place it. Files that
+    are already in the origin when watching starts are archived first.
+
+    A group that fails is reported, and watching carries on.
+
+    :param origin: the directory to watch
+    :param destination: the destination directory
+    :param flat: whether the destination is organized flat (True) or nested
+    :type flat: bool
+    :param window: how long to gather files for before archiving them (and,
+        when polling, how often to poll), in seconds
+    :param poll: whether to poll the origin even where inotify is available
+    :type poll: bool
+
+    A throttle's schedule is looked at (and reloaded, if that was asked for)
+    for each group.
+
+    The rest are as for nested() and flat().
+    """
+    # Ensure we have some sort of logger. Prevents errors.
+    if not logger:
+        logger = loggers.stream_logger(1)
+
+    # Check that the origin actually, like... exists.
+    if not os.path.isdir(origin):
+        raise RuntimeError("No such origin directory: " + origin)
+    origin      = os.path.abspath(origin)
+    destination = os.path.abspath(destination)
+    archiver    = Archiver(origin, destination, flat, grain, delimiter, replace, persist, update_time, logger, jobs,
+                           incremental, recursive, dedup, False, None, stats_file, pipeline, bundle, order, verify,
+                           throttle)
+
+    with archiver, watcher.start(origin, recursive, window, exclude=[destination], poll=poll) as watching:
+        logger.info("Watching {} ({}, gathering files for {} s at a time).".format(
+            origin, "inotify" if isinstance(watching, watcher.Inotify) else "polling", window
+        ))
+        for paths in watching.batches():
+            try:
+                for result in archiver.run(paths):
+                    pass
+            except Exception as e:
+                logger.error("Archiving {} files failed: {}: {}".format(len(paths), type(e).__name__, e))
+
+def rebuild_manifest(origin, destination, flat=False, grain=3, delimiter='.', logger=None, recursive=False, bundle=None):
+    """
+    Throws away the manifest in the destination and builds a new one from the
+    files in the origin which can already be found in the destination (with the
+    same size and modification time). Each file is looked for where an
+    archival with the same options would have put it.
+
+    :param origin: the originating directory
+    :param destination: the destination directory holding the manifest
+    :param flat: whether the destination is organized flat (True) or nested
+    :type flat: bool
+    :param grain: the granularity the destination is organized by
+    :type grain: int
+    :param delimiter: the delimiter used in flat file names
+    :param logger: a Management Tools logger to record information
+    :param recursive: whether the files beneath the origin's subdirectories
+        were archived too
+    :type recursive: bool
+    :param bundle: the format of the bundles the files were archived into, if
+        they were (see bundle.Bundle)
+    :return: the number of records in the new manifest
+    """
+    # Ensure we have some sort of logger. Prevents errors.
+    if not logger:
+        logger = loggers.stream_logger(1)
+    target_for, depth = _targets(flat, grain, delimiter)
+    if bundle:
+        bundles.check(bundle)
+        target_for = _bundled(target_for, bundle)
+        found      = bundles.Members(destination, bundle)
+
+    # Check that the origin actually, like... exists.
+    if not os.path.isdir(origin):
+        raise RuntimeError("No such origin directory: " + origin)
+    origin      = os.path.abspath(origin)
+    destination = os.path.abspath(destination)
+
+    logger.info("Rebuilding manifest in: " + destination)
+    if recursive:
+        entries = scanner.walk(origin, exclude=[destination])
+    else:
+        entries = scanner.payload(origin)
+    start = len(os.path.join(origin, ''))
+    with Manifest(destination) as manifest:
+        manifest.clear()
+        for entry in entries:
+            bucket, target = target_for(entry, entry.path[start:])
+            if bundle and bundles.split(target) is not None:
+                if found.matches(target, entry):
+                    manifest.record(entry, target)
+                continue
+            try:
+                info = os.stat(os.path.join(destination, target))
+            except OSError:
+                continue
+            if info.st_size == entry.size and int(info.st_mtime) == int(entry.mtime):
+                manifest.record(entry, target)
+        logger.info("{} records written.".format(len(manifest)))
+        return len(manifest)
+
+def _targets(flat, grain, delimiter='.'):
+    """
+    Works out how files are placed in the destination.
+
+    :return: a function taking an entry and its path relative to the origin,
+        which returns the entry's bucket and its target path (relative to the
+        destination); and how deep the date directories go
+    """
+    if flat:
+        buckets = formatting.Bucketer(grain, delimiter)
+        def target_for(entry, relative):
+            # The date goes on the front of the file name. (Any directories in
+            # the file's path relative to the origin become part of the name
+            # too.)
+            prefix = buckets.bucket(entry.mtime)
+            return prefix, prefix + delimiter + relative.replace(os.sep, delimiter)
+        return target_for, 0
+    else:
+        buckets = formatting.Bucketer(grain)
+        def target_for(entry, relative):
+            # The file keeps its path relative to the origin beneath its date
+            # directory.
+            leaf = buckets.bucket(entry.mtime)
+            return leaf, leaf + os.sep + relative
+        return target_for, buckets.grain
+
+def _bundled(target_for, format):
+    """
+    Wraps a target_for function so that each file's target is in its bucket's
+    bundle instead (see bundle.target()). Only files are bundled: anything else
+    (a subdirectory of the origin, when it isn't walked) keeps its own target,
+    and goes into the bucket's directory the usual way.
+    """
+    def bundled(entry, relative):
+        bucket, target = target_for(entry, relative)
+        if not entry.is_file:
+            return bucket, target
+        return bucket, bundles.target(bucket, format, relative)
+    return bundled
+
+def _manifest(destination, incremental, dry_run=False):
+    """
+    Opens the destination's manifest if it's wanted. (A dry run won't create
+    one that isn't there.)
+    """
+    if not incremental:
+        return None
+    if dry_run and not os.path.isfile(os.path.join(destination, MANIFEST_NAME)):
+        return None
+    return Manifest(destination)
+
+def _plan(origin, destination, target_for, existing, replace, manifest, recursive, metrics=None, paths=None, streaming=False):
+    """
+    Plans the archival of everything in the origin.
+
+    Without `recursive`, the origin's contents are read in one go and sorted by
+    name. With it, everything beneath the origin is planned as it is found (and
+    the destination is not wandered into, if it happens to be in there). If
+    `paths` are given, just those files are planned, and the origin isn't read
+    at all.
+
+    If metrics are given, the time spent on this goes to the 'scan' phase.
+
+    :param existing: what's in the destination already (see planner.plan())
+    :param streaming: whether each file is transferred as soon as it's planned
+        (see planner.plan())
+    """
+    if paths is not None:
+        entries = scanner.entries(paths)
+    elif recursive:
+        entries = scanner.walk(origin, exclude=[os.path.abspath(destination)])
+    else:
+        entries = scanner.payload(origin)
+    operations = planner.plan(entries, origin, target_for, existing, replace, manifest,
+                              streaming and recursive and paths is None)
+    if metrics is not None:
+        operations = metrics.timed(operations, 'scan')
+    return operations
+
+def _archive(origin, destination, target_for, depth, replace, persist, update_time, logger, jobs, incremental, recursive, dedup, dry_run, plan_out, stats_file, pipeline, bundle, order='name', verify=False, throttle=None, summary=None, paths=None, kept=None):
+    """
+    Does the archival for Archiver (and so for nested() and flat()). First each file's operation
+    is planned, and then (unless this is a dry run) it is carried out.
+
+    Without `recursive`, the whole plan is made before anything is done, so
+    that all of the directories can be created in one go. With it, each file
+    is streamed through the pipeline:
+
+        scan -> classify by date -> ensure directory -> transfer
+
+    as soon as it is found, so the first file is put in place before the scan
+    is finished and memory use doesn't depend on how many files there are.
+
+    With `pipeline`, the destination's existing directories are all read up
+    front, `jobs` at a time, and each missing directory is created by the
+    worker that's about to put the first file in it. That way none of the
+    round trips to the destination hold up anything but the file they're for.
+
+    With `bundle`, each bucket's files go into the bucket's bundle (see
+    bundle.Bundle) rather than being put in the destination one by one. The
+    whole plan is made first (even when `recursive`), so that each bundle can
+    be written in one go.
+
+    With an `order` other than 'name', the whole plan is made first (even when
+    `recursive`) and put in that order (see scheduler.order()) before anything
+    is transferred.
+
+    With `verify`, every file that's written is read back and checked against
+    its original before it's put in place (or, when moving, before the
+    original is removed), and each bucket's digests are kept next to it.
+
+    With a `throttle`, files are written no faster than its limits allow, and
+    the time spent waiting on it is added to the metrics.
+
+    With `paths` (from watch()), only those files are archived, as though they
+    were all that was in the origin.
+
+    Either way, the run's metrics are summarized at the end.
+
+    :param summary: if given, a results.Summary to keep the totals of the plan
+        and the results in, and the run's metrics
+    :param kept: if given, the _Kept of an Archiver, to use what it holds (or
+        keep what's opened in it) instead of opening it for just this run
+    :return: a generator of the results.Result of each file
+    """
+    if summary is None:
+        summary = results.Summary()
+    metrics = summary.metrics = stats.Metrics()
+    scheduler.check(order)
+    # Whether each file is transferred as soon as it's found.
+    streaming = recursive and not bundle and order == 'name'
+    if bundle:
+        bundles.check(bundle)
+        target_for = _bundled(target_for, bundle)
+
+    # Check that the origin actually, like... exists.
+    if not os.path.isdir(origin):
+        raise RuntimeError("No such origin directory: " + origin)
     
-    # Do all of the archival.
-    with ChDir(destination):
-        file_prefixes   = {}
-        max_file_length = 0
-        for file in payload:
-            # For each file, pull its timestamp and split it into its different
-            # parts. These will be used to create the appropriate file name for
-            # each file being moved.
-            time = datetime.fromtimestamp(os.path.getmtime(file))
-            date_parts = time.strftime(date).split('.')
-            prefix = delimiter.join(date_parts)
-            file_prefixes[file] = prefix
+    # Destination should probably exist.
+    if not os.path.isdir(destination):
+        if dry_run:
+            logger.info("Would create destination directory at: " + destination)
+        else:
+            logger.error("Creating destination directory at: " + destination)
+            os.makedirs(destination)
+    origin      = os.path.abspath(origin)
+    destination = os.path.abspath(destination)
+
+    # Whether files can be moved by renaming them is the same for every file,
+    # so it's only checked once.
+    cross_device = not transfer.same_device(origin, destination)
+    if not persist and not bundle:
+        if cross_device:
+            logger.info("Origin and destination are on different devices: files will be copied and then removed.")
+        else:
+            logger.info("Origin and destination are on the same device: files will be renamed into place.")
+
+    if paths is not None:
+        logger.info("{} files ready in: {}".format(len(paths), origin))
+    else:
+        logger.info("Streaming payload from: " + origin if streaming else "Building payload list.")
+    if kept is not None and kept.dirs is not None:
+        dirs, existing, manifest = kept.dirs, kept.existing, kept.manifest
+    else:
+        manifest = _manifest(destination, incremental, dry_run)
+        dirs     = DirCache(destination, depth, jobs if pipeline else 1)
+        # (When bundling, whether a file is there already depends on what's in
+        # its bucket's bundle.)
+        existing = bundles.Members(destination, bundle) if bundle else dirs
+        if kept is not None:
+            kept.dirs, kept.existing, kept.manifest = dirs, existing, manifest
+    # (A kept cache carries its counts over from earlier runs.)
+    counts = _dir_counts(dirs)
+    out    = open(plan_out, 'w') if plan_out else None
+    totals = summary.totals
+    try:
+        operations = _plan(origin, destination, target_for, existing, replace, manifest, recursive, metrics, paths,
+                           streaming)
+        if bundle and replace:
+            operations = _unchanged_members(operations, existing)
+        operations = planner.track(operations, totals, out, persist)
+
+        # In a dry run, that's all.
+        if dry_run:
+            for operation in operations:
+                result = results.Result.of(operation, results.PLANNED if operation.moves else results.SKIPPED)
+                summary.add(result)
+                yield result
+            _log_totals(totals, logger)
+            _log_metrics(metrics, stats_file, logger)
+            return
+
+        # Do all of the archival.
+        if streaming:
+            max_file_length = 0
+            if not pipeline:
+                operations = _ensure_dirs(operations, dirs, logger, metrics)
+        else:
+            operations = scheduler.order(operations, 'name' if bundle else order)
+            _log_totals(totals, logger)
             # This is just used for pretty printing.
-            if len(os.path.basename(file)) > max_file_length:
-                max_file_length = len(os.path.basename(file))
-        
+            max_file_length = max([len(operation.entry.name) for operation in operations if operation.moves] or [0])
+            # Create the nested folders. The cache has read the existing
+            # structure once, and creates each missing folder exactly once,
+            # parents first. (This avoids errors where a folder already
+            # exists.)
+            if depth and not pipeline:
+                start   = time.time()
+                # (A bucket's bundle goes where the bucket's directory
+                # would have.)
+                created = dirs.ensure_all(os.path.dirname(_placed(operation.target))
+                                          for operation in operations if operation.moves)
+                metrics.add('mkdir', time.time() - start)
+                if created:
+                    logger.info("Created nested directory structure in: {}".format(destination))
+                for dir in created:
+                    logger.info("  ./" + dir)
+
+        if throttle is not None:
+            throttle.check()
+            if throttle.error:
+                logger.error("Keeping the old throttle schedule: " + throttle.error)
+            logger.info("Throttling to: {}".format(throttle))
+            waited = throttle.waited
+
         # Start moving/copying the files.
         # (Moving is used if the files don't need to stay in the origin.)
-        logger.info("{} files to appropriate subdirectories...".format("Moving" if not persist else "Copying"))
-        for file, prefix in file_prefixes.items():
-            # Each file gets wrapped in a try/except block to ensure that flow
-            # is not interrupted if there's an issue with one of them.
-            try:
-                # Form the new file name.
-                new_name = prefix + delimiter + os.path.basename(file)
-                add = False
-                # Determine whether the file should be put in the destination.
-                if replace:
-                    # Definitely add the file if we're okay with replacing it.
-                    add = True
+        if bundle:
+            logger.info("{} files into {} bundles...".format("Moving" if not persist else "Copying", bundle))
+            done = _bundle(operations, destination, bundle, persist, update_time, jobs, max_file_length, logger,
+                           manifest, metrics, order, verify, throttle, dirs if pipeline else None)
+        else:
+            logger.info("{} files to appropriate subdirectories...".format("Moving" if not persist else "Copying"))
+            done = _transfer(operations, destination, replace, persist, update_time, jobs, max_file_length, logger,
+                             manifest, dedup, metrics, cross_device, dirs if pipeline else None, verify, throttle,
+                             kept)
+        for result in done:
+            summary.add(result)
+            yield result
+        if throttle is not None:
+            metrics.add('throttle', throttle.waited - waited)
+        if streaming:
+            _log_totals(totals, logger)
+        _log_dirs(dirs, logger, counts)
+        if not persist and not bundle:
+            _log_moves(metrics, logger)
+        if kept is not None:
+            _forget_others(dirs, existing, totals.buckets, bundle)
+        _log_metrics(metrics, stats_file, logger)
+    finally:
+        if out is not None:
+            out.close()
+        if manifest is not None:
+            if kept is None:
+                manifest.close()
+            else:
+                manifest.save()
+
+def _unchanged_members(operations, members):
+    """
+    Passes operations along, skipping the replacement of any file that's in
+    its bundle already with the same size and modification time (see
+    bundle.Members.matches()). Unlike a file in a directory, one added to a
+    bundle again doesn't take the place of the old one, but goes in next to
+    it.
+    """
+    for operation in operations:
+        if operation.action == planner.REPLACE and members.matches(operation.target, operation.entry):
+            operation = operation._replace(action=planner.SKIP)
+        yield operation
+
+def _placed(target):
+    """
+    :return: what a target puts in the destination: its bundle, if it's in one,
+        or else the target itself
+    """
+    parts = bundles.split(target)
+    return target if parts is None else parts[0]
+
+def _forget_others(dirs, existing, buckets, bundle=None):
+    """
+    Lets go of what's known about the destination outside of the given buckets
+    (and the directories above them), so that only what was used last is kept
+    from one run to the next.
+    """
+    def used(path):
+        return any(path == bucket or path.startswith(bucket + os.sep) or bucket.startswith(path + os.sep)
+                   for bucket in buckets)
+    dirs.forget([directory for directory in set(dirs.files) | dirs.known if directory and not used(directory)])
+    if bundle:
+        length = len(bundles.extension(bundle))
+        existing.forget([archive for archive in list(existing.names) if archive[:-length] not in buckets])
+
+def _ensure_dirs(operations, dirs, logger, metrics):
+    """
+    Passes operations along, creating the directory for each one's target
+    first if it's not there yet.
+    """
+    for operation in operations:
+        if operation.moves:
+            start = time.time()
+            for dir in dirs.ensure(os.path.dirname(operation.target)):
+                logger.info("  ./" + dir)
+            metrics.add('mkdir', time.time() - start)
+        yield operation
+
+def _log_totals(totals, logger):
+    """
+    Reports what the plan holds.
+    """
+    logger.info("Plan: {} files ({} bytes) into {} buckets; {} new, {} replaced, {} skipped, {} unchanged.".format(
+        totals.moving, totals.moving_bytes, len(totals.buckets),
+        totals.files[planner.ADD], totals.files[planner.REPLACE],
+        totals.files[planner.SKIP], totals.files[planner.UNCHANGED]
+    ))
+
+def _log_metrics(metrics, stats_file, logger):
+    """
+    Reports the run's metrics, and writes them to the stats file (if any).
+    """
+    metrics.finish()
+    for line in metrics.summary():
+        logger.info(line)
+    if stats_file:
+        try:
+            metrics.write(stats_file)
+        except (IOError, OSError) as e:
+            logger.error("{}".format(repr(e)))
+            logger.error("Unable to write stats file: " + stats_file)
+
+def _log_moves(metrics, logger):
+    """
+    Reports how many files (and bytes) were moved by renaming them, and how
+    many had to be copied across devices and then removed.
+    """
+    renamed = (metrics.strategies.get('rename', 0), metrics.strategy_bytes.get('rename', 0))
+    copied  = (sum(metrics.strategies.values()) - renamed[0], sum(metrics.strategy_bytes.values()) - renamed[1])
+    logger.info("Moves: {} files ({} bytes) renamed, {} files ({} bytes) copied and removed.".format(
+        renamed[0], renamed[1], copied[0], copied[1]
+    ))
+
+def _dir_counts(dirs):
+    """
+    :return: how much work the directory cache has done (and saved) so far
+    """
+    return dirs.created, dirs.scanned, dirs.hits
+
+def _log_dirs(dirs, logger, since=(0, 0, 0)):
+    """
+    Reports how much work the directory cache did (and saved) since the counts
+    given were taken (see _dir_counts()).
+    """
+    logger.info("Directories: {} created, {} scanned, {} lookups answered from cache.".format(
+        *[now - then for now, then in zip(_dir_counts(dirs), since)]
+    ))
+
+def _transfer(operations, destination, replace, persist, update_time, jobs, max_file_length, logger, manifest=None, dedup=False, metrics=None, cross_device=False, dirs=None, verify=False, throttle=None, kept=None):
+    """
+    Copies or moves each file to its place in the destination, reporting on
+    each one in the same order as the operations were given.
+
+    :param operations: an iterable of planner.Operations (those which don't
+        move anything are passed over, and reported as skipped)
+    :param destination: the destination directory (absolute)
+    :param jobs: how many files to copy/move at the same time
+    :type jobs: int
+    :param max_file_length: the longest file name (used for pretty printing)
+    :param logger: a Management Tools logger to record information
+    :param manifest: if given, each file that's copied is recorded in it
+    :param dedup: whether to put files through a BlobStore in the destination
+    :param metrics: if given, a metrics.Metrics to record each file in
+    :param cross_device: whether the destination is on a different device
+        from the origin
+    :type cross_device: bool
+    :param dirs: if given, the destination's DirCache; the directory for each
+        file is then ensured by the same worker that transfers it
+    :param verify: whether to check each file as it's written (see
+        transfer.place()), and write each bucket's digests next to it
+    :param throttle: if given, a throttle.Throttle for transfer.place() to
+        keep to
+    :param kept: if given, the _Kept of an Archiver, whose journal and dedup
+        store are used (and left open)
+    :return: a generator of the results.Result of each operation
+
+    When moving files on the same device, each one is only a rename, so they
+    are all done in a row without handing them off to worker threads (which
+    would cost more than the renames do), unless the directories are handled
+    by the workers too. Moving across devices means copying
+    each file and then removing it, which goes through the workers like any
+    other copy, without trying a rename first.
+    """
+    if not persist and not dedup and not cross_device and dirs is None:
+        jobs = 1
+    if kept is None:
+        store   = BlobStore(destination) if dedup else None
+        journal = Journal(destination)
+    else:
+        if dedup and kept.store is None:
+            kept.store = BlobStore(destination)
+        if kept.journal is None:
+            kept.journal = Journal(destination)
+        store, journal = kept.store if dedup else None, kept.journal
+    sidecars = digests.Sidecars(destination) if verify else None
+    if len(journal):
+        logger.info("Resuming where possible: {} copies were interrupted.".format(len(journal)))
+    # The line for each file is only put together if it's going to be logged.
+    verbose  = loggers.enabled(logger)
+
+    def work(operation):
+        if not operation.moves:
+            return operation, [], results.Result.of(operation, results.SKIPPED)
+        # Each file gets wrapped in a try/except block to ensure that flow is
+        # not interrupted if there's an issue with one of them. The error is
+        # handed back so that it can be reported in order.
+        start   = time.time()
+        created = []
+        try:
+            if dirs is not None:
+                created = dirs.ensure(os.path.dirname(operation.target))
+                if metrics is not None:
+                    metrics.add('mkdir', time.time() - start)
+            checksum = digests.Checksum() if verify else None
+            strategy = transfer.place(operation.entry, os.path.join(destination, operation.target), replace,
+                                      persist, update_time, store,
+                                      exists=operation.action == planner.REPLACE, metrics=metrics,
+                                      journal=journal, cross_device=cross_device, checksum=checksum,
+                                      throttle=throttle)
+            error    = None
+            if strategy and sidecars is not None and checksum.value:
+                sidecars.add(operation.bucket, operation.target, checksum.value)
+        except Exception as e:
+            strategy = 'failed'
+            error    = e
+        seconds = time.time() - start
+        if metrics is not None:
+            metrics.file(operation.entry.path, operation.entry.size, seconds, strategy, error)
+        if error is not None:
+            result = results.Result.of(operation, results.FAILED, None, seconds, error)
+        elif strategy:
+            result = results.Result.of(operation, results.DONE, strategy, seconds)
+        else:
+            # It turned up in the destination after all, and isn't replaced.
+            result = results.Result.of(operation, results.SKIPPED, None, seconds)
+        return operation, created, result
+
+    try:
+        for operation, created, result in transfer.imap(work, operations, jobs,
+                                                        inline=lambda operation: not operation.moves):
+            entry, target, error = operation.entry, operation.target, result.error
+            for dir in created:
+                logger.info("  ./" + dir)
+            # If the file was put in the destination (or we tried to), report on
+            # it and how it got there.
+            if verbose and result.status in (results.DONE, results.FAILED):
+                logger.info("  {file:>{length}} {dash}> ./{dest} [{strategy}]".format(
+                    file     = entry.name,
+                    length   = max_file_length,
+                    dest     = target,
+                    dash     = '=' if persist else '-',
+                    strategy = result.strategy or 'failed'
+                ))
+            if isinstance(error, (IOError, OSError)):
+                # These are the most likely errors.
+                logger.error("{}".format(repr(error)))
+                logger.error("Unable to copy file '{}' to path: {}".format(entry.path, target))
+            elif error is not None:
+                logger.error("{}".format(repr(error)))
+            elif result.status == results.DONE and manifest is not None and persist:
+                manifest.record(entry, target)
+            yield result
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Quitting...")
+    finally:
+        if kept is None:
+            journal.close()
+            if store is not None:
+                store.close()
+        else:
+            journal.trim()
+        if sidecars is not None:
+            sidecars.close()
+
+def _bundle(operations, destination, format, persist, update_time, jobs, max_file_length, logger, manifest=None, metrics=None, order='name', verify=False, throttle=None, dirs=None):
+    """
+    Writes the files of each bucket into the bucket's bundle, `jobs` bundles at
+    a time (so compression makes use of that many cores). Each file is
+    reported in the order its bundle was written in, bucket by bucket.
+
+    When moving, the original files are only removed once their bundle has
+    been written and synced to disk (and, with `verify`, read back and checked
+    against them). If a bundle can't be written, none of its files are
+    removed.
+
+    :param operations: an iterable of planner.Operations with targets made by
+        bundle.target() (those which don't move anything are passed over, and
+        reported as skipped before any bundles are written). Any with targets
+        outside of a bundle (see _bundled()) are put in place with
+        transfer.place() first.
+    :param destination: the destination directory (absolute)
+    :param format: one of bundle.FORMATS
+    :param jobs: how many bundles to write at the same time
+    :type jobs: int
+    :param max_file_length: the longest file name (used for pretty printing)
+    :param logger: a Management Tools logger to record information
+    :param manifest: if given, each file that's copied is recorded in it
+    :param metrics: if given, a metrics.Metrics to record each file in
+    :param order: the order to write the bundles in (see scheduler.buckets()),
+        and each bundle's files in (see scheduler.order())
+    :param verify: whether to check the files added to each bundle (see
+        bundle.Bundle.verify()), and write each bucket's digests next to its
+        bundle
+    :param throttle: if given, a throttle.Throttle to keep to; it's waited on
+        for each file (and its size) as it's added to a bundle, since what
+        ends up being written is compressed
+    :param dirs: if given, the destination's DirCache; the directory for each
+        bundle is then ensured by the same worker that writes it
+    :return: a generator of the results.Result of each operation
+    """
+    buckets = []
+    members = {}
+    loose   = []
+    for operation in operations:
+        if operation.moves and bundles.split(operation.target) is None:
+            loose.append(operation)
+        elif operation.moves:
+            if operation.bucket not in members:
+                buckets.append(operation.bucket)
+                members[operation.bucket] = []
+            members[operation.bucket].append(operation)
+        else:
+            yield results.Result.of(operation, results.SKIPPED)
+    for bucket in buckets:
+        members[bucket] = scheduler.order(members[bucket], order)
+    buckets  = scheduler.buckets(buckets, members, order)
+    sidecars = digests.Sidecars(destination) if verify else None
+    # The line for each file is only put together if it's going to be logged.
+    verbose  = loggers.enabled(logger)
+
+    def place(operation):
+        # The same outcomes as work(), for something that isn't bundled.
+        created = []
+        start   = time.time()
+        try:
+            if dirs is not None:
+                created = dirs.ensure(os.path.dirname(operation.target))
+            if throttle is not None:
+                throttle.operation()
+            strategy = transfer.place(operation.entry, os.path.join(destination, operation.target), True,
+                                      persist, update_time, exists=operation.action == planner.REPLACE)
+            return created, [[operation, time.time() - start, None, strategy]]
+        except Exception as e:
+            return created, [[operation, time.time() - start, e, None]]
+
+    def work(bucket):
+        # The outcomes are the operation, how long it took, the error (if there
+        # was one), and how it was stored for each file, along with the
+        # directories created.
+        operations = members.pop(bucket)
+        outcomes   = []
+        checksums  = {}
+        created    = []
+        archive    = bundles.split(operations[0].target)[0]
+        try:
+            if dirs is not None:
+                start   = time.time()
+                created = dirs.ensure(os.path.dirname(archive))
+                if metrics is not None:
+                    metrics.add('mkdir', time.time() - start)
+            with bundles.Bundle(os.path.join(destination, archive), format, update_time) as out:
+                for operation in operations:
+                    start = time.time()
+                    try:
+                        name = bundles.split(operation.target)[1]
+                        if verify:
+                            checksums[name] = digests.Checksum()
+                        if throttle is not None:
+                            throttle.operation()
+                        out.add(operation.entry.path, name, checksums.get(name))
+                        if throttle is not None:
+                            throttle.transferred(operation.entry.size)
+                        error = None
+                    except Exception as e:
+                        if out.broken:
+                            raise
+                        error = e
+                    outcomes.append([operation, time.time() - start, error, format])
+        except Exception as e:
+            return created, [(operation, 0, e, None) for operation in operations]
+        if verify:
+            # Read back what was added, before any of the originals go.
+            added = dict((bundles.split(outcome[0].target)[1], outcome) for outcome in outcomes if outcome[2] is None)
+            bad   = set(out.verify(dict((name, checksums[name].value) for name in added)))
+            for name, outcome in added.items():
+                if name in bad:
+                    outcome[2] = IOError(errno.EIO, "Bundled file doesn't match its original", outcome[0].target)
                 else:
-                    # If we're not okay with replacing it, ensure that the file
-                    # does not exist in the destination already.
-                    if not os.path.isfile(new_name):
-                        add = True
-                # If we're okay with adding the file, then do the thing!
-                if add:
-                    logger.info("  {file:>{length}} {dash}> ./{new}".format(
+                    sidecars.add(outcome[0].bucket, outcome[0].target, checksums[name].value)
+        if not persist:
+            for outcome in outcomes:
+                if outcome[2] is None:
+                    try:
+                        os.unlink(outcome[0].entry.path)
+                    except OSError as e:
+                        outcome[2] = e
+        return created, outcomes
+
+    try:
+        done = itertools.chain(transfer.imap(place, loose, jobs), transfer.imap(work, buckets, jobs))
+        for created, outcomes in done:
+            for dir in created:
+                logger.info("  ./" + dir)
+            for operation, seconds, error, strategy in outcomes:
+                entry, target = operation.entry, operation.target
+                if metrics is not None:
+                    metrics.file(entry.path, entry.size, seconds, strategy if error is None else 'failed', error)
+                if verbose:
+                    logger.info("  {file:>{length}} {dash}> ./{dest} [{format}]".format(
+                        file   = entry.name,
                         length = max_file_length,
-                        file   = os.path.basename(file),
-                        new    = new_name,
-                        dash   = '=' if persist else '-'
+                        dest   = target,
+                        dash   = '=' if persist else '-',
+                        format = strategy if error is None else 'failed'
                     ))
-                    # If the file exists in the destination, delete it before
-                    # attempting to move a new copy there. This also accounts
-                    # for symbolic links.
-                    if os.path.isfile(new_name):
-                        os.remove(new_name)
-                    # Copy if persisting data; move otherwise.
-                    if persist:
-                        shutil.copy2(file, new_name)
-                    else:
-                        shutil.move(file, new_name)
-                    # Update the time as needed.
-                    if update_time:
-                        os.utime(new_name, None)
-            except (IOError, OSError) as e:
-                # These are the most likely errors.
-                logger.error("{}".format(repr(e)))
-                logger.error("Unable to copy file '{}' to path: {}".format(file, path))
-            except (KeyboardInterrupt, SystemExit):
-                logger.info("Quitting...")
-                break
-            except Exception as e:
-                logger.error("{}".format(repr(e)))
+                if isinstance(error, (IOError, OSError)):
+                    logger.error("{}".format(repr(error)))
+                    logger.error("Unable to bundle file '{}' into: {}".format(entry.path, target))
+                elif error is not None:
+                    logger.error("{}".format(repr(error)))
+                elif manifest is not None and persist:
+                    manifest.record(entry, target)
+                if error is None:
+                    yield results.Result.of(operation, results.DONE, strategy, seconds)
+                else:
+                    yield results.Result.of(operation, results.FAILED, None, seconds, error)
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Quitting...")
+    finally:
+        if sidecars is not None:
+            sidecars.close()
 
 def uniquify(seq, idfun=None):
     """
@@ -0,0 +1,400 @@
+import errno
+import os
+import time
+
+import digests
+
+# The kinds of bundle that can be made, in the order they're listed in help.
+FORMATS = ('tar.gz', 'tar.zst', 'zip')
+
+# What separates a bundle's path from the name of a file in it, in a target.
+SEPARATOR = ':'
+
+# Before Python 3.6, zipfile can only add a whole file from its path, or one
+# from memory. Files up to this size are read into memory (and hashed on the
+# way) so that they're only read once; bigger ones are read once to hash them
+# and again to add them.
+_BUFFERED = 8 * 1024 * 1024
+
+def check(format):
+    """
+    Makes sure a bundle format can be used here.
+
+    :raises ValueError: if it's unknown, or needs a module that isn't installed
+    """
+    if format not in FORMATS:
+        raise ValueError("Unknown bundle format: " + format)
+    if format == 'tar.zst' and _zstandard() is None:
+        raise ValueError("The 'zstandard' module is needed for tar.zst bundles.")
+
+def _zstandard():
+    """
+    :return: the 'zstandard' module (which isn't part of the standard library
+        and is needed for tar.zst bundles), or None if it isn't installed
+    """
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+def extension(format):
+    """
+    :return: what's added to a bucket's name to make the name of its bundle
+    """
+    return '.' + format
+
+def target(bucket, format, name):
+    """
+    :return: the target of a file in a bucket's bundle, in the form
+        "bucket.tar.gz:name" (this is what gets planned, logged, and recorded)
+    """
+    return bucket + extension(format) + SEPARATOR + name
+
+def split(target):
+    """
+    :return: the bundle and the name within it from a target made by target(),
+        or None if the target isn't in a bundle
+    """
+    for format in FORMATS:
+        marker = extension(format) + SEPARATOR
+        index  = target.find(marker)
+        if index >= 0:
+            return target[:index + len(marker) - 1], target[index + len(marker):]
+    return None
+
+class Bundle(object):
+    """
+    A single archive file holding the files of one date bucket.
+
+    Files are read straight from the origin into the archive (and compressed on
+    the way), without being staged anywhere first. If the archive already
+    exists, the files are appended to it:
+
+        tar.gz    a new gzip member is added to the end of the file, holding a
+                  tar stream of just the new files
+        tar.zst   likewise, with a new zstd frame
+        zip       the new files are added, and the zip's directory rewritten
+
+    Concatenated tar streams have end-of-archive markers between them, so read
+    them with `tar --ignore-zeros` (or tarfile's `ignore_zeros=True`). A file
+    that's added again (when replacing one that's changed) is in the bundle
+    twice; extracting a tar bundle leaves the one added last, and zipfile warns
+    of the duplicate name. (The archivers don't add a file again if its size
+    and modification time are the same as those in the bundle.)
+
+    If writing a tar bundle fails, the file is cut back to the size it was when
+    it was opened, so what was already in it stays readable.
+
+    A bundle must only be written by one thread at a time, but any number of
+    bundles may be written at once (compression releases the GIL, so they make
+    use of more than one core).
+    """
+    def __init__(self, path, format, update_time=False):
+        """
+        :param path: the archive file
+        :param format: one of FORMATS
+        :param update_time: whether to give the files the current time instead
+            of their own (in tar bundles; zip bundles always keep the files'
+            own times)
+        :type update_time: bool
+        """
+        check(format)
+        self.path        = path
+        self.format      = format
+        self.update_time = update_time
+        # Whether something went wrong part of the way through writing a file,
+        # so that nothing more can be added.
+        self.broken      = False
+        if format == 'zip':
+            import zipfile
+            self.raw     = None
+            self.archive = zipfile.ZipFile(path, 'a', zipfile.ZIP_DEFLATED, allowZip64=True)
+            return
+        self.raw   = open(path, 'ab')
+        self.raw.seek(0, os.SEEK_END)
+        self.start = self.raw.tell()
+        import tarfile
+        if format == 'tar.gz':
+            import gzip
+            self.stream = gzip.GzipFile(filename='', mode='wb', fileobj=self.raw)
+        else:
+            self.stream = _zstandard().ZstdCompressor().stream_writer(self.raw)
+        self.archive = tarfile.open(fileobj=self.stream, mode='w|', dereference=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add(self, source, name, checksum=None):
+        """
+        Adds a file to the bundle.
+
+        If this fails before anything is written (e.g. the file can't be read),
+        the bundle carries on as it was. If it fails after that, the bundle is
+        marked as broken.
+
+        :param source: the file to add
+        :param name: its name in the bundle
+        :param checksum: if given, a digests.Checksum to leave the file's
+            digest in (the data is hashed as it's read), so that it can be
+            checked with verify()
+        """
+        if os.path.isdir(source):
+            raise IOError(errno.EISDIR, "Is a directory", source)
+        if self.format == 'zip':
+            if checksum is None:
+                os.stat(source)
+                self.broken = True
+                self.archive.write(source, name)
+                self.broken = False
+                return
+            hasher = digests.Hasher()
+            try:
+                with open(source, 'rb') as file:
+                    self._add_zip(file, source, name, hasher)
+            finally:
+                hasher.close()
+            checksum.value = hasher.hexdigest()
+            return
+        with open(source, 'rb') as file:
+            info = self.archive.gettarinfo(arcname=name, fileobj=file)
+            if self.update_time:
+                info.mtime = time.time()
+            hasher = None
+            if checksum is not None:
+                hasher = digests.Hasher()
+                file   = _Hashing(file, hasher)
+            self.broken = True
+            try:
+                self.archive.addfile(info, file)
+            finally:
+                if hasher is not None:
+                    hasher.close()
+            self.broken = False
+        if hasher is not None:
+            checksum.value = hasher.hexdigest()
+
+    def _add_zip(self, file, source, name, hasher):
+        # Adds an open file to a zip bundle, hashing it as it's read (see
+        # _BUFFERED).
+        import shutil
+        import zipfile
+        info = os.fstat(file.fileno())
+        member = zipfile.ZipInfo(name, time.localtime(info.st_mtime)[:6])
+        member.external_attr = (info.st_mode & 0xFFFF) << 16
+        member.compress_type = zipfile.ZIP_DEFLATED
+        member.file_size     = info.st_size
+        if hasattr(zipfile.ZipInfo, 'from_file'):
+            # (Python 3.6+, where a member can be written as a stream.)
+            self.broken = True
+            with self.archive.open(member, 'w') as out:
+                shutil.copyfileobj(_Hashing(file, hasher), out, _BUFFERED)
+        elif info.st_size <= _BUFFERED:
+            data = file.read()
+            hasher.update(data)
+            self.broken = True
+            self.archive.writestr(member, data)
+        else:
+            digests.feed(file, hasher)
+            self.broken = True
+            self.archive.write(source, name)
+        self.broken = False
+
+    def verify(self, expected):
+        """
+        Reads back the files added since the bundle was opened (once it's been
+        closed) and checks each one against its digest. Only what was added is
+        read: for tar bundles, that's the gzip member or zstd frame written
+        this time.
+
+        :param expected: a dictionary of the digest of each name added
+        :return: a list of the names which don't match (or couldn't be read
+            back at all)
+        """
+        found = {}
+        try:
+            if self.format == 'zip':
+                import zipfile
+                with zipfile.ZipFile(self.path) as archive:
+                    for name in expected:
+                        member = archive.open(name)
+                        try:
+                            found[name] = digests.feed(member, digests.Hasher()).hexdigest()
+                        finally:
+                            member.close()
+            else:
+                import tarfile
+                with open(self.path, 'rb') as raw:
+                    digests.drop_cache(raw.fileno())
+                    raw.seek(self.start)
+                    archive = tarfile.open(fileobj=_reader(raw, self.format), mode='r|', ignore_zeros=True)
+                    try:
+                        for member in archive:
+                            if member.name in expected and member.isfile():
+                                found[member.name] = digests.feed(archive.extractfile(member),
+                                                                  digests.Hasher()).hexdigest()
+                    finally:
+                        archive.close()
+        except Exception:
+            # Whatever wasn't read back by now can't be trusted.
+            pass
+        return [name for name in expected if found.get(name) != expected[name]]
+
+    def close(self):
+        """
+        Finishes the bundle and makes sure it's on disk.
+        """
+        self.archive.close()
+        if self.raw is None:
+            return
+        self._finish()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.raw.close()
+
+    def abort(self):
+        """
+        Gives up on the files added since the bundle was opened (as far as the
+        format allows).
+        """
+        if self.raw is None:
+            self.archive.close()
+            return
+        try:
+            self._finish()
+        finally:
+            self.raw.truncate(self.start)
+            self.raw.close()
+
+    def _finish(self):
+        # Ends the compressed stream. (Neither of these closes the file
+        # underneath.)
+        if self.format == 'tar.gz':
+            self.stream.close()
+        else:
+            self.stream.flush(_zstandard().FLUSH_FRAME)
+
+class _Hashing(object):
+    """
+    Passes reads through to a file, hashing the data on the way.
+    """
+    def __init__(self, file, hasher):
+        self.file   = file
+        self.hasher = hasher
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.hasher.update(data)
+        return data
+
+def _reader(raw, format):
+    """
+    :return: a file object which decompresses a tar bundle from an open file
+        (from wherever it's positioned)
+    """
+    if format == 'tar.gz':
+        import gzip
+        return gzip.GzipFile(fileobj=raw)
+    return _zstandard().ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+
+def members(path, format):
+    """
+    :return: a dictionary of the size and modification time of each file in a
+        bundle, by name (for a file that was added more than once, those of the
+        one added last). Zip bundles keep times in local time, to two seconds.
+    """
+    check(format)
+    if format == 'zip':
+        import zipfile
+        with zipfile.ZipFile(path) as archive:
+            return dict((info.filename, (info.file_size, time.mktime(info.date_time + (0, 0, -1))))
+                        for info in archive.infolist())
+    import tarfile
+    with open(path, 'rb') as raw:
+        archive = tarfile.open(fileobj=_reader(raw, format), mode='r|', ignore_zeros=True)
+        try:
+            return dict((member.name, (member.size, member.mtime)) for member in archive)
+        finally:
+            archive.close()
+
+class Members(object):
+    """
+    Keeps track of what's in the bundles in the destination, so that planning
+    can tell whether a file is in its bucket's bundle already (it stands in for
+    the destination's DirCache when bundling). Each bundle is only read once,
+    the first time a file in it is asked about.
+    """
+    def __init__(self, root, format):
+        """
+        :param root: the top of the tree (the destination)
+        :param format: one of FORMATS
+        """
+        self.root   = root
+        self.format = format
+        self.names  = {}
+
+    def _names(self, archive):
+        names = self.names.get(archive)
+        if names is None:
+            path = os.path.join(self.root, archive)
+            try:
+                names = members(path, self.format) if os.path.isfile(path) else {}
+            except Exception:
+                # One that can't be read is planned as though it were empty
+                # (adding to it will fail on its own, and be reported then).
+                names = {}
+            self.names[archive] = names
+        return names
+
+    def claim(self, target):
+        """
+        Checks whether a file is in its bundle already, and notes that it will
+        be from now on.
+
+        :param target: the file's target, made by target() (or, for something
+            that isn't bundled, its path relative to the root)
+        :return: whether the file was in the bundle already
+        """
+        parts = split(target)
+        if parts is None:
+            return os.path.lexists(os.path.join(self.root, target))
+        archive, name = parts
+        names = self._names(archive)
+        if name in names:
+            return True
+        # (What it'll be like isn't known until it's added.)
+        names[name] = None
+        return False
+
+    def matches(self, target, entry):
+        """
+        Checks whether a file is in its bundle already with the same size and
+        modification time as an entry (to the second, or two for zip bundles).
+
+        :param target: the file's target, made by target()
+        :param entry: the scanner Entry of the file
+        """
+        parts = split(target)
+        if parts is None:
+            return False
+        found = self._names(parts[0]).get(parts[1])
+        if found is None:
+            return False
+        size, mtime = found
+        return size == entry.size and abs(mtime - entry.mtime) < (2 if self.format == 'zip' else 1)
+
+    def forget(self, archives):
+        """
+        Lets go of the names in some bundles (they're read again if they're
+        asked about).
+
+        :param archives: an iterable of bundles' paths, relative to the root
+        """
+        for archive in archives:
+            self.names.pop(archive, None)
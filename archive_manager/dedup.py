@@ -0,0 +1,193 @@
+import errno
+import os
+import threading
+
+import digests
+import transfer
+
+# The name of the directory kept at the top of the destination which holds the
+# stored content (and its index).
+STORE_NAME = '.archive_manager_blobs'
+
+# How much of a file to read at a time.
+_CHUNK = 1024 * 1024
+
+# The errors which mean a hard link can't be made (or its blob is gone), so the
+# file has to be written out normally instead.
+_NO_LINK = set(getattr(errno, name) for name in (
+    'ENOENT', 'EPERM', 'EMLINK', 'EXDEV', 'ENOTSUP', 'EOPNOTSUPP'
+) if hasattr(errno, name))
+
+class BlobStore(object):
+    """
+    A content-addressed store in the destination. Every distinct file content
+    is kept exactly once, as a 'blob' named by its SHA-256 digest, and archived
+    files are hard links to their blob. Archiving a file whose content is
+    already in the store doesn't write any data at all.
+
+    The index of stored digests is an append-only text file in the store, with
+    one "digest size" line per blob. It's read into memory when the store is
+    opened.
+
+    Since hard links share their metadata, files with identical content also
+    share permissions and timestamps (those of the first copy stored).
+
+    A single store may be used by many threads at once.
+    """
+    def __init__(self, destination):
+        self.path = os.path.join(os.path.abspath(destination), STORE_NAME)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.index_path = os.path.join(self.path, 'index')
+        self.digests = {}
+        self.sizes   = set()
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as index:
+                for line in index:
+                    try:
+                        digest, size = line.split()
+                        size = int(size)
+                    except ValueError:
+                        # A partly-written line from an interrupted run.
+                        continue
+                    self.digests[digest] = size
+                    self.sizes.add(size)
+        self.index = open(self.index_path, 'a')
+        self.lock  = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def blob(self, digest):
+        """
+        :return: the path of the blob with the given digest
+        """
+        return os.path.join(self.path, digest[:2], digest)
+
+    def copy(self, source, target, checksum=None, throttle=None):
+        """
+        Puts a copy of a file at `target`, using the store.
+
+        If nothing in the store is the same size as the file, it can't possibly
+        be a duplicate, so it is hashed as it's copied into the store (reading
+        it only once). Otherwise it is hashed first, and only copied if its
+        digest turns out to be new.
+
+        With a checksum, a new blob is read back and checked against the
+        original before it's added to the store. (Content that was already
+        stored isn't checked again.) With a throttle, only the writing of new
+        content is held back.
+
+        :param source: the file to copy
+        :param target: the path of the new file
+        :param checksum: if given, a digests.Checksum to check the copy with
+        :param throttle: if given, a throttle.Throttle to keep to
+        :return: 'dedup' if the content was already stored, 'stored' if it was
+            added to the store, or the strategy from transfer.copy() if the
+            destination doesn't support hard links
+        """
+        if os.path.isdir(source):
+            raise IOError(errno.EISDIR, "Is a directory", source)
+        size = os.path.getsize(source)
+        if size in self.sizes:
+            digest = _digest(source)
+            with self.lock:
+                known = digest in self.digests
+            if known and self._link(digest, target):
+                if checksum is not None:
+                    checksum.value = digest
+                return 'dedup'
+        # The content is new, so it has to be written.
+        temp, digest = self._write(source, checksum, throttle)
+        with self.lock:
+            blob = self.blob(digest)
+            if digest in self.digests and os.path.isfile(blob):
+                # Another thread stored the same content in the meantime.
+                os.remove(temp)
+                strategy = 'dedup'
+            else:
+                if not os.path.isdir(os.path.dirname(blob)):
+                    os.makedirs(os.path.dirname(blob))
+                os.rename(temp, blob)
+                if digest not in self.digests:
+                    self.index.write("{} {}\n".format(digest, size))
+                    self.index.flush()
+                self.digests[digest] = size
+                self.sizes.add(size)
+                strategy = 'stored'
+        if not self._link(digest, target):
+            return transfer.copy(source, target, checksum=checksum, throttle=throttle)
+        return strategy
+
+    def _write(self, source, checksum=None, throttle=None):
+        """
+        Copies a file into a temporary file in the store, hashing it on the way
+        (and checking it afterwards, if there's a checksum), and keeping to
+        the throttle (if there is one) after each chunk.
+
+        :return: the path of the temporary file and the file's digest
+        """
+        import shutil
+        import tempfile
+        hash = digests.Hasher()
+        handle, temp = tempfile.mkstemp(prefix='.tmp-', dir=self.path)
+        try:
+            with os.fdopen(handle, 'wb') as fdst:
+                with open(source, 'rb') as fsrc:
+                    while True:
+                        chunk = fsrc.read(_CHUNK)
+                        if not chunk:
+                            break
+                        hash.update(chunk)
+                        fdst.write(chunk)
+                        if throttle is not None:
+                            throttle.transferred(len(chunk))
+                    if checksum is not None:
+                        fdst.flush()
+                        os.fsync(fdst.fileno())
+            digest = hash.hexdigest()
+            if checksum is not None:
+                checksum.value = digest
+                checksum.check(temp)
+            shutil.copystat(source, temp)
+        except:
+            os.remove(temp)
+            raise
+        finally:
+            hash.close()
+        return temp, digest
+
+    def _link(self, digest, target):
+        """
+        Hard links a blob to the target.
+
+        :return: whether it worked (False if the filesystem doesn't support it,
+            or the blob has gone missing)
+        """
+        try:
+            os.link(self.blob(digest), target)
+            return True
+        except OSError as e:
+            if e.errno in _NO_LINK:
+                return False
+            raise
+
+    def close(self):
+        self.index.close()
+
+def _digest(path):
+    """
+    :return: the SHA-256 hex digest of a file's content
+    """
+    import hashlib
+    hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while True:
+            chunk = file.read(_CHUNK)
+            if not chunk:
+                break
+            hash.update(chunk)
+    return hash.hexdigest()
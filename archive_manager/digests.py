@@ -0,0 +1,217 @@
+import errno
+import os
+import threading
+
+# What's added to a bucket's name to make the name of its digest file.
+SUFFIX = '.sha256'
+
+# How much of a file to read at a time.
+_CHUNK = 1024 * 1024
+
+# Data smaller than this is hashed straight away, rather than being handed to
+# another thread (which costs more than hashing it does).
+_THREADED = 256 * 1024
+
+class Hasher(object):
+    """
+    A SHA-256 hash (with the same update() and hexdigest() as hashlib's) which
+    does its hashing on a thread of its own, so that it goes on at the same
+    time as the reading and writing of the data. (hashlib lets go of the GIL
+    while it hashes, so the two really do run at once.) Small pieces of data
+    are just hashed on the spot.
+
+    If the digest turns out not to be wanted (e.g. the copy being hashed
+    failed), close() it so that its thread isn't left waiting for more.
+    """
+    def __init__(self):
+        import hashlib
+        self.hash   = hashlib.sha256()
+        self.queue  = None
+        self.thread = None
+
+    def update(self, data):
+        if self.thread is None:
+            if len(data) < _THREADED:
+                self.hash.update(data)
+                return
+            self._start()
+        self.queue.put(data)
+
+    def _start(self):
+        try:
+            import Queue as queue
+        except ImportError:
+            import queue
+        # Only a few chunks are ever waiting, so memory use stays flat.
+        self.queue  = queue.Queue(4)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            self.hash.update(data)
+
+    def close(self):
+        """
+        Finishes hashing whatever has been given so far, and stops the thread
+        (if there is one). It's safe to call more than once.
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def hexdigest(self):
+        self.close()
+        return self.hash.hexdigest()
+
+class Checksum(object):
+    """
+    Asks for a file to be checked as it's put in the destination (see
+    transfer.place()): its data is hashed as it's read from the origin, and
+    the file that was written is read back and compared with it. Afterwards,
+    `value` holds the file's SHA-256 hex digest (or None, if it was left
+    alone).
+    """
+    def __init__(self):
+        self.value = None
+
+    def check(self, path):
+        """
+        Reads back a file which has just been written (and synced to disk),
+        and makes sure that it matches `value`.
+
+        :raises IOError: if it doesn't
+        """
+        written = file_digest(path, uncache=True)
+        if written != self.value:
+            raise IOError(errno.EIO, "Written file doesn't match its original (SHA-256 {} instead of {})".format(
+                written, self.value
+            ), path)
+
+def feed(file, hasher, size=None):
+    """
+    Reads an open file into a hasher.
+
+    :param size: how much to read (by default, everything that's left)
+    :return: the hasher (which is closed if the file can't be read)
+    """
+    try:
+        while size is None or size > 0:
+            chunk = file.read(_CHUNK if size is None else min(_CHUNK, size))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            if size is not None:
+                size -= len(chunk)
+    except:
+        hasher.close()
+        raise
+    return hasher
+
+def file_digest(path, uncache=False):
+    """
+    :param uncache: whether to drop the file from the page cache first (where
+        the OS allows it), so that what's on the disk is what gets read; the
+        file must already have been synced for this to work
+    :return: the SHA-256 hex digest of a file's content
+    """
+    with open(path, 'rb') as file:
+        if uncache:
+            drop_cache(file.fileno())
+        return feed(file, Hasher()).hexdigest()
+
+def drop_cache(fd):
+    """
+    Asks the OS to forget the (synced) data of an open file, so that it's read
+    from the disk next time. Where that can't be done, nothing happens.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+def sidecar(bucket):
+    """
+    :return: the path of a bucket's digest file (relative to the destination):
+        next to the bucket's directory or bundle when nested, e.g.
+        '2014/08/08.sha256', and next to its files when flat, e.g.
+        '2014.08.08.sha256'
+    """
+    return bucket + SUFFIX
+
+def load(path):
+    """
+    Reads a digest file.
+
+    :return: a list of (name, digest) in the order they're listed
+    """
+    records = []
+    try:
+        with open(path) as file:
+            for line in file:
+                digest, _, name = line.rstrip('\n').partition(' ')
+                if name[:1] in (' ', '*'):
+                    name = name[1:]
+                if digest and name:
+                    records.append((name, digest))
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return records
+
+class Sidecars(object):
+    """
+    The digest files of the buckets in the destination (see sidecar()), in
+    the format that sha256sum writes: one "digest  name" line per file, with
+    each name relative to the digest file's directory, so a bucket can be
+    checked later with `sha256sum -c` from there. (Files in bundles are listed
+    as "bundle:name", which sha256sum can't check.)
+
+    Digests are gathered in memory and written out when this is closed. Each
+    digest file is updated (a file archived again gets its new digest) and
+    replaced in one step, so nothing ever reads half of one.
+
+    Digests may be added from many threads at once.
+    """
+    def __init__(self, destination='.'):
+        self.root    = destination
+        self.records = {}
+        self.lock    = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def add(self, bucket, target, digest):
+        """
+        :param bucket: the bucket the file is in
+        :param target: the file's path relative to the destination
+        :param digest: its SHA-256 hex digest
+        """
+        name = os.path.relpath(target, os.path.dirname(bucket) or os.curdir)
+        with self.lock:
+            self.records.setdefault(bucket, {})[name] = digest
+
+    def close(self):
+        import tempfile
+        with self.lock:
+            records, self.records = self.records, {}
+        for bucket in sorted(records):
+            path    = os.path.join(self.root, sidecar(bucket))
+            known   = load(path)
+            updated = records[bucket]
+            lines   = ["{}  {}\n".format(updated.pop(name, digest), name) for name, digest in known]
+            lines  += ["{}  {}\n".format(updated[name], name) for name in sorted(updated)]
+            handle, temp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(os.path.abspath(path)))
+            with os.fdopen(handle, 'w') as file:
+                file.writelines(lines)
+            os.chmod(temp, 0o644)
+            os.rename(temp, path)
@@ -0,0 +1,224 @@
+import errno
+import os
+import threading
+
+import scanner
+import transfer
+
+class DirCache(object):
+    """
+    Keeps track of what exists beneath the destination, so that each directory
+    is only ever read or created once.
+
+    The cache is seeded by a single scan of the existing destination tree, down
+    to the depth that the date buckets go. After that, asking for a directory
+    never stats anything: directories that are known are answered from memory,
+    and directories that aren't are created with a plain mkdir (an 'already
+    exists' error just means it was there after all), parents first.
+
+    Asking whether a file exists reads the names in its directory (once), so
+    the same question about any other file in that directory is answered from
+    memory too.
+
+    The number of calls this avoids is tallied in `hits`, next to the number of
+    directories actually created (`created`) and read (`scanned`).
+
+    With more than one job, the tree is read a level at a time with that many
+    directories being read at once (which is what matters when each read is a
+    round trip to a file server), and the bottom level is read as well so that
+    planning never has to wait on one. Directories may then also be ensured
+    from many threads at once.
+    """
+    def __init__(self, root='.', depth=0, jobs=1):
+        """
+        :param root: the top of the tree (the destination)
+        :param depth: how many levels of the existing tree to read up front
+        :type depth: int
+        :param jobs: how many directories to read at once
+        :type jobs: int
+        """
+        self.root    = root
+        self.depth   = depth
+        self.known   = set()
+        self.files   = {}
+        self.created = 0
+        self.scanned = 0
+        self.hits    = 0
+        self.lock    = threading.Lock()
+        self.pending = {}
+        # Directories that have been forgotten, which can't be assumed not to
+        # exist just because the seeding didn't see them.
+        self.unsure  = set()
+        if jobs > 1:
+            self._seed_concurrently(depth, jobs)
+        else:
+            self._seed('', depth)
+
+    def _seed(self, directory, depth):
+        if depth <= 0:
+            return
+        try:
+            files, dirs = self._read(directory)
+        except OSError:
+            return
+        for name in dirs:
+            # Hidden directories (like the dedup store) are never buckets.
+            if not name.startswith('.'):
+                path = os.path.join(directory, name)
+                self.known.add(path)
+                self._seed(path, depth - 1)
+
+    def _seed_concurrently(self, depth, jobs):
+        level = ['']
+        for remaining in range(depth, -1, -1):
+            below = []
+            for directory, listing in zip(level, transfer.imap(self._try_read, level, jobs)):
+                if listing is None:
+                    continue
+                files, dirs = listing
+                self.files[directory] = files
+                self.scanned += 1
+                if remaining:
+                    for name in dirs:
+                        if not name.startswith('.'):
+                            path = os.path.join(directory, name)
+                            self.known.add(path)
+                            below.append(path)
+            level = below
+
+    def _try_read(self, directory):
+        try:
+            return scanner.listing(os.path.join(self.root, directory))
+        except OSError:
+            return None
+
+    def _read(self, directory):
+        files, dirs = scanner.listing(os.path.join(self.root, directory))
+        self.files[directory] = files
+        self.scanned += 1
+        return files, dirs
+
+    def _names(self, directory):
+        """
+        :return: the set of the names of the files in a directory
+        """
+        files = self.files.get(directory)
+        if files is not None:
+            with self.lock:
+                self.hits += 1
+            return files
+        if (directory and directory not in self.known and directory not in self.unsure
+                and directory.count(os.sep) < self.depth):
+            # Everything this shallow was seen when the cache was seeded, so
+            # this directory doesn't exist (yet).
+            files = self.files[directory] = set()
+            return files
+        try:
+            return self._read(directory)[0]
+        except OSError:
+            files = self.files[directory] = set()
+            return files
+
+    def contains(self, path):
+        """
+        :param path: the path of a file, relative to the root
+        :return: whether there's a file there
+        """
+        directory, _, name = path.rpartition(os.sep)
+        return name in self._names(directory)
+
+    def add(self, path):
+        """
+        Notes that there is (or will be) a file at the given path.
+
+        :param path: the path of a file, relative to the root
+        """
+        directory, _, name = path.rpartition(os.sep)
+        self._names(directory).add(name)
+
+    def claim(self, path):
+        """
+        Checks whether there's a file at the given path, and notes that there
+        will be one from now on.
+
+        :param path: the path of a file, relative to the root
+        :return: whether there was a file there already
+        """
+        directory, _, name = path.rpartition(os.sep)
+        names = self._names(directory)
+        if name in names:
+            return True
+        names.add(name)
+        return False
+
+    def forget(self, directories):
+        """
+        Lets go of everything known about some directories (the names of their
+        files, and that they exist), once nothing more will be asked about
+        them. If something is, they're read or created again, in case anything
+        else has changed them in the meantime.
+
+        :param directories: an iterable of directories, relative to the root
+        """
+        for directory in directories:
+            self.files.pop(directory, None)
+            self.known.discard(directory)
+            self.unsure.add(directory)
+
+    def ensure(self, path):
+        """
+        Makes sure a directory exists, creating it (and any missing parents) if
+        needed.
+
+        If another thread is already creating the same directory, this waits
+        for it to finish instead.
+
+        :param path: the directory, relative to the root
+        :return: a list of the directories that were created, parents first
+        """
+        if not path:
+            return []
+        if path in self.known:
+            with self.lock:
+                self.hits += 1
+            return []
+        with self.lock:
+            waiting = self.pending.get(path)
+            if waiting is None:
+                done = self.pending[path] = threading.Event()
+        if waiting is not None:
+            waiting.wait()
+            if path in self.known:
+                return []
+            # It didn't work out for the other thread, so try again here.
+            return self.ensure(path)
+        try:
+            created = self.ensure(os.path.dirname(path))
+            try:
+                os.mkdir(os.path.join(self.root, path))
+                with self.lock:
+                    self.created += 1
+                created.append(path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            self.known.add(path)
+        finally:
+            with self.lock:
+                del self.pending[path]
+            done.set()
+        return created
+
+    def ensure_all(self, paths):
+        """
+        Makes sure all of the given directories exist. Each distinct directory
+        is only handled once, and they're handled in sorted order so that every
+        parent comes before its children.
+
+        :param paths: an iterable of directories, relative to the root
+        :return: a list of the directories that were created, parents first
+        """
+        created = []
+        for path in sorted(set(paths)):
+            created.extend(self.ensure(path))
+        return created
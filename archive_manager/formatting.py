@@ -1,3 +1,14 @@
+import calendar
+import os
+import time
+
+from datetime import datetime
+
+try:
+    from functools import lru_cache
+except ImportError:
+    lru_cache = None
+
 grains = {
     'year':   '1',
     'month':  '2',
@@ -44,3 +55,107 @@ def date_grain(grain):
         yield '%M'
     if grain >= 6:
         yield '%S'
+
+class Bucketer(object):
+    """
+    Works out which date bucket a modification time belongs in: the nested
+    directory (e.g. '2014/08/12') or, if a delimiter is given, the flat file
+    name prefix (e.g. '2014.08.12').
+
+    Formatting a date is slow compared to everything else done per file, and
+    most files share their bucket with many others. So each timestamp is first
+    truncated to an integer key, and the bucket for each key is only formatted
+    once and then kept in a least-recently-used cache.
+
+    (On Python 2, which has no functools.lru_cache, the cache is simply emptied
+    whenever it fills up.)
+
+    The keys are whole seconds for the 'second' grain, whole minutes for
+    'minute', and 15-minute blocks for everything coarser. A block only has a
+    bucket of its own if the local time zone's offset is the same all the way
+    through it and is a whole number of blocks (so the block lines up with
+    local hours, and can't cross into another one). That's nearly always so,
+    but not everywhere and always: Newfoundland used to change its clocks at
+    00:01, and local mean times are offset by odd seconds. The times in any
+    other block are each formatted on their own.
+    """
+    def __init__(self, grain, delimiter=None, size=4096):
+        """
+        :param grain: the granularity of the buckets
+        :param delimiter: if given, buckets are flat prefixes joined with this;
+            otherwise they are nested directory paths
+        :param size: how many buckets to keep in the cache
+        :type size: int
+        """
+        self.grain     = int(granularity(grain))
+        self.format    = date(self.grain)
+        self.delimiter = delimiter
+        self.size      = size
+        if lru_cache is not None:
+            self.lookup = lru_cache(size)(self._format)
+        else:
+            self.cache  = {}
+            self.lookup = self._lookup
+        if self.grain >= 6:
+            self.unit = 1
+        elif self.grain == 5:
+            self.unit = 60
+        else:
+            self.unit = 900
+
+    def bucket(self, mtime):
+        """
+        :param mtime: a modification time (seconds since the epoch)
+        :return: the bucket that the time belongs in
+        """
+        value = self.lookup(mtime // self.unit)
+        if value is None:
+            value = self._name(mtime)
+        return value
+
+    def buckets(self, mtimes):
+        """
+        Works out the buckets for a whole list of modification times at once.
+        Each distinct key is only looked up once, no matter how many times it
+        appears.
+
+        :param mtimes: a list of modification times
+        :return: a list of the buckets, in the same order
+        """
+        unit   = self.unit
+        keys   = [mtime // unit for mtime in mtimes]
+        lookup = self.lookup
+        values = dict((key, lookup(key)) for key in set(keys))
+        if None in values.values():
+            return [values[key] or self._name(mtime) for key, mtime in zip(keys, mtimes)]
+        return [values[key] for key in keys]
+
+    def _lookup(self, key):
+        if key not in self.cache:
+            if len(self.cache) >= self.size:
+                self.cache.clear()
+            self.cache[key] = self._format(key)
+        return self.cache[key]
+
+    def _format(self, key):
+        """
+        :return: the bucket of every time in a key's block, or None if they
+            don't all share one
+        """
+        start  = key * self.unit
+        offset = _offset(start)
+        if self.unit > 1 and (offset % self.unit or offset != _offset(start + self.unit - 1)):
+            return None
+        return self._name(start)
+
+    def _name(self, mtime):
+        parts = datetime.fromtimestamp(mtime).strftime(self.format).split('.')
+        if self.delimiter is None:
+            return os.path.join(*parts)
+        return self.delimiter.join(parts)
+
+def _offset(timestamp):
+    """
+    :return: the local time zone's offset from UTC at a time, in seconds
+    """
+    return calendar.timegm(time.localtime(timestamp)) - int(timestamp)
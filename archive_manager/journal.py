@@ -0,0 +1,221 @@
+import json
+import os
+import threading
+
+# The name of the journal file kept at the top of the destination.
+JOURNAL_NAME = '.archive_manager.journal'
+
+# What's added to a target's name (with a leading dot) while it's being
+# written. The name doesn't change between runs, so a later run can find it.
+PARTIAL_SUFFIX = '.archive_manager-partial'
+
+# How much has to be written between checkpoints. Files smaller than this are
+# simply started over if they're interrupted.
+CHECKPOINT = 256 * 1024 * 1024
+
+# How much of the data just before a checkpoint is compared with the origin
+# before a partial copy is resumed.
+_VERIFY = 1024 * 1024
+
+def partial(target):
+    """
+    :return: the path that a target is written to before it's put in place
+    """
+    directory, _, name = target.rpartition(os.sep)
+    return (directory + os.sep if directory else '') + '.' + name + PARTIAL_SUFFIX
+
+class Journal(object):
+    """
+    A write-ahead log of the copies in flight in a destination.
+
+    Every copy is written to a partial file next to its target (see partial())
+    and only renamed into place once it's complete, so the target is never
+    left truncated. Before a copy starts, a 'begin' line is written to the
+    journal. While a large copy goes on, the partial file is synced to disk
+    every CHECKPOINT bytes and a 'checkpoint' line records how far it got. A
+    'done' line is written when it's in place.
+
+    If a run is interrupted, the next one reads the journal back and resumes
+    each unfinished copy from its last checkpoint (so long as the origin file
+    hasn't changed, and the data just before the checkpoint still matches it)
+    instead of starting over. Unfinished copies whose origin file has changed
+    or disappeared have their partial files removed.
+
+    The journal lives in the destination, next to the manifest, and is removed
+    when nothing is left in flight. A single journal may be used by many
+    threads at once.
+
+    Targets may be given relative to the destination or as absolute paths
+    beneath it; either way they're recorded relative to it, so the journal
+    still works if the destination is reached by another path next time.
+    """
+    def __init__(self, destination):
+        self.root    = os.path.abspath(destination)
+        self.path    = os.path.join(self.root, JOURNAL_NAME)
+        self.pending = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                        target = record['target']
+                    except (ValueError, KeyError, TypeError):
+                        # A partly-written line from an interrupted run.
+                        continue
+                    if record.get('op') == 'begin':
+                        self.pending[target] = record
+                    elif record.get('op') == 'checkpoint' and target in self.pending:
+                        self.pending[target]['offset'] = record['offset']
+                    elif record.get('op') == 'done':
+                        self.pending.pop(target, None)
+            self._discard_stale()
+        self.lock    = threading.Lock()
+        self.journal = open(self.path, 'a')
+        # Start the file over with just what's still in flight.
+        self._rewrite()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def _discard_stale(self):
+        """
+        Forgets unfinished copies whose origin file has changed (or is gone),
+        along with their partial files.
+        """
+        for target, record in list(self.pending.items()):
+            try:
+                info    = os.stat(record['source'])
+                changed = (info.st_size, info.st_mtime) != (record['size'], record['mtime'])
+            except OSError:
+                changed = True
+            if changed:
+                self._remove(target)
+                del self.pending[target]
+
+    def _key(self, target):
+        """
+        :return: a target's path relative to the destination
+        """
+        return os.path.relpath(target, self.root) if os.path.isabs(target) else target
+
+    def _remove(self, target):
+        try:
+            os.remove(os.path.join(self.root, partial(target)))
+        except OSError:
+            pass
+
+    def _rewrite(self):
+        self.journal.seek(0)
+        self.journal.truncate()
+        for record in self.pending.values():
+            self.journal.write(json.dumps(record, sort_keys=True) + '\n')
+        self.journal.flush()
+
+    def _write(self, record, sync=False):
+        with self.lock:
+            self.journal.write(json.dumps(record, sort_keys=True) + '\n')
+            self.journal.flush()
+            if sync:
+                os.fsync(self.journal.fileno())
+
+    def resume(self, source, target):
+        """
+        Works out where an interrupted copy of a file can pick up from.
+
+        :param source: the file being copied
+        :param target: where it's going
+        :return: the offset to carry on from, or 0 to start over
+        """
+        target = self._key(target)
+        record = self.pending.get(target)
+        if not record or record['source'] != source or not record.get('offset'):
+            return 0
+        offset = record['offset']
+        try:
+            if os.path.getsize(os.path.join(self.root, partial(target))) < offset:
+                return 0
+            # Make sure the last stretch before the checkpoint made it to disk
+            # (and is the same data).
+            start = max(0, offset - _VERIFY)
+            with open(source, 'rb') as original:
+                original.seek(start)
+                expected = original.read(offset - start)
+            with open(os.path.join(self.root, partial(target)), 'rb') as copied:
+                copied.seek(start)
+                if copied.read(offset - start) != expected:
+                    return 0
+        except (IOError, OSError):
+            return 0
+        return offset
+
+    def begin(self, source, target, info, offset=0):
+        """
+        Notes that a copy is starting (or resuming).
+
+        :param source: the file being copied
+        :param target: where it's going
+        :param info: the stat result of the file being copied
+        :param offset: where the copy is starting from
+        """
+        target = self._key(target)
+        record = {
+            'op':     'begin',
+            'source': source,
+            'target': target,
+            'size':   info.st_size,
+            'mtime':  info.st_mtime,
+            'offset': offset,
+        }
+        with self.lock:
+            self.pending[target] = record
+        self._write(record)
+
+    def checkpoint(self, target, offset):
+        """
+        Notes that everything before `offset` has been written to the partial
+        file and synced to disk.
+        """
+        target = self._key(target)
+        with self.lock:
+            record = self.pending.get(target)
+            if record is not None:
+                record['offset'] = offset
+        self._write({'op': 'checkpoint', 'target': target, 'offset': offset}, sync=True)
+
+    def done(self, target):
+        """
+        Notes that a copy is finished (and in place), or was abandoned.
+        """
+        target = self._key(target)
+        with self.lock:
+            self.pending.pop(target, None)
+        self._write({'op': 'done', 'target': target})
+
+    def abandon(self, target):
+        """
+        Removes a copy's partial file and forgets about it.
+        """
+        target = self._key(target)
+        self._remove(target)
+        self.done(target)
+
+    def trim(self):
+        """
+        Starts the file over with just what's still in flight, so that it
+        doesn't keep growing while the journal is kept open.
+        """
+        with self.lock:
+            self._rewrite()
+
+    def close(self):
+        with self.lock:
+            self._rewrite()
+            self.journal.close()
+            if not self.pending:
+                os.remove(self.path)
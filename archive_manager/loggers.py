@@ -0,0 +1,82 @@
+import os
+import sys
+
+# The loggers come from Management Tools when it's installed. It's only
+# imported once a logger is actually wanted, and if it isn't there, loggers
+# from the standard library's logging module (which behave the same way, as far
+# as Archive Manager is concerned) are used instead.
+
+# The levels from the logging module (which isn't imported until it's needed).
+DEBUG = 10
+INFO  = 20
+
+def _management_tools():
+    try:
+        from management_tools import loggers
+    except ImportError:
+        return None
+    return loggers
+
+def stream_logger(level=1):
+    """
+    :return: a logger which writes to the console
+    """
+    loggers = _management_tools()
+    if loggers is not None:
+        return loggers.stream_logger(level)
+    import logging
+    return _logger('archive_manager', logging.StreamHandler(sys.stdout), "%(message)s")
+
+def file_logger(name, path=None):
+    """
+    :param name: the name of the log
+    :param path: where to put the log: a directory, or the log file itself (by
+        default, ~/Library/Logs if it's there, or the system's temporary
+        directory)
+    :return: a logger which writes to a log file
+    """
+    loggers = _management_tools()
+    if loggers is not None:
+        if path:
+            return loggers.file_logger(name, path=path)
+        return loggers.file_logger(name)
+    import logging
+    if not path:
+        path = os.path.expanduser(os.path.join('~', 'Library', 'Logs'))
+        if not os.path.isdir(path):
+            import tempfile
+            path = tempfile.gettempdir()
+    if os.path.isdir(path):
+        path = os.path.join(path, name + '.log')
+    return _logger(name, logging.FileHandler(path), "%(asctime)s %(levelname)s: %(message)s")
+
+def quiet_logger():
+    """
+    :return: a logger which only lets warnings and errors through, to wherever
+        the application using Archive Manager sends them (for when it's used as
+        a library)
+    """
+    import logging
+    logger = logging.getLogger('archive_manager.quiet')
+    if not logger.handlers:
+        logger.addHandler(logging.NullHandler())
+        logger.setLevel(logging.WARNING)
+    return logger
+
+def enabled(logger, level=INFO):
+    """
+    :return: whether a logger would do anything with a message at `level`, so
+        that messages that would only be thrown away aren't put together at all
+        (loggers that can't say are assumed to want everything)
+    """
+    check = getattr(logger, 'isEnabledFor', None)
+    return check is None or check(level)
+
+def _logger(name, handler, format):
+    import logging
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        handler.setFormatter(logging.Formatter(format))
+        logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    return logger
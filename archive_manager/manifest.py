@@ -0,0 +1,132 @@
+import os
+
+import bundle
+
+# The name of the manifest file kept at the top of the destination.
+MANIFEST_NAME = '.archive_manager.sqlite'
+
+# How many records to write before committing them to disk.
+_BATCH = 1000
+
+class Manifest(object):
+    """
+    A record of every file that has already been archived into a destination,
+    keyed by its path in the origin along with its size, modification time, and
+    inode. If a file in the origin still matches its record then it hasn't
+    changed since it was archived, and it can be skipped without looking at the
+    destination at all.
+
+    All of the records are read into memory when the manifest is opened, so
+    each lookup is a single dictionary access.
+
+    Use this in a 'with' statement so that everything gets saved:
+
+    with Manifest(destination) as manifest:
+        if not manifest.unchanged(entry):
+            ...
+            manifest.record(entry, target)
+    """
+    def __init__(self, destination):
+        import sqlite3
+        self.path = os.path.join(os.path.abspath(destination), MANIFEST_NAME)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "origin TEXT PRIMARY KEY, size INTEGER, mtime REAL, inode INTEGER, "
+            "target TEXT)"
+        )
+        self.records = {}
+        for origin, size, mtime, inode, target in self.connection.execute(
+            "SELECT origin, size, mtime, inode, target FROM files"
+        ):
+            self.records[origin] = (size, mtime, inode, target)
+        self.unsaved = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.records)
+
+    def unchanged(self, entry):
+        """
+        :param entry: a scanner Entry from the origin
+        :return: whether the entry has already been archived and hasn't changed
+            since
+        """
+        record = self.records.get(entry.path)
+        return record is not None and record[:3] == (entry.size, entry.mtime, entry.inode)
+
+    def record(self, entry, target):
+        """
+        Notes that an entry has been archived.
+
+        :param entry: a scanner Entry from the origin
+        :param target: where the entry was put, relative to the destination
+        """
+        self.records[entry.path] = (entry.size, entry.mtime, entry.inode, target)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+            (entry.path, entry.size, entry.mtime, entry.inode, target)
+        )
+        self.unsaved += 1
+        if self.unsaved >= _BATCH:
+            self.save()
+
+    def forget(self, origin):
+        """
+        Removes the record for a file so that it will be archived again.
+
+        :param origin: the path of the file in the origin
+        """
+        self.records.pop(origin, None)
+        self.connection.execute("DELETE FROM files WHERE origin = ?", (origin,))
+        self.unsaved += 1
+
+    def clear(self):
+        """
+        Removes every record from the manifest.
+        """
+        self.records.clear()
+        self.connection.execute("DELETE FROM files")
+        self.save()
+
+    def verify(self, destination):
+        """
+        Checks every record against the destination, and forgets the records of
+        any files that are no longer there (or no longer the right size). Files
+        archived into a bundle are only checked for their bundle being there.
+
+        :param destination: the destination directory the manifest belongs to
+        :return: a list of the origin paths whose records were removed
+        """
+        dropped = []
+        for origin, (size, mtime, inode, target) in sorted(self.records.items()):
+            bundled = bundle.split(target)
+            try:
+                if bundled:
+                    good = os.path.isfile(os.path.join(destination, bundled[0]))
+                else:
+                    good = os.stat(os.path.join(destination, target)).st_size == size
+            except OSError:
+                good = False
+            if not good:
+                dropped.append(origin)
+        for origin in dropped:
+            self.forget(origin)
+        self.save()
+        return dropped
+
+    def save(self):
+        """
+        Commits all of the new records to disk.
+        """
+        self.connection.commit()
+        self.unsaved = 0
+
+    def close(self):
+        self.save()
+        self.connection.close()
@@ -0,0 +1,250 @@
+import heapq
+import os
+import threading
+import time
+
+# The upper bounds (in seconds) of the per-file latency histogram's buckets.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300, 1800)
+
+# How many of the slowest files to remember.
+SLOWEST = 5
+
+class Metrics(object):
+    """
+    Collects numbers about an archival run: how long each phase took, how many
+    files and bytes were transferred, how long each file took (as a histogram,
+    plus the few slowest files), and how many errors there were.
+
+    Everything here may be added to from many threads at once.
+
+    The phases are:
+
+        scan      reading the origin (and planning each file)
+        mkdir     creating directories in the destination
+        remove    removing files that are being replaced (with a dedup store)
+        transfer  copying or moving files
+        utime     updating timestamps
+        throttle  waiting to keep to the rate limits (see throttle.Throttle),
+                  which is part of 'transfer'
+
+    Time spent in 'remove', 'transfer', 'utime', and 'throttle' is summed across all of the
+    workers, so with --jobs it can add up to more than the run's total time.
+    """
+    def __init__(self, clock=time.time):
+        """
+        :param clock: the function used to tell the time
+        """
+        self.clock   = clock
+        self.started = clock()
+        self.ended   = None
+        self.first   = None
+        self.phases  = {}
+        self.files   = 0
+        self.bytes   = 0
+        self.errors  = 0
+        self.strategies = {}
+        self.strategy_bytes = {}
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.slowest = []
+        self.lock    = threading.Lock()
+
+    def add(self, phase, seconds):
+        """
+        Adds time to a phase.
+        """
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def timed(self, items, phase):
+        """
+        Passes along the items from an iterable, adding the time spent waiting
+        for each of them to a phase.
+        """
+        items = iter(items)
+        clock = self.clock
+        while True:
+            start = clock()
+            try:
+                item = next(items)
+            except StopIteration:
+                self.add(phase, clock() - start)
+                return
+            self.add(phase, clock() - start)
+            yield item
+
+    def file(self, path, size, seconds, strategy=None, error=None):
+        """
+        Records a file that was transferred (or that failed to be).
+
+        :param path: the file's path in the origin
+        :param size: the file's size in bytes
+        :param seconds: how long it took
+        :param strategy: how it was transferred
+        :param error: the error, if it failed
+        """
+        index = 0
+        while index < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[index]:
+            index += 1
+        with self.lock:
+            self.latency[index] += 1
+            self.latency_sum += seconds
+            if error is not None:
+                self.errors += 1
+            else:
+                if self.first is None:
+                    self.first = self.clock() - self.started
+                self.files += 1
+                self.bytes += size
+                if strategy:
+                    self.strategies[strategy] = self.strategies.get(strategy, 0) + 1
+                    self.strategy_bytes[strategy] = self.strategy_bytes.get(strategy, 0) + size
+            if len(self.slowest) < SLOWEST:
+                heapq.heappush(self.slowest, (seconds, path))
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (seconds, path))
+
+    def finish(self):
+        """
+        Notes that the run is over.
+        """
+        self.ended = self.clock()
+
+    @property
+    def elapsed(self):
+        return (self.ended if self.ended is not None else self.clock()) - self.started
+
+    def quantile(self, q):
+        """
+        Estimates a quantile of the per-file latency from the histogram.
+
+        :param q: the quantile, between 0 and 1
+        :return: the upper bound of the bucket holding that quantile (or None if
+            no files were recorded, or it's beyond the last bucket)
+        """
+        count = sum(self.latency)
+        if not count:
+            return None
+        seen = 0
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            seen += self.latency[index]
+            if seen >= q * count:
+                return bound
+        return None
+
+    def summary(self):
+        """
+        :return: a list of lines summarizing the run
+        """
+        elapsed = self.elapsed or 1e-9
+        lines = [
+            "Transferred {} files ({:.1f} MB) in {:.2f} s: {:.1f} files/s, {:.2f} MB/s, {} errors.".format(
+                self.files, self.bytes / 1e6, elapsed,
+                self.files / elapsed, self.bytes / 1e6 / elapsed, self.errors
+            ),
+            "Phases: " + ", ".join(
+                "{} {:.2f} s".format(phase, seconds) for phase, seconds in sorted(self.phases.items())
+            ),
+        ]
+        if self.first is not None:
+            lines.append("First file in place after {:.2f} s.".format(self.first))
+        if self.strategies:
+            lines.append("Strategies: " + ", ".join(
+                "{} {} ({:.1f} MB)".format(strategy, count, self.strategy_bytes[strategy] / 1e6)
+                for strategy, count in sorted(self.strategies.items())
+            ))
+        if sum(self.latency):
+            lines.append("Per-file latency: p50 <= {}, p90 <= {}, p99 <= {}".format(
+                *[_bound(self.quantile(q)) for q in (0.5, 0.9, 0.99)]
+            ))
+            for seconds, path in sorted(self.slowest, reverse=True):
+                lines.append("  slow: {:.3f} s {}".format(seconds, path))
+        return lines
+
+    def record(self):
+        """
+        :return: a dictionary of all of the numbers, ready for JSON
+        """
+        return {
+            'elapsed_seconds': self.elapsed,
+            'first_file_seconds': self.first,
+            'files':   self.files,
+            'bytes':   self.bytes,
+            'errors':  self.errors,
+            'phases':  dict(self.phases),
+            'strategies': dict(self.strategies),
+            'strategy_bytes': dict(self.strategy_bytes),
+            'latency': {
+                'buckets': [[bound, count] for bound, count in zip(list(LATENCY_BUCKETS) + ['+Inf'], self.latency)],
+                'sum':     self.latency_sum,
+                'count':   sum(self.latency),
+            },
+            'slowest': [[seconds, path] for seconds, path in sorted(self.slowest, reverse=True)],
+            'finished': self.ended if self.ended is not None else self.clock(),
+        }
+
+    def prometheus(self, prefix='archive_manager'):
+        """
+        :return: the numbers in the Prometheus text exposition format (e.g. for
+            node_exporter's textfile collector)
+        """
+        lines = []
+        def metric(name, kind, help, samples):
+            lines.append("# HELP {}_{} {}".format(prefix, name, help))
+            lines.append("# TYPE {}_{} {}".format(prefix, name, kind))
+            for labels, value in samples:
+                lines.append("{}_{}{} {}".format(prefix, name, labels, repr(float(value))))
+
+        metric('files', 'gauge', "Files transferred by the last run.", [('', self.files)])
+        metric('bytes', 'gauge', "Bytes transferred by the last run.", [('', self.bytes)])
+        metric('errors', 'gauge', "Files which failed to transfer in the last run.", [('', self.errors)])
+        metric('elapsed_seconds', 'gauge', "How long the last run took.", [('', self.elapsed)])
+        if self.first is not None:
+            metric('first_file_seconds', 'gauge', "How long the last run took to put its first file in place.",
+                   [('', self.first)])
+        metric('phase_seconds', 'gauge', "Time spent in each phase of the last run.",
+               [('{{phase="{}"}}'.format(phase), seconds) for phase, seconds in sorted(self.phases.items())])
+        metric('strategy_files', 'gauge', "Files transferred with each strategy in the last run.",
+               [('{{strategy="{}"}}'.format(strategy), count) for strategy, count in sorted(self.strategies.items())])
+        metric('strategy_bytes', 'gauge', "Bytes transferred with each strategy in the last run.",
+               [('{{strategy="{}"}}'.format(strategy), size) for strategy, size in sorted(self.strategy_bytes.items())])
+        cumulative = 0
+        samples    = []
+        for bound, count in zip(list(LATENCY_BUCKETS) + ['+Inf'], self.latency):
+            cumulative += count
+            samples.append(('_bucket{{le="{}"}}'.format(bound), cumulative))
+        samples.append(('_sum', self.latency_sum))
+        samples.append(('_count', cumulative))
+        lines.append("# HELP {}_file_seconds Time taken to transfer each file in the last run.".format(prefix))
+        lines.append("# TYPE {}_file_seconds histogram".format(prefix))
+        for suffix, value in samples:
+            lines.append("{}_file_seconds{} {}".format(prefix, suffix, repr(float(value))))
+        metric('last_run_timestamp_seconds', 'gauge', "When the last run finished.",
+               [('', self.ended if self.ended is not None else self.clock())])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Writes the numbers to a file: in the Prometheus text format if its name
+        ends with '.prom', or as JSON otherwise. The file is replaced in one
+        step, so nothing ever reads half of it.
+
+        :param path: the file to write
+        """
+        import json
+        import tempfile
+        if path.endswith('.prom'):
+            content = self.prometheus()
+        else:
+            content = json.dumps(self.record(), sort_keys=True, indent=2) + '\n'
+        directory = os.path.dirname(os.path.abspath(path))
+        handle, temp = tempfile.mkstemp(prefix='.tmp-', dir=directory)
+        with os.fdopen(handle, 'w') as file:
+            file.write(content)
+        os.chmod(temp, 0o644)
+        os.rename(temp, path)
+
+def _bound(seconds):
+    if seconds is None:
+        return "longer"
+    return "{} s".format(seconds)
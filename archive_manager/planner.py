@@ -0,0 +1,161 @@
+import json
+import os
+
+from collections import namedtuple
+
+# The things that can be done with a file.
+ADD       = 'add'        # it isn't in the destination yet, so put it there
+REPLACE   = 'replace'    # it's in the destination already, but replace it
+SKIP      = 'skip'       # it's in the destination already, so leave it alone
+UNCHANGED = 'unchanged'  # the manifest says it was archived and hasn't changed
+
+ACTIONS = (ADD, REPLACE, SKIP, UNCHANGED)
+
+class Operation(namedtuple('Operation', 'action entry bucket target')):
+    """
+    A single planned step of an archival run.
+
+    :param action: one of ADD, REPLACE, SKIP, or UNCHANGED
+    :param entry: the scanner Entry of the file in the origin
+    :param bucket: the date bucket the file belongs to (its nested directory,
+        or its flat prefix)
+    :param target: where the file goes, relative to the destination
+    """
+    __slots__ = ()
+
+    @property
+    def moves(self):
+        """
+        Whether anything will actually be copied or moved for this operation.
+        """
+        return self.action == ADD or self.action == REPLACE
+
+    def record(self, persist=False):
+        """
+        :param persist: whether the file will be copied (True) or moved
+        :return: a dictionary describing the operation, ready for JSON
+        """
+        return {
+            'action': self.action,
+            'mode':   'copy' if persist else 'move',
+            'source': self.entry.path,
+            'target': self.target,
+            'bucket': self.bucket,
+            'size':   self.entry.size,
+            'mtime':  self.entry.mtime,
+        }
+
+class Totals(object):
+    """
+    Running totals of a plan: how many files (and bytes) each action applies
+    to, and how many buckets will receive files.
+    """
+    def __init__(self):
+        self.files   = dict((action, 0) for action in ACTIONS)
+        self.bytes   = dict((action, 0) for action in ACTIONS)
+        self.buckets = set()
+
+    def add(self, operation):
+        self.files[operation.action] += 1
+        self.bytes[operation.action] += operation.entry.size
+        if operation.moves:
+            self.buckets.add(operation.bucket)
+
+    @property
+    def moving(self):
+        """
+        The number of files that will be copied or moved.
+        """
+        return self.files[ADD] + self.files[REPLACE]
+
+    @property
+    def moving_bytes(self):
+        """
+        The number of bytes that will be copied or moved.
+        """
+        return self.bytes[ADD] + self.bytes[REPLACE]
+
+    def record(self):
+        """
+        :return: a dictionary of the totals, ready for JSON
+        """
+        return {
+            'files':   dict(self.files),
+            'bytes':   dict(self.bytes),
+            'moving':  self.moving,
+            'moving_bytes': self.moving_bytes,
+            'buckets': len(self.buckets),
+        }
+
+def plan(entries, origin, target_for, destination, replace=True, manifest=None, streaming=False):
+    """
+    Decides what to do with each file, without touching anything.
+
+    Whether a target already exists is answered from the destination's
+    DirCache, which reads each destination directory at most once, so planning
+    doesn't stat anything per file.
+
+    :param entries: an iterable of scanner Entry records from the origin
+    :param origin: the origin directory the entries came from
+    :param target_for: a function taking an entry and its path relative to the
+        origin, which returns the entry's bucket and its target path (relative
+        to the destination)
+    :param destination: a DirCache of the destination (or, when bundling, a
+        bundle.Members of it)
+    :param replace: whether files already in the destination are replaced
+    :type replace: bool
+    :param manifest: if given, files it lists as unchanged are left out
+    :param streaming: whether the entries come from scanner.walk() (which
+        gives each directory's files together) and are transferred as they're
+        planned. Then the names in each destination directory are let go of
+        once the origin directory headed for it is finished, and the planned
+        targets aren't noted, so memory use doesn't grow with the number of
+        files. (Two files can only be headed for the same target from
+        different origin directories when flat, e.g. 'a/b' and 'a.b'; the
+        second one isn't known to be there until it's put in place.)
+    :type streaming: bool
+    :return: a generator of Operations, in the same order as the entries
+    """
+    start   = len(os.path.join(os.path.abspath(origin), ''))
+    folder  = None
+    touched = set()
+    for entry in entries:
+        bucket, target = target_for(entry, entry.path[start:])
+        if streaming:
+            if os.path.dirname(entry.path) != folder:
+                destination.forget(touched)
+                touched.clear()
+                folder = os.path.dirname(entry.path)
+            # (The top of the destination is where every flat file goes, so
+            # it's kept.)
+            if os.sep in target:
+                touched.add(os.path.dirname(target))
+        if manifest is not None and manifest.unchanged(entry):
+            action = UNCHANGED
+        elif destination.contains(target) if streaming else destination.claim(target):
+            action = REPLACE if replace else SKIP
+        else:
+            # (Anything else headed for the same place will find this there.)
+            action = ADD
+        yield Operation(action, entry, bucket, target)
+
+def track(operations, totals, out=None, persist=False):
+    """
+    Passes operations along, adding each one to the totals. If an output file
+    is given, each operation is also written to it as a line of JSON, followed
+    by a final line holding the totals (once all of the operations have gone
+    by).
+
+    :param operations: an iterable of Operations
+    :param totals: the Totals to add to
+    :param out: an open file to write JSON Lines to
+    :param persist: whether the files will be copied (True) or moved
+    :return: a generator of the same Operations
+    """
+    for operation in operations:
+        totals.add(operation)
+        if out is not None:
+            out.write(json.dumps(operation.record(persist), sort_keys=True) + '\n')
+        yield operation
+    if out is not None:
+        out.write(json.dumps({'totals': totals.record()}, sort_keys=True) + '\n')
@@ -0,0 +1,105 @@
+import planner
+
+# What became of a file.
+DONE    = 'done'     # it was put in the destination
+FAILED  = 'failed'   # it couldn't be (see the error)
+SKIPPED = 'skipped'  # it was left alone (see the action for why)
+PLANNED = 'planned'  # it would have been put in the destination (a dry run)
+
+STATUSES = (DONE, FAILED, SKIPPED, PLANNED)
+
+class Result(object):
+    """
+    What happened to a single file in an archival run.
+
+    :param source: the file's path in the origin
+    :param target: where it goes, relative to the destination
+    :param bucket: the date bucket it belongs to
+    :param action: what was planned for it (one of planner.ACTIONS)
+    :param status: what became of it (one of STATUSES)
+    :param strategy: how it got to the destination (e.g. 'rename', 'sendfile',
+        'dedup', or a bundle format), if it did
+    :param bytes: the file's size
+    :param seconds: how long it took
+    :param error: the exception, if it failed
+    """
+    # There's one of these for every file, so they're kept small.
+    __slots__ = ('source', 'target', 'bucket', 'action', 'status', 'strategy', 'bytes', 'seconds', 'error')
+
+    def __init__(self, source, target, bucket, action, status, strategy=None, bytes=0, seconds=0.0, error=None):
+        self.source   = source
+        self.target   = target
+        self.bucket   = bucket
+        self.action   = action
+        self.status   = status
+        self.strategy = strategy
+        self.bytes    = bytes
+        self.seconds  = seconds
+        self.error    = error
+
+    @classmethod
+    def of(cls, operation, status, strategy=None, seconds=0.0, error=None):
+        """
+        :param operation: the planner.Operation the result is for
+        """
+        return cls(operation.entry.path, operation.target, operation.bucket, operation.action, status, strategy,
+                   operation.entry.size, seconds, error)
+
+    def record(self):
+        """
+        :return: a dictionary describing the result, ready for JSON
+        """
+        return {
+            'source':   self.source,
+            'target':   self.target,
+            'bucket':   self.bucket,
+            'action':   self.action,
+            'status':   self.status,
+            'strategy': self.strategy,
+            'bytes':    self.bytes,
+            'seconds':  self.seconds,
+            'error':    None if self.error is None else "{}: {}".format(type(self.error).__name__, self.error),
+        }
+
+    def __repr__(self):
+        return "Result({!r} -> {!r}, {})".format(self.source, self.target, self.status)
+
+class Summary(object):
+    """
+    Running totals of the results of an archival run: how many files (and
+    bytes) ended up with each status, and the results of the files that failed.
+
+    `totals` (the planner.Totals of the plan) and `metrics` (the
+    metrics.Metrics of the run) are filled in as soon as the run starts, and
+    are complete once it's over.
+    """
+    def __init__(self):
+        self.files   = dict((status, 0) for status in STATUSES)
+        self.bytes   = dict((status, 0) for status in STATUSES)
+        self.failed  = []
+        self.totals  = planner.Totals()
+        self.metrics = None
+
+    def add(self, result):
+        self.files[result.status] += 1
+        self.bytes[result.status] += result.bytes
+        if result.status == FAILED:
+            self.failed.append(result)
+
+    @property
+    def ok(self):
+        """
+        Whether every file that was meant to be archived was.
+        """
+        return not self.failed
+
+    def record(self):
+        """
+        :return: a dictionary describing the run, ready for JSON
+        """
+        return {
+            'files':   dict(self.files),
+            'bytes':   dict(self.bytes),
+            'failed':  [result.source for result in self.failed],
+            'seconds': self.metrics.elapsed if self.metrics is not None else None,
+        }
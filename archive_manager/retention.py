@@ -0,0 +1,266 @@
+import os
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import bundle
+import digests
+import formatting
+import scanner
+
+# How long each granularity's buckets last, after the first three (which are
+# uneven, so they're worked out from the calendar instead).
+_SPANS = {4: timedelta(hours=1), 5: timedelta(minutes=1), 6: timedelta(seconds=1)}
+
+class Bucket(namedtuple('Bucket', 'start end paths')):
+    """
+    A date bucket found in the destination.
+
+    :param start: the datetime the bucket starts at
+    :param end: the datetime the next bucket starts at
+    :param paths: the paths (relative to the destination) which hold the
+        bucket's files: its directory and/or bundle when nested, or each of its
+        files when flat
+    """
+    __slots__ = ()
+
+def span(parts):
+    """
+    Works out the time covered by a bucket from the numbers in its name.
+
+    :param parts: the bucket's date as a tuple of integers (year first), as
+        many as the granularity has
+    :return: the start and end datetimes of the bucket
+    """
+    start = datetime(*(tuple(parts) + (1, 1, 0, 0, 0)[len(parts) - 1:]))
+    if len(parts) == 1:
+        end = start.replace(year=start.year + 1)
+    elif len(parts) == 2:
+        end = start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    elif len(parts) == 3:
+        end = start + timedelta(days=1)
+    else:
+        end = start + _SPANS[len(parts)]
+    return start, end
+
+def _parse(names):
+    """
+    :return: the names as a tuple of integers, or None if any of them isn't a
+        number
+    """
+    try:
+        return tuple(int(name) for name in names)
+    except ValueError:
+        return None
+
+def _bucket_name(name):
+    """
+    :return: the bucket part of a bundle's or digest file's name, or None if
+        it's neither
+    """
+    if name.endswith(digests.SUFFIX):
+        return name[:-len(digests.SUFFIX)]
+    for format in bundle.FORMATS:
+        if name.endswith(bundle.extension(format)):
+            return name[:-len(bundle.extension(format))]
+    return None
+
+def buckets(destination, flat=False, grain=3, delimiter='.'):
+    """
+    Finds all of the date buckets in a destination from their names alone
+    (nothing is stat'ed, and nothing inside a bucket's directory is read).
+    Names that aren't dates are ignored.
+
+    :param destination: the destination directory
+    :param flat: whether the destination is organized flat (True) or nested
+    :type flat: bool
+    :param grain: the granularity the destination was archived with
+    :type grain: int
+    :param delimiter: the delimiter used in flat file names
+    :return: a list of Buckets, oldest first
+    """
+    grain = int(formatting.granularity(grain))
+    found = {}
+    def add(parts, path):
+        if parts not in found:
+            found[parts] = []
+        found[parts].append(path)
+
+    if flat:
+        files, dirs = scanner.listing(destination)
+        for name in list(files) + dirs:
+            # (A bucket's bundle and digest file go with it.)
+            parts = _parse(_strip(name).split(delimiter)[:grain])
+            if parts is not None and len(parts) == grain:
+                add(parts, name)
+    else:
+        pending = [('', ())]
+        while pending:
+            directory, parts = pending.pop()
+            try:
+                files, dirs = scanner.listing(os.path.join(destination, directory))
+            except OSError:
+                continue
+            for name in dirs:
+                number = _parse([name])
+                if number is None:
+                    continue
+                path = os.path.join(directory, name)
+                if len(parts) + 1 == grain:
+                    add(parts + number, path)
+                else:
+                    pending.append((path, parts + number))
+            if len(parts) + 1 == grain:
+                # Buckets which were written as bundles, and their digest
+                # files.
+                for name in files:
+                    number = _parse([_bucket_name(name) or ''])
+                    if number is not None:
+                        add(parts + number, os.path.join(directory, name))
+
+    result = []
+    for parts, paths in found.items():
+        try:
+            start, end = span(parts)
+        except ValueError:
+            # Not a real date (e.g. a month of 13).
+            continue
+        result.append(Bucket(start, end, sorted(paths)))
+    return sorted(result)
+
+def _strip(name):
+    """
+    :return: a flat file's name without the digest file suffix or bundle
+        extension, if it has one (so that the delimiter can be anything)
+    """
+    return _bucket_name(name) or name
+
+def keep(buckets, now, days=None, weeks=None, months=None):
+    """
+    Decides which buckets to keep. A bucket is kept if any of the rules keeps
+    it:
+
+        days    every bucket from the last `days` days
+        weeks   the newest bucket of each of the last `weeks` weeks
+        months  the newest bucket of each of the last `months` months
+
+    (A bucket is in a week or month if any of it is, so buckets coarser than
+    the rule, like a month when keeping weeks, are kept while they overlap.)
+
+    Buckets from the future are always kept.
+
+    :param buckets: a list of Buckets, oldest first
+    :param now: the datetime to count back from
+    :return: a set of the start times of the buckets to keep
+    """
+    kept = set(bucket.start for bucket in buckets if bucket.start > now)
+    if days:
+        cutoff = now - timedelta(days=days)
+        kept.update(bucket.start for bucket in buckets if bucket.end > cutoff)
+    if weeks:
+        this = now.date() - timedelta(days=now.weekday())
+        cutoff = datetime.combine(this - timedelta(weeks=weeks - 1), datetime.min.time())
+        kept.update(_newest(buckets, cutoff, lambda start: start.isocalendar()[:2]))
+    if months:
+        year, month = divmod(now.year * 12 + now.month - 1 - (months - 1), 12)
+        cutoff = datetime(year, month + 1, 1)
+        kept.update(_newest(buckets, cutoff, lambda start: (start.year, start.month)))
+    return kept
+
+def _newest(buckets, cutoff, period):
+    """
+    :return: the start of the newest bucket in each period from the cutoff on
+        (a bucket that began before the cutoff but hasn't ended by then, like
+        the current month when keeping weeks, counts as part of the first
+        period)
+    """
+    newest = {}
+    for bucket in buckets:
+        if bucket.end > cutoff:
+            # They're in order, so the last one seen in a period is its newest.
+            newest[period(max(bucket.start, cutoff))] = bucket.start
+    return newest.values()
+
+def prune(destination, flat=False, grain=3, delimiter='.', days=None, weeks=None, months=None, dry_run=False,
+          now=None):
+    """
+    Removes every bucket that the retention rules (see keep()) don't keep.
+
+    When nested, a directory whose buckets are all being removed (e.g. a whole
+    year) is removed in one go instead of one bucket at a time. When flat, the
+    files are removed by name from the single listing of the destination.
+
+    :param destination: the destination directory
+    :param flat: whether the destination is organized flat (True) or nested
+    :param grain: the granularity the destination was archived with
+    :param delimiter: the delimiter used in flat file names
+    :param days: keep everything from this many days back
+    :param weeks: keep one bucket for each of this many weeks back
+    :param months: keep one bucket for each of this many months back
+    :param dry_run: whether to only work out what would be removed
+    :param now: the datetime to count back from (the current time by default)
+    :return: the number of buckets kept, the number removed, and a list of the
+        paths (relative to the destination) that were removed
+    """
+    if not (days or weeks or months):
+        raise ValueError("At least one retention rule is needed; otherwise everything would be removed.")
+    if now is None:
+        now = datetime.now()
+    found  = buckets(destination, flat, grain, delimiter)
+    kept   = keep(found, now, days, weeks, months)
+    doomed = set()
+    for bucket in found:
+        if bucket.start not in kept:
+            doomed.update(bucket.paths)
+    removed = sorted(doomed) if flat else _collapse(destination, doomed, kept, found)
+    if not dry_run:
+        import shutil
+        for path in removed:
+            full = os.path.join(destination, path)
+            if os.path.isdir(full) and not os.path.islink(full):
+                shutil.rmtree(full)
+            else:
+                os.remove(full)
+    keeping = sum(1 for bucket in found if bucket.start in kept)
+    return keeping, len(found) - keeping, removed
+
+def _collapse(destination, doomed, kept, found):
+    """
+    Replaces doomed paths with their parent directory wherever everything in
+    the parent is doomed.
+
+    :return: a sorted list of the paths to remove
+    """
+    # Every directory that holds something that's being kept must stay.
+    keeping = set()
+    for bucket in found:
+        if bucket.start in kept:
+            for path in bucket.paths:
+                keeping.update(_parents(path))
+    # Whether each directory holds only buckets (so that removing it can't
+    # take anything else with it). Each one is only read once.
+    pure = {}
+    def only_buckets(directory):
+        if directory not in pure:
+            files, dirs = scanner.listing(os.path.join(destination, directory))
+            pure[directory] = all(_parse([_bucket_name(name) or name]) is not None for name in list(files) + dirs)
+        return pure[directory]
+
+    removed = set()
+    for path in doomed:
+        # Go up as far as nothing is being kept (and stop at anything that
+        # isn't only buckets, like the top of the destination).
+        top    = path
+        parent = os.path.dirname(path)
+        while parent and parent not in keeping and only_buckets(parent):
+            top    = parent
+            parent = os.path.dirname(parent)
+        removed.add(top)
+    # Leave out anything inside something else that's being removed.
+    return [path for path in sorted(removed) if not any(parent in removed for parent in _parents(path))]
+
+def _parents(path):
+    parent = os.path.dirname(path)
+    while parent:
+        yield parent
+        parent = os.path.dirname(parent)
@@ -0,0 +1,167 @@
+import os
+import stat
+
+from collections import namedtuple
+
+# Prefer the fastest directory reader available: the built-in os.scandir
+# (Python 3.5+), then the 'scandir' backport, and finally plain os.listdir.
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+# The different kinds of entries that can be found in a directory.
+FILE  = 'file'
+DIR   = 'dir'
+LINK  = 'link'
+OTHER = 'other'
+
+class Entry(namedtuple('Entry', 'name path size mtime inode kind')):
+    """
+    A compact record of everything the archivers need to know about a single
+    item in the origin directory. All of it is gathered from one directory read
+    (plus at most one stat for each item), so nothing needs to be stat'ed again
+    later on.
+
+    :param name: the base name of the item
+    :param path: the absolute path to the item
+    :param size: the size of the item in bytes
+    :param mtime: the modification time of the item
+    :param inode: the inode number of the item
+    :param kind: one of FILE, DIR, LINK, or OTHER
+    """
+    __slots__ = ()
+
+    @property
+    def is_file(self):
+        return self.kind == FILE
+
+    @property
+    def is_dir(self):
+        return self.kind == DIR
+
+def scan(origin):
+    """
+    Reads the contents of a directory once and yields an Entry for each item in
+    it. Symbolic links are followed (as os.path.getmtime does), unless they are
+    broken, in which case the link itself is described.
+
+    :param origin: the directory to read
+    :return: a generator of Entry records, in no particular order
+    """
+    origin = os.path.abspath(origin)
+    if _scandir is not None:
+        for item in _scandir(origin):
+            try:
+                info = item.stat()
+            except OSError:
+                info = item.stat(follow_symlinks=False)
+            yield _entry(item.name, item.path, info)
+    else:
+        for name in os.listdir(origin):
+            path = os.path.join(origin, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                info = os.lstat(path)
+            yield _entry(name, path, info)
+
+def walk(origin, exclude=()):
+    """
+    Yields an Entry for every item beneath a directory which isn't itself a
+    directory, descending into subdirectories as they are found. Nothing is
+    collected up front; only the directories still waiting to be read are kept
+    in memory, so this works the same on a handful of files or millions of
+    them. Symbolic links to directories are skipped entirely.
+
+    :param origin: the directory to walk
+    :param exclude: absolute paths of directories that should not be walked
+        (e.g. a destination which lives inside the origin)
+    :return: a generator of Entry records
+    """
+    exclude = set(os.path.abspath(path) for path in exclude)
+    pending = [os.path.abspath(origin)]
+    while pending:
+        directory = pending.pop()
+        try:
+            for entry in scan(directory):
+                if entry.kind != DIR:
+                    yield entry
+                elif entry.path not in exclude and not os.path.islink(entry.path):
+                    pending.append(entry.path)
+        except OSError:
+            # The directory went away or can't be read; there's nothing to
+            # archive from it.
+            continue
+
+def listing(directory):
+    """
+    Reads just the names in a directory, split into files and subdirectories.
+    Where the directory itself reports what type each item is, nothing gets
+    stat'ed. Symbolic links are followed.
+
+    :param directory: the directory to read
+    :return: a set of the names of the files, and a list of the names of the
+        subdirectories
+    """
+    files = set()
+    dirs  = []
+    if _scandir is not None:
+        for item in _scandir(directory):
+            try:
+                if item.is_dir():
+                    dirs.append(item.name)
+                elif item.is_file():
+                    files.add(item.name)
+            except OSError:
+                continue
+    else:
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.isdir(path):
+                dirs.append(name)
+            elif os.path.isfile(path):
+                files.add(name)
+    return files, dirs
+
+def payload(origin):
+    """
+    Builds the sorted list of entries to be archived from the origin directory.
+
+    :param origin: the directory to read
+    :return: a list of Entry records sorted by their paths
+    """
+    return sorted(scan(origin), key=lambda entry: entry.path)
+
+def entries(paths):
+    """
+    Builds entries for particular files (e.g. ones that a watcher said are
+    ready), with one stat each. Files that have gone away are left out.
+
+    :param paths: the absolute paths of the files
+    :return: a generator of Entry records, in the same order as the paths
+    """
+    for path in paths:
+        try:
+            info = os.stat(path)
+        except OSError:
+            continue
+        yield _entry(os.path.basename(path), path, info)
+
+def _entry(name, path, info):
+    """
+    Builds an Entry from a name, a path, and a stat result.
+    """
+    mode = info.st_mode
+    if stat.S_ISREG(mode):
+        kind = FILE
+    elif stat.S_ISDIR(mode):
+        kind = DIR
+    elif stat.S_ISLNK(mode):
+        kind = LINK
+    else:
+        kind = OTHER
+    return Entry(name, path, info.st_size, info.st_mtime, info.st_ino, kind)
@@ -0,0 +1,66 @@
+# The orders files can be transferred in, in the order they're listed in help.
+# 'name' is the order they're planned in (sorted by name, or as found when
+# recursive).
+ORDERS = ('name', 'smallest', 'largest', 'oldest')
+
+# How each order sorts the files: by the Entry, with the path breaking ties so
+# that the order is always the same.
+_KEYS = {
+    'smallest': lambda entry: (entry.size, entry.path),
+    'largest':  lambda entry: (-entry.size, entry.path),
+    'oldest':   lambda entry: (entry.mtime, entry.path),
+}
+
+def check(order):
+    """
+    :raises ValueError: if the order is unknown
+    """
+    if order not in ORDERS:
+        raise ValueError("Unknown order: " + order)
+
+def order(operations, order='name'):
+    """
+    Puts operations in the order their files should be transferred in:
+
+        name      as planned
+        smallest  smallest first, so that as many files as possible are in
+                  place as soon as possible
+        largest   largest first; with --jobs, the workers all take their next
+                  file from the same queue, so this spreads the bytes evenly
+                  between them (one huge file is started first, instead of
+                  being left until last while the other workers go idle)
+        oldest    least recently modified first
+
+    :param operations: an iterable of planner.Operations
+    :param order: one of ORDERS
+    :return: a list of the operations
+    """
+    check(order)
+    if order == 'name':
+        return list(operations)
+    key = _KEYS[order]
+    return sorted(operations, key=lambda operation: key(operation.entry))
+
+def buckets(buckets, members, order='name'):
+    """
+    Puts buckets (e.g. bundles) in the order they should be written in, by the
+    same measures as order(): the total size of each bucket's files for
+    'smallest' and 'largest', and its oldest file for 'oldest'.
+
+    :param buckets: a list of the buckets, as planned
+    :param members: a dictionary of the list of operations in each bucket
+    :param order: one of ORDERS
+    :return: a list of the buckets
+    """
+    check(order)
+    if order == 'name':
+        return list(buckets)
+    def total(bucket):
+        return sum(operation.entry.size for operation in members[bucket])
+    if order == 'smallest':
+        key = lambda bucket: (total(bucket), bucket)
+    elif order == 'largest':
+        key = lambda bucket: (-total(bucket), bucket)
+    else:
+        key = lambda bucket: (min(operation.entry.mtime for operation in members[bucket]), bucket)
+    return sorted(buckets, key=key)
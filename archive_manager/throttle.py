@@ -0,0 +1,368 @@
+import os
+import re
+import threading
+import time
+
+from datetime import datetime
+
+# How often (in seconds) the schedule is looked at again while transferring.
+RECHECK = 30
+
+# The days of the week, in the order datetime.weekday() counts them.
+DAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+# What can follow a number in a rate, e.g. '10M' or '512 KB/s'.
+_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+_RATE  = re.compile(r'^\s*([0-9]*\.?[0-9]+)\s*([kmg]?)b?(/s)?\s*$', re.IGNORECASE)
+
+def rate(text):
+    """
+    Reads a rate, e.g. '10M' (10 MB/s), '512k', '1.5G', or '200' (bytes or
+    files per second). 'unlimited', 'none', 'off', and '0' mean no limit.
+
+    :return: the rate per second, or None if there's no limit
+    :raises ValueError: if it can't be read
+    """
+    if text is None or text.strip().lower() in ('', 'unlimited', 'none', 'off'):
+        return None
+    match = _RATE.match(text)
+    if not match:
+        raise ValueError("Not a rate: " + text)
+    value = float(match.group(1)) * _UNITS[match.group(2).lower()]
+    return value or None
+
+def describe(value, unit):
+    """
+    :return: a rate for reading, e.g. '10.0 MB/s' or 'unlimited'
+    """
+    if not value:
+        return "unlimited"
+    if unit == 'B':
+        for name, size in (('GB', 1024 ** 3), ('MB', 1024 ** 2), ('KB', 1024)):
+            if value >= size:
+                return "{:.1f} {}/s".format(value / size, name)
+    return "{:g} {}/s".format(value, unit)
+
+class TokenBucket(object):
+    """
+    Limits how fast something is used up (bytes, files, ...) to `rate` per
+    second on average, allowing bursts of up to `burst` at once.
+
+    Taking more than is in the bucket puts it into debt, and the taker waits
+    until the debt has been paid back, so something bigger than the burst
+    (e.g. one large chunk of a file) doesn't wait forever. Each taker waits
+    outside of the lock, for its own share: with many threads taking at once,
+    they're spread out so that the total still keeps to the rate.
+
+    The clock and the sleep function can be replaced (e.g. with fakes, to try
+    it out without waiting).
+    """
+    def __init__(self, rate=None, burst=None, clock=time.time, sleep=time.sleep):
+        """
+        :param rate: how much may be taken per second, or None for no limit
+        :param burst: how much may be taken at once (one second's worth, by
+            default)
+        :param clock: the function used to tell the time
+        :param sleep: the function used to wait
+        """
+        self.clock  = clock
+        self.sleep  = sleep
+        self.lock   = threading.Lock()
+        self.rate   = None
+        self.burst  = 0
+        self.tokens = 0
+        self.stamp  = clock()
+        self.set(rate, burst)
+
+    def set(self, rate, burst=None):
+        """
+        Changes the rate (anything already owed is still owed).
+        """
+        with self.lock:
+            self._fill()
+            first      = self.rate is None
+            # (As floats, so that Python 2 doesn't round the waits down.)
+            self.rate  = float(rate) if rate else None
+            self.burst = float(burst if burst is not None else (rate or 0))
+            # A new bucket starts full.
+            self.tokens = self.burst if first else min(self.tokens, self.burst)
+
+    def _fill(self):
+        now = self.clock()
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, amount):
+        """
+        Takes some from the bucket, waiting for as long as it takes to make up
+        for it.
+
+        :return: how long was spent waiting, in seconds
+        """
+        with self.lock:
+            if not self.rate:
+                return 0.0
+            self._fill()
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            # Python 2's sleep() returns early if a signal comes in (e.g. the
+            # SIGHUP that reloads a schedule), so sleep until it's really done.
+            until = self.clock() + wait
+            left  = wait
+            while left > 0:
+                self.sleep(left)
+                left = until - self.clock()
+        return wait
+
+class Rule(object):
+    """
+    One section of a schedule: the limits that apply at certain times.
+    """
+    def __init__(self, name, days=None, hours=None, bandwidth=None, files=None):
+        """
+        :param name: the section's name
+        :param days: a set of the weekdays it applies on (0 is Monday), or None
+            for every day
+        :param hours: the (start, end) minutes after midnight between which it
+            applies (wrapping around midnight if the end comes first), or None
+            for all day
+        :param bandwidth: the bytes per second, None for no limit, or False to
+            leave the limit as it was given on the command line
+        :param files: the files per second, likewise
+        """
+        self.name      = name
+        self.days      = days
+        self.hours     = hours
+        self.bandwidth = bandwidth
+        self.files     = files
+
+    def matches(self, when):
+        """
+        :param when: a datetime
+        :return: whether the rule applies then
+        """
+        if self.days is not None and when.weekday() not in self.days:
+            return False
+        if self.hours is not None:
+            minute = when.hour * 60 + when.minute
+            start, end = self.hours
+            if start <= end:
+                return start <= minute < end
+            return minute >= start or minute < end
+        return True
+
+class Schedule(object):
+    """
+    Limits that change with the time of day and the day of the week, read from
+    an INI file. Each section is a rule; the first one that applies wins, and
+    if none does, the limits given on the command line are used. For example:
+
+        # Weekdays during business hours: keep to 10 MB/s and 50 files/s.
+        [business hours]
+        days      = mon-fri
+        hours     = 08:00-18:00
+        bandwidth = 10M
+        files     = 50
+
+        # Any other time: as fast as it'll go.
+        [otherwise]
+        bandwidth = unlimited
+        files     = unlimited
+
+    Leaving out `days` or `hours` means every day or all day. Leaving out
+    `bandwidth` or `files` means the limit given on the command line.
+    """
+    def __init__(self, rules):
+        self.rules = rules
+
+    @classmethod
+    def load(cls, path):
+        """
+        :raises ValueError: if the file can't be read, or anything in it can't
+            be understood
+        """
+        try:
+            from configparser import RawConfigParser, Error
+        except ImportError:
+            from ConfigParser import RawConfigParser, Error
+        parser = RawConfigParser()
+        try:
+            if not parser.read(path):
+                raise ValueError("Can't read the throttle schedule: " + path)
+        except Error as e:
+            raise ValueError("Can't read the throttle schedule {}: {}".format(path, e))
+        rules = []
+        for section in parser.sections():
+            options = dict(parser.items(section))
+            try:
+                rules.append(Rule(
+                    section,
+                    days      = _days(options['days']) if 'days' in options else None,
+                    hours     = _hours(options['hours']) if 'hours' in options else None,
+                    bandwidth = rate(options['bandwidth']) if 'bandwidth' in options else False,
+                    files     = rate(options['files']) if 'files' in options else False,
+                ))
+            except ValueError as e:
+                raise ValueError("In [{}] of {}: {}".format(section, path, e))
+        return cls(rules)
+
+    def limits(self, when, default=(None, None)):
+        """
+        :param when: a datetime
+        :param default: the (bandwidth, files) limits to use where no rule says
+            otherwise
+        :return: the (bandwidth, files) limits that apply at that time, and the
+            name of the rule they came from (or None)
+        """
+        for rule in self.rules:
+            if rule.matches(when):
+                return (default[0] if rule.bandwidth is False else rule.bandwidth,
+                        default[1] if rule.files is False else rule.files), rule.name
+        return default, None
+
+def _days(text):
+    """
+    Reads a list of days, e.g. 'mon-fri', 'sat, sun', or 'mon,wed-fri'.
+
+    :return: a set of weekdays (0 is Monday)
+    """
+    days = set()
+    for part in text.lower().split(','):
+        first, _, last = part.strip().partition('-')
+        try:
+            start = DAYS.index(first.strip()[:3])
+            end   = DAYS.index(last.strip()[:3]) if last else start
+        except ValueError:
+            raise ValueError("Not a day (or range of days): " + part.strip())
+        day = start
+        days.add(day)
+        while day != end:
+            day = (day + 1) % 7
+            days.add(day)
+    return days
+
+def _hours(text):
+    """
+    Reads a range of times, e.g. '08:00-18:00' or '22-6'.
+
+    :return: the (start, end) minutes after midnight
+    """
+    try:
+        start, end = [_minutes(time) for time in text.split('-')]
+    except ValueError:
+        raise ValueError("Not a range of hours (like 08:00-18:00): " + text)
+    return start, end
+
+def _minutes(text):
+    hour, _, minute = text.strip().partition(':')
+    hour, minute = int(hour), int(minute or 0)
+    if not (0 <= hour <= 24 and 0 <= minute < 60):
+        raise ValueError(text)
+    return hour * 60 + minute
+
+class Throttle(object):
+    """
+    Limits how fast files are archived: how many bytes per second are written
+    (bandwidth) and how many files per second are put in place (files), each
+    with a TokenBucket.
+
+    The limits can come from a Schedule as well, which is looked at again
+    every RECHECK seconds while files are being transferred (see check()).
+    Calling reload() (which is safe to do from a signal handler) has the
+    schedule read again from its file the next time it's checked.
+
+    A throttle may be used by many threads at once.
+    """
+    def __init__(self, bandwidth=None, files=None, schedule=None, clock=time.time, sleep=time.sleep):
+        """
+        :param bandwidth: the bytes per second, or None for no limit
+        :param files: the files per second, or None for no limit
+        :param schedule: the path of a schedule file (see Schedule)
+        :param clock: the function used to tell the time
+        :param sleep: the function used to wait
+        """
+        self.default   = (bandwidth, files)
+        # (Kept absolute, in case the current directory changes.)
+        self.path      = os.path.abspath(schedule) if schedule else None
+        self.schedule  = Schedule.load(schedule) if schedule else None
+        self.clock     = clock
+        self.bytes     = TokenBucket(clock=clock, sleep=sleep)
+        self.files     = TokenBucket(clock=clock, sleep=sleep)
+        self.lock      = threading.Lock()
+        self.limits    = None
+        self.rule      = None
+        self.checked   = None
+        self.reloading = False
+        # The last problem reloading the schedule, if there was one (the old
+        # schedule is kept when the new one can't be read).
+        self.error     = None
+        self.waited    = 0.0
+        self._apply()
+
+    def _apply(self):
+        now = self.clock()
+        if self.schedule is not None:
+            limits, self.rule = self.schedule.limits(datetime.fromtimestamp(now), self.default)
+        else:
+            limits = self.default
+        if limits != self.limits:
+            self.limits = limits
+            self.bytes.set(limits[0])
+            self.files.set(limits[1])
+        self.checked = now
+
+    def check(self):
+        """
+        Brings the limits up to date: reloads the schedule if that was asked
+        for, or looks at it again if it's been RECHECK seconds since it last
+        was.
+        """
+        with self.lock:
+            if self.reloading:
+                self.reloading = False
+                try:
+                    self.schedule = Schedule.load(self.path)
+                    self.error    = None
+                except ValueError as e:
+                    self.error = str(e)
+                self._apply()
+            elif self.schedule is not None and self.clock() - self.checked >= RECHECK:
+                self._apply()
+
+    def reload(self):
+        """
+        Asks for the schedule to be read again, the next time it's needed.
+        """
+        if self.path:
+            self.reloading = True
+
+    def transferred(self, size):
+        """
+        Waits for as long as it takes to keep to the bandwidth limit, after
+        `size` bytes have been written.
+        """
+        self.check()
+        waited = self.bytes.take(size)
+        if waited:
+            with self.lock:
+                self.waited += waited
+
+    def operation(self):
+        """
+        Waits for as long as it takes to keep to the files limit, before a
+        file is put in place.
+        """
+        self.check()
+        waited = self.files.take(1)
+        if waited:
+            with self.lock:
+                self.waited += waited
+
+    def __str__(self):
+        bandwidth, files = self.limits
+        text = "{}, {}".format(describe(bandwidth, 'B'), describe(files, 'files'))
+        if self.rule:
+            text += " [{}]".format(self.rule)
+        return text
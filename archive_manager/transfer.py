@@ -0,0 +1,468 @@
+import errno
+import os
+import shutil
+import sys
+import threading
+import time
+
+from collections import deque
+
+import digests
+from journal import CHECKPOINT, partial
+
+# Waiting on a result without a timeout cannot be interrupted by ^C in Python 2,
+# so a (very long) timeout is always given.
+_FOREVER = 60 * 60 * 24 * 365
+
+# How many finished results imap() holds on to while it waits for an earlier
+# one to finish (so that it can hand them back in order).
+_BACKLOG = 4096
+
+# How much to hand to the kernel (or read into memory) at a time.
+_CHUNK = 8 * 1024 * 1024
+
+# The ioctl request number for FICLONE on Linux, which makes the target share
+# the source's blocks on copy-on-write filesystems (btrfs, XFS, ...).
+_FICLONE = 0x40049409
+
+# If one of these errors comes up before any data has been written, the
+# strategy just isn't supported for this pair of files and the next one should
+# be tried instead.
+_UNSUPPORTED = set(getattr(errno, name) for name in (
+    'ENOSYS', 'EXDEV', 'EINVAL', 'ENOTSUP', 'EOPNOTSUPP', 'ENOTSOCK', 'ENOTTY',
+    'EBADF', 'EPERM'
+) if hasattr(errno, name))
+
+def place(entry, target, replace=True, persist=False, update_time=False, store=None, exists=None, metrics=None, journal=None, cross_device=False, checksum=None, throttle=None):
+    """
+    Puts a single file into the destination.
+
+    :param entry: the scanner Entry of the file to be archived
+    :param target: the path (including file name) where the file should end up
+    :param replace: if the target already exists, should it be replaced?
+    :type replace: bool
+    :param persist: whether to copy the file (True) or move it (False)
+    :type persist: bool
+    :param update_time: whether to update the timestamps on the target
+    :type update_time: bool
+    :param store: if given, a dedup.BlobStore to put the file's content in
+    :param exists: whether the target is already there, if that's known (e.g.
+        from a plan); if not given, it's checked
+    :param metrics: if given, a metrics.Metrics to add the time spent on each
+        step to
+    :param journal: if given, a journal.Journal to keep track of copies in (so
+        that interrupted ones can be resumed)
+    :param cross_device: whether the target is known to be on a different
+        filesystem, so that moving has to copy (see move())
+    :type cross_device: bool
+    :param checksum: if given, a digests.Checksum: whatever is written is
+        checked against the original, and the file's digest is left in it
+    :param throttle: if given, a throttle.Throttle to keep to (it's waited on
+        before the file is put in place, and as its data is written)
+    :return: the strategy used to put the file in the destination (see copy()
+        and move()), or None if it was left alone
+    """
+    # Check the destination only once (if the plan didn't already); the answer
+    # is used both to decide whether to add the file and whether to clear the
+    # way.
+    if exists is None:
+        exists = os.path.isfile(target)
+    if exists and not replace:
+        return None
+    # Copies and moves both end with a rename, which replaces whatever is at
+    # the target in one step; the old file stays in place until the new one is
+    # complete. Only a store (which hard links the target) needs the way
+    # cleared first, and the old content is kept in the store anyway.
+    start = time.time()
+    if exists and store is not None and entry.is_file:
+        try:
+            os.remove(target)
+        except OSError as e:
+            # It's already gone, which is fine.
+            if e.errno != errno.ENOENT:
+                raise
+        start = _timed(metrics, 'remove', start)
+    if throttle is not None:
+        throttle.operation()
+    # Copy if persisting data; move otherwise. (With a store, moving is done by
+    # adding the file to the store and then removing the original. Only files
+    # have content to store, so directories and broken links go the usual way.)
+    if store is not None and entry.is_file:
+        strategy = store.copy(entry.path, target, checksum, throttle)
+        if not persist:
+            os.unlink(entry.path)
+    elif persist:
+        strategy = copy(entry.path, target, journal, checksum, throttle)
+    else:
+        strategy = move(entry.path, target, journal, rename=not cross_device, checksum=checksum, throttle=throttle)
+    start = _timed(metrics, 'transfer', start)
+    # Update the time as needed.
+    if update_time:
+        os.utime(target, None)
+        _timed(metrics, 'utime', start)
+    return strategy
+
+def _timed(metrics, phase, start):
+    """
+    Adds the time since `start` to a phase of the metrics (if there are any).
+
+    :return: the time now
+    """
+    now = time.time()
+    if metrics is not None:
+        metrics.add(phase, now - start)
+    return now
+
+def copy(source, target, journal=None, checksum=None, throttle=None):
+    """
+    Copies a file's contents and metadata (the same metadata shutil.copy2
+    keeps), letting the kernel move the data whenever it can. The strategies
+    are tried in this order:
+
+        copy_file_range   in-kernel copy (Linux, Python 3.8+)
+        sendfile          in-kernel copy (Linux, Python 3.3+)
+        reflink           shares the blocks on copy-on-write filesystems
+        userspace         reads and writes through Python (what shutil does)
+
+    The data is written to a partial file next to the target (see
+    journal.partial()), which is renamed into place once it's complete, so
+    there's never a truncated file under the target's name. If the copy fails,
+    the partial file is removed.
+
+    With a journal, the copy is logged in it, and large copies are checkpointed
+    as they go. If a checkpointed copy of the same file was interrupted before,
+    it carries on from its last checkpoint (and the strategy is reported as
+    resumed).
+
+    With a checksum, the data has to pass through here to be hashed, so it's
+    always copied in userspace (and hashed on another thread as it goes; see
+    digests.Hasher). Before the partial file is renamed into place, it's
+    synced, read back (from the disk, where the OS lets the page cache be
+    dropped), and compared with the original. If they don't match, the copy
+    fails.
+
+    With a throttle, the data is copied a chunk at a time, waiting after each
+    one for as long as it takes to keep to the bandwidth limit. (A reflink
+    doesn't write any data, so it isn't held back.)
+
+    :param source: the file to copy
+    :param target: the path of the new file
+    :param journal: if given, a journal.Journal of the target's destination
+    :param checksum: if given, a digests.Checksum to check the copy with
+    :param throttle: if given, a throttle.Throttle to keep to
+    :return: the name of the strategy that was used
+    """
+    if os.path.isdir(source):
+        raise IOError(errno.EISDIR, "Is a directory", source)
+    temp   = partial(target)
+    offset = journal.resume(source, target) if journal is not None else 0
+    try:
+        with open(source, 'rb') as fsrc:
+            with open(temp, 'r+b' if offset else 'wb') as fdst:
+                progress = None
+                if journal is not None:
+                    journal.begin(source, target, os.fstat(fsrc.fileno()), offset)
+                    progress = _checkpoints(fdst, target, journal, offset)
+                if throttle is not None:
+                    progress = _throttled(progress, throttle, offset)
+                if offset:
+                    fdst.truncate(offset)
+                    fsrc.seek(offset)
+                    fdst.seek(offset)
+                if checksum is not None:
+                    strategy = _copy_checked(fsrc, fdst, offset, progress, checksum)
+                else:
+                    strategy = _copy_data(fsrc, fdst, offset, progress)
+        if checksum is not None:
+            checksum.check(temp)
+        shutil.copystat(source, temp)
+        os.rename(temp, target)
+    except Exception:
+        # Don't leave the partial file lying around. (If the run is being
+        # stopped instead, it's kept so that the next run can resume it.)
+        if journal is not None:
+            journal.abandon(target)
+        elif os.path.exists(temp):
+            os.remove(temp)
+        raise
+    if journal is not None:
+        journal.done(target)
+    if offset:
+        strategy += ' (resumed)'
+    return strategy
+
+def _checkpoints(fdst, target, journal, offset):
+    """
+    :return: a function to call with the position in the target as a copy
+        goes on, which syncs it to disk and checkpoints it in the journal after
+        every CHECKPOINT bytes
+    """
+    last = [offset]
+    def progress(position):
+        if position - last[0] >= CHECKPOINT:
+            fdst.flush()
+            os.fsync(fdst.fileno())
+            journal.checkpoint(target, position)
+            last[0] = position
+    return progress
+
+def _throttled(progress, throttle, offset):
+    """
+    :return: a function to call with the position in the target as a copy
+        goes on, which waits on the throttle for the bytes written since it was
+        last called (and then calls `progress`, if it's given)
+    """
+    last = [offset]
+    def throttled(position):
+        throttle.transferred(position - last[0])
+        last[0] = position
+        if progress is not None:
+            progress(position)
+    return throttled
+
+def move(source, target, journal=None, rename=True, checksum=None, throttle=None):
+    """
+    Moves a file. If a simple rename can't be done (because the target is on a
+    different filesystem), the file is copied with copy() and then the source
+    is removed (only once the copy is complete, and has been checked if there's
+    a checksum).
+
+    A renamed file's data hasn't gone anywhere, so there's nothing to check,
+    but with a checksum it's read once (before it's renamed) to work out its
+    digest. Only regular files have a digest; a directory or link is moved
+    without one.
+
+    :param source: the file to move
+    :param target: the new path of the file
+    :param journal: if given, a journal.Journal for copy() to use
+    :param rename: whether to try renaming at all (if the target is already
+        known to be on a different filesystem, there's no point)
+    :type rename: bool
+    :param checksum: if given, a digests.Checksum for copy() to use (or to
+        leave a renamed file's digest in)
+    :param throttle: if given, a throttle.Throttle for copy() to keep to
+    :return: the name of the strategy that was used ('rename', or one of the
+        strategies from copy())
+    """
+    if rename:
+        if checksum is not None and os.path.isfile(source) and not os.path.islink(source):
+            checksum.value = digests.file_digest(source)
+        try:
+            os.rename(source, target)
+            return 'rename'
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+    if os.path.isdir(source) or os.path.islink(source):
+        # Leave the hard cases to shutil.
+        shutil.move(source, target)
+        return 'move'
+    strategy = copy(source, target, journal, checksum, throttle)
+    os.unlink(source)
+    return strategy
+
+def same_device(origin, destination):
+    """
+    :return: whether two paths are on the same filesystem (so that files can be
+        moved from one to the other by renaming them)
+
+    The destination doesn't have to exist yet (as in a dry run): the nearest
+    directory above it that does is where it would be made.
+    """
+    destination = os.path.abspath(destination)
+    while not os.path.exists(destination) and os.path.dirname(destination) != destination:
+        destination = os.path.dirname(destination)
+    return os.stat(origin).st_dev == os.stat(destination).st_dev
+
+def _copy_data(fsrc, fdst, offset=0, progress=None):
+    """
+    Copies everything from one open file to another with the best available
+    strategy, starting from `offset` (where both files must already be
+    positioned).
+
+    :param progress: if given, called with the position in the target after
+        each chunk is written
+    """
+    infd  = fsrc.fileno()
+    outfd = fdst.fileno()
+    for name, strategy in _STRATEGIES:
+        if offset and name == 'reflink':
+            # Cloning only works on whole files.
+            continue
+        try:
+            strategy(infd, outfd, progress)
+            return name
+        except (IOError, OSError) as e:
+            # Only move on to the next strategy if nothing has been written
+            # yet. Otherwise this is a real error.
+            if e.errno not in _UNSUPPORTED or os.lseek(outfd, 0, os.SEEK_CUR) != offset:
+                raise
+    if progress is None:
+        shutil.copyfileobj(fsrc, fdst, _CHUNK)
+        return 'userspace'
+    while True:
+        chunk = fsrc.read(_CHUNK)
+        if not chunk:
+            break
+        fdst.write(chunk)
+        offset += len(chunk)
+        progress(offset)
+    return 'userspace'
+
+def _copy_checked(fsrc, fdst, offset, progress, checksum):
+    """
+    Copies everything from one open file to another in userspace, like
+    _copy_data(), hashing the data as it goes. (If the copy is being resumed,
+    the part of the original before `offset` is read and hashed first.) The
+    digest is left in the checksum, and the target is synced to disk so that
+    it can be checked.
+    """
+    hasher = digests.Hasher()
+    try:
+        if offset:
+            with open(fsrc.name, 'rb') as before:
+                digests.feed(before, hasher, offset)
+        while True:
+            chunk = fsrc.read(_CHUNK)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            fdst.write(chunk)
+            offset += len(chunk)
+            if progress is not None:
+                progress(offset)
+        fdst.flush()
+        os.fsync(fdst.fileno())
+        checksum.value = hasher.hexdigest()
+    finally:
+        # (So that a failed copy doesn't leave the hashing thread behind.)
+        hasher.close()
+    return 'userspace'
+
+def _copy_file_range(infd, outfd, progress=None):
+    while os.copy_file_range(infd, outfd, _CHUNK):
+        if progress is not None:
+            progress(os.lseek(outfd, 0, os.SEEK_CUR))
+
+def _sendfile(infd, outfd, progress=None):
+    offset = os.lseek(infd, 0, os.SEEK_CUR)
+    while True:
+        sent = os.sendfile(outfd, infd, offset, _CHUNK)
+        if not sent:
+            break
+        offset += sent
+        if progress is not None:
+            progress(offset)
+    # sendfile() doesn't move the file positions, so do it here.
+    os.lseek(infd, offset, os.SEEK_SET)
+    os.lseek(outfd, offset, os.SEEK_SET)
+
+def _reflink(infd, outfd, progress=None):
+    import fcntl
+    fcntl.ioctl(outfd, _FICLONE, infd)
+    os.lseek(outfd, 0, os.SEEK_END)
+
+# The kernel-level strategies available on this system, in order of preference.
+_STRATEGIES = []
+if hasattr(os, 'copy_file_range'):
+    _STRATEGIES.append(('copy_file_range', _copy_file_range))
+if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+    _STRATEGIES.append(('sendfile', _sendfile))
+if sys.platform.startswith('linux'):
+    _STRATEGIES.append(('reflink', _reflink))
+
+def imap(function, items, jobs=1, inline=None):
+    """
+    Applies a function to every item, using up to `jobs` worker threads. The
+    results are yielded in the same order as the items were given, no matter
+    which one finishes first, so anything reported from them stays
+    deterministic. Only a small window of items is handed to the workers at a
+    time, so `items` may be a (long) generator.
+
+    The window only counts items that are still being worked on: the workers
+    are given more as soon as any of them finishes, even while an earlier item
+    (say, one huge file) holds up the results behind it. The workers take the
+    items in the order they're given, from a single queue.
+
+    Items that `inline` picks out (say, files that are being skipped) are
+    done straight away on this thread instead, since handing them to a worker
+    would cost more than they do. Their results still come back in order.
+
+    Exceptions raised by `function` are not caught here; callers that want to
+    keep going after a failure should catch them inside `function`.
+
+    If a KeyboardInterrupt arrives, no further items are started. The results
+    of the items already in progress are still yielded (after they finish) and
+    then the KeyboardInterrupt is raised again. A second interrupt stops
+    immediately.
+
+    :param function: the function to call on each item
+    :param items: an iterable of items
+    :param jobs: how many items may be worked on at once
+    :type jobs: int
+    :param inline: if given, a function which says (for an item) whether to
+        do it on this thread
+    :return: a generator of the results
+    """
+    if jobs <= 1:
+        for item in items:
+            yield function(item)
+        return
+
+    from multiprocessing.pool import ThreadPool
+    pool    = ThreadPool(jobs)
+    pending = deque()
+    # How many items have been handed over and aren't finished yet.
+    running = [0]
+    changed = threading.Condition()
+    def run(item):
+        try:
+            return function(item)
+        finally:
+            with changed:
+                running[0] -= 1
+                changed.notify()
+    try:
+        try:
+            for item in items:
+                if inline is not None and inline(item):
+                    pending.append(_Done(function(item)))
+                else:
+                    # Keep every worker busy, but don't read ahead any further
+                    # than that. (The timeout lets ^C through in Python 2.)
+                    with changed:
+                        while running[0] >= jobs * 2:
+                            changed.wait(1)
+                        running[0] += 1
+                    pending.append(pool.apply_async(run, (item,)))
+                # Hand back whatever has finished, in order.
+                while pending and pending[0].ready():
+                    yield pending.popleft().get(_FOREVER)
+                if len(pending) >= _BACKLOG:
+                    yield pending.popleft().get(_FOREVER)
+            while pending:
+                yield pending.popleft().get(_FOREVER)
+        except KeyboardInterrupt:
+            # Let the files that are already in progress finish up, and report
+            # on them, before quitting.
+            while pending:
+                yield pending.popleft().get(_FOREVER)
+            raise
+    finally:
+        pool.terminate()
+
+class _Done(object):
+    """
+    A result that's already there, which stands in line with those of the
+    workers (see imap()).
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self, timeout=None):
+        return self.value
@@ -0,0 +1,303 @@
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+import scanner
+
+# Flags from <sys/inotify.h>.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+IN_CLOEXEC     = 0x00080000
+
+# What's watched in each directory: files that have been closed after being
+# written to, files (or directories) moved in from elsewhere, and new
+# directories.
+_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+# The fixed part of each event read from an inotify file descriptor: the watch
+# descriptor, mask, cookie, and length of the name that follows.
+_EVENT = struct.Struct('iIII')
+
+def _libc():
+    """
+    :return: the C library, if it has inotify (Linux), or None
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    import ctypes
+    import ctypes.util
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+def start(origin, recursive=False, window=1.0, exclude=(), poll=False):
+    """
+    Starts watching the origin for files that are ready to be archived.
+
+    :param origin: the directory to watch
+    :param recursive: whether to watch the origin's subdirectories too
+    :type recursive: bool
+    :param window: how long to gather files for before handing them over (and,
+        when polling, how often to poll), in seconds
+    :param exclude: absolute paths of directories that should not be watched
+        (e.g. a destination which lives inside the origin)
+    :param poll: whether to poll even where inotify is available
+    :type poll: bool
+    :return: an Inotify watcher on Linux, or a Poller anywhere else
+    """
+    libc = None if poll else _libc()
+    if libc is not None:
+        try:
+            return Inotify(libc, origin, recursive, window, exclude)
+        except OSError:
+            # E.g. out of inotify instances.
+            pass
+    return Poller(origin, recursive, window, exclude)
+
+class _Watcher(object):
+    """
+    What Inotify and Poller have in common. Call batches() to get the files as
+    they become ready, and close() when done.
+
+    A file found by reading a directory (rather than from an event saying it
+    was closed) might still be being written to, so it's 'settling' until its
+    size and modification time have stayed the same for a whole window.
+    """
+    def __init__(self, origin, recursive, window, exclude):
+        self.origin    = os.path.abspath(origin)
+        self.recursive = recursive
+        self.window    = window
+        self.exclude   = set(os.path.abspath(path) for path in exclude)
+        self.settling  = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        pass
+
+    def _files(self, directory):
+        """
+        Reads a directory's files (and, when recursive, its subdirectories').
+
+        :return: a dictionary of each file's size and modification time, by its
+            absolute path
+        """
+        if self.recursive:
+            entries = scanner.walk(directory, exclude=self.exclude)
+        else:
+            entries = scanner.scan(directory)
+        files = {}
+        try:
+            for entry in entries:
+                if entry.kind == scanner.FILE:
+                    files[entry.path] = (entry.size, entry.mtime)
+        except OSError:
+            pass
+        return files
+
+    def _settled(self):
+        """
+        :return: the settling files which haven't changed since they were last
+            looked at (they're no longer settling); the rest are looked at
+            again next time
+        """
+        ready = []
+        for path, seen in list(self.settling.items()):
+            try:
+                info = os.stat(path)
+            except OSError:
+                # It's gone.
+                del self.settling[path]
+                continue
+            now = (info.st_size, info.st_mtime)
+            if now == seen:
+                ready.append(path)
+                del self.settling[path]
+            else:
+                self.settling[path] = now
+        return ready
+
+class Inotify(_Watcher):
+    """
+    Watches with Linux's inotify, so that nothing is read until something
+    happens: while the origin is idle, this just waits on the inotify file
+    descriptor. A file is ready once whatever was writing it closes it, or
+    when it's moved in (from elsewhere on the same device) whole.
+
+    When recursive, each new directory is watched as soon as it's created, and
+    read in case anything got into it first.
+    """
+    def __init__(self, libc, origin, recursive=False, window=1.0, exclude=()):
+        super(Inotify, self).__init__(origin, recursive, window, exclude)
+        self.libc = libc
+        self.fd   = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            error = _errno()
+            raise OSError(error, os.strerror(error))
+        self.watches = {}
+        self._watch(self.origin)
+        # Whatever is already there is handed over once it's settled.
+        self.settling.update(self._files(self.origin))
+
+    def _watch(self, directory):
+        """
+        Watches a directory (and, when recursive, everything beneath it).
+        """
+        if directory in self.exclude:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, _encode(directory), _MASK)
+        if wd < 0:
+            error = _errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                # It went away before it could be watched.
+                return
+            raise OSError(error, os.strerror(error), directory)
+        self.watches[wd] = directory
+        if self.recursive:
+            try:
+                entries = list(scanner.scan(directory))
+            except OSError:
+                return
+            for entry in entries:
+                if entry.kind == scanner.DIR and not os.path.islink(entry.path):
+                    self._watch(entry.path)
+
+    def _events(self, timeout):
+        """
+        Waits for events for up to `timeout` seconds (or forever, if it's None).
+
+        :return: a list of (directory, mask, name) for each event read
+        """
+        ready, _, _ = _select([self.fd], timeout)
+        if not ready:
+            return []
+        data   = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name    = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((self.watches.get(wd), mask, _decode(name)))
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+        return events
+
+    def _handle(self, events, ready):
+        """
+        Adds the files that the events show are ready to `ready`.
+        """
+        for directory, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so everything has to be looked at.
+                self.settling.update(self._files(self.origin))
+                continue
+            if directory == self.origin and mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                raise RuntimeError("The origin directory went away: " + self.origin)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch(path)
+                    self.settling.update(self._files(path))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self.settling.pop(path, None)
+                ready.add(path)
+
+    def batches(self):
+        """
+        Waits for files to be ready, and then gathers any more that are ready
+        within the window after that.
+
+        :return: a generator of sorted lists of the absolute paths of the files
+            that are ready, one list for each window
+        """
+        while True:
+            ready = set()
+            # Nothing happens until there's an event (or something is settling).
+            self._handle(self._events(self.window if self.settling else None), ready)
+            deadline = time.time() + self.window
+            while time.time() < deadline:
+                self._handle(self._events(deadline - time.time()), ready)
+            ready.update(self._settled())
+            if ready:
+                yield sorted(path for path in ready if os.path.isfile(path))
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class Poller(_Watcher):
+    """
+    Watches by reading the origin once each window, for when inotify isn't
+    available. A file is ready once it has stayed the same from one read to the
+    next, and isn't handed over again unless it changes (in case it's being
+    copied rather than moved, and so is still there next time). Nothing is
+    stat'ed beyond what reading the origin does anyway.
+    """
+    def __init__(self, origin, recursive=False, window=1.0, exclude=()):
+        super(Poller, self).__init__(origin, recursive, window, exclude)
+        self.handed = {}
+
+    def batches(self):
+        """
+        :return: a generator of sorted lists of the absolute paths of the files
+            that are ready, one list for each window that has any
+        """
+        while True:
+            present = self._files(self.origin)
+            ready   = []
+            for path, seen in present.items():
+                if self.handed.get(path) != seen and self.settling.get(path) == seen:
+                    ready.append(path)
+                    self.handed[path] = seen
+            self.settling = dict((path, seen) for path, seen in present.items() if self.handed.get(path) != seen)
+            # Forget about whatever's gone.
+            self.handed   = dict((path, seen) for path, seen in self.handed.items() if path in present)
+            if ready:
+                yield sorted(ready)
+            time.sleep(self.window)
+
+def _errno():
+    import ctypes
+    return ctypes.get_errno()
+
+def _select(fds, timeout):
+    while True:
+        try:
+            return select.select(fds, [], [], timeout)
+        except (select.error, OSError) as e:
+            # Interrupted by a signal; go back to waiting.
+            if e.args[0] != errno.EINTR:
+                raise
+
+def _encode(path):
+    if isinstance(path, bytes):
+        return path
+    return path.encode(sys.getfilesystemencoding())
+
+def _decode(name):
+    if str is bytes:
+        return name
+    return name.decode(sys.getfilesystemencoding(), 'surrogateescape')
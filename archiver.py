@@ -1,26 +1,72 @@
 #!/usr/bin/env python
 
-import argparse
+import os
+import signal
 import sys
 import time
 
 from datetime import datetime
 
-import archive_manager.archivers
-from archive_manager.formatting import granularity
-from archive_manager.formatting import date
+# The package is only imported once it's known there's work to do: importing
+# it imports all of it, which is most of what a quick run costs.
+
+def package_version():
+    '''Reads the package's version from it without importing it.'''
+
+    import imp
+    import re
+
+    try:
+        path = imp.find_module('archive_manager')[1]
+        with open(os.path.join(path, '__init__.py')) as init:
+            return re.search(r"^__version__ = '(.+)'$", init.read(), re.MULTILINE).group(1)
+    except (ImportError, IOError, AttributeError):
+        # It's somewhere that can't be read like that (e.g. a zip file).
+        import archive_manager
+        return archive_manager.__version__
 
 options = {}
 options['long_name'] = "Archive Manager"
 options['name']      = "archive_manager.py"
-options['version']   = archive_manager.__version__
+options['version']   = package_version()
+
+def main(origin, destination, flat, delimiter, grain, replace, persist, update_time, jobs, incremental, manifest, recursive, dedup, dry_run, plan_out, stats_file, pipeline, bundle, retention, watch, order, verify, throttle, logger):
+    import archive_manager.archivers
+    import archive_manager.throttle
+    from archive_manager.formatting import granularity
+    from archive_manager.formatting import date
 
-def main(origin, destination, flat, delimiter, grain, replace, persist, update_time, logger):
     logger.info('-' * 80)
-    logger.info("Archiving from:     " + origin)
+    if origin:
+        logger.info("Archiving from:     " + origin)
     logger.info("Archiving to:       " + destination)
     logger.info("Persisting:         " + str(persist))
     logger.info("Replacing:          " + str(replace))
+    logger.info("Parallel jobs:      " + str(jobs))
+    logger.info("Pipelined:          " + str(pipeline))
+    logger.info("Incremental:        " + str(incremental))
+    logger.info("Recursive:          " + str(recursive))
+    logger.info("Deduplicating:      " + str(dedup))
+    logger.info("Dry run:            " + str(dry_run))
+    logger.info("Verifying:          " + str(verify))
+    if bundle:
+        logger.info("Bundling into:      " + bundle)
+    if order != 'name':
+        logger.info("Transfer order:     " + order)
+    if throttle:
+        bandwidth, files, schedule = throttle
+        throttle = archive_manager.throttle.Throttle(bandwidth, files, schedule)
+        logger.info("Throttling to:      " + str(throttle))
+        if schedule:
+            logger.info("Throttle schedule:  " + schedule)
+            # The schedule can be changed without stopping the run: edit it and
+            # send SIGHUP.
+            if hasattr(signal, 'SIGHUP'):
+                signal.signal(signal.SIGHUP, lambda signum, frame: throttle.reload())
+    if plan_out:
+        logger.info("Plan output:        " + plan_out)
+    if stats_file:
+        logger.info("Stats output:       " + stats_file)
     try:
         granularity(grain)
     except:
@@ -37,23 +83,52 @@ def main(origin, destination, flat, delimiter, grain, replace, persist, update_t
     else:
         message += "nested directories (file names will not be modified)"
     logger.info(message)
-    logger.info("Will begin in ten seconds...")
-    time.sleep(1)
+
+    # The manifest commands are run instead of archiving anything.
+    if manifest == 'verify':
+        archive_manager.archivers.verify_manifest(destination, logger)
+        return
+    if manifest == 'rebuild':
+        archive_manager.archivers.rebuild_manifest(origin, destination, flat, grain, delimiter, logger, recursive,
+                                                   bundle)
+        return
+
+    # So is pruning.
+    if retention:
+        days, weeks, months = retention
+        logger.info("Keeping:            {} days, {} weeks, {} months".format(days or 0, weeks or 0, months or 0))
+        archive_manager.archivers.prune(destination, flat, grain, delimiter, days, weeks, months, dry_run, logger)
+        return
+
+    # Only pause when someone is there to stop it (not under cron or launchd).
+    if not dry_run and sys.stdin.isatty():
+        logger.info("Will begin in ten seconds...")
+        time.sleep(1)
     logger.info('')
-    logger.info("BEGINNING ARCHIVAL")
+    logger.info("BEGINNING " + ("DRY RUN" if dry_run else "ARCHIVAL"))
 
-    if flat:
-        archive_manager.archivers.flat(origin, destination, replace, grain, persist, delimiter, update_time, logger)
+    if watch:
+        window, poll = watch
+        archive_manager.archivers.watch(origin, destination, flat, grain, delimiter, window, replace, persist, update_time, logger, jobs, incremental, recursive, dedup, stats_file, pipeline, bundle, poll, order, verify, throttle)
+    elif flat:
+        archive_manager.archivers.flat(origin, destination, replace, grain, persist, delimiter, update_time, logger, jobs, incremental, recursive, dedup, dry_run, plan_out, stats_file, pipeline, bundle, order, verify, throttle)
     else:
-        archive_manager.archivers.nested(origin, destination, replace, grain, persist, update_time, logger)
+        archive_manager.archivers.nested(origin, destination, replace, grain, persist, update_time, logger, jobs, incremental, recursive, dedup, dry_run, plan_out, stats_file, pipeline, bundle, order, verify, throttle)
 
-class ArgumentParser(argparse.ArgumentParser):
-    '''Custom ArgumentParser for error handling.'''
+def argument_parser():
+    '''Makes the ArgumentParser (argparse is only imported when it's needed).'''
 
-    def error(self, message):
-        print("Error: {}\n".format(message))
-        usage(short=True)
-        self.exit(2)
+    import argparse
+
+    class ArgumentParser(argparse.ArgumentParser):
+        '''Custom ArgumentParser for error handling.'''
+
+        def error(self, message):
+            print("Error: {}\n".format(message))
+            usage(short=True)
+            self.exit(2)
+
+    return ArgumentParser(add_help=False)
 
 def version():
     '''Prints the version information.'''
@@ -69,7 +144,14 @@ def usage(short=False):
 
     print('''\
 usage: {name} [-hvn] [-l log] [--flat] [--delimiter delimiter]
-\t[--granularity grain] [--replace] [--persist] origin destination
+\t[--granularity grain] [--replace] [--persist] [--jobs N]
+\t[--incremental] [--verify-manifest] [--rebuild-manifest] [--recursive]
+\t[--dedup] [--dry-run] [--plan-out file] [--stats-file file]
+\t[--pipeline] [--bundle format] [--order order] [--verify]
+\t[--bandwidth rate] [--file-rate rate] [--throttle-schedule file]
+\t[--watch [--window seconds] [--poll]]
+\t[--prune [--keep-days N] [--keep-weeks N] [--keep-months N]]
+\torigin destination
 
 Automatically archives files from `origin` into `destination`. This can either
 be done in a nested directory format using date components as the directories,
@@ -102,10 +184,129 @@ archived file.
         left alone. The default is to replace it with the non-archived one.
     --persist
         Leaves the original files in their places and only copies them to
-        `destination`.
+        `destination`. The copying is done by the kernel where possible (with
+        copy_file_range, sendfile, or a copy-on-write reflink), and the method
+        used for each file is shown in the log.
     --update-time
         After files are moved or copied to the new location, the new files will
         have their access and modified times updated to the current time.
+    --jobs N
+        Copies/moves up to `N` files at the same time. This helps to make full
+        use of fast disks and network mounts when archiving many large files.
+        The default is 1 (one file at a time).
+    --incremental
+        Keeps a manifest of the files that have been archived in `destination`
+        (in the file '.archive_manager.sqlite'). Files in `origin` which have
+        not changed since they were archived (same size, modification time, and
+        inode) are skipped without looking at `destination`. This is meant to
+        be used with --persist.
+    --verify-manifest
+        Instead of archiving, checks the manifest in `destination` and forgets
+        any files which are no longer there so they will be archived again.
+    --rebuild-manifest
+        Instead of archiving, throws away the manifest in `destination` and
+        builds a new one from the files in `origin` that are already archived.
+        Give the same --flat, --delimiter, --granularity, --recursive, and
+        --bundle used to archive.
+    --recursive
+        Archives the files in all of the subdirectories of `origin` as well.
+        Each file keeps its path relative to `origin` beneath its date
+        directory (or, with --flat, the directory names are joined onto the
+        file name with the delimiter). Files are archived as they are found,
+        rather than after the whole of `origin` has been read.
+    --dedup
+        Keeps one copy of each distinct file content in a store inside
+        `destination` (the directory '.archive_manager_blobs'), and makes the
+        archived files hard links to it. Files whose content has already been
+        archived take up no extra space and aren't written again. Note that
+        hard-linked files share their permissions and timestamps.
+    --dry-run
+        Works out what would be done with every file (added, replaced, skipped,
+        or unchanged) and reports the totals, without touching anything.
+    --plan-out file
+        Writes the plan to `file` as JSON Lines: one line for each file, and a
+        last line with the totals. This can be used with or without --dry-run.
+    --stats-file file
+        Writes the run's metrics (time spent in each phase, files and bytes
+        transferred, per-file latency histogram, errors) to `file`. If `file`
+        ends with '.prom' it's written in the Prometheus text format (for
+        node_exporter's textfile collector); otherwise it's written as JSON. A
+        summary of the metrics is always logged at the end of a run.
+    --pipeline
+        For destinations on a network share, where every directory listing,
+        mkdir, and so on is a round trip to the server. The existing
+        directories in `destination` are read up front, --jobs at a time, and
+        each new directory is created by the job that's putting the first file
+        in it, so the round trips overlap with each other and with the
+        transfers instead of happening one after another. Use it with --jobs.
+    --bundle format
+        Writes each date bucket as a single archive file instead of a directory
+        (or, with --flat, instead of a set of renamed files): e.g.
+        '2014/08/08.tar.gz' in place of '2014/08/08/'. `format` is one of
+        'tar.gz', 'tar.zst' (which needs the 'zstandard' module), or 'zip'.
+        Files are read straight into the archive, and --jobs archives are
+        written at once. If a bucket's archive is already there, the new files
+        are appended to it; tar archives that have been appended to should be
+        read with `tar --ignore-zeros`. When moving, the original files are
+        only removed once their archive has been written.
+    --order order
+        The order to transfer files in: 'name' (the default), 'smallest' (so
+        that as many files as possible are archived as soon as possible),
+        'largest' (with --jobs, so that the bytes are shared out evenly between
+        the jobs and one huge file doesn't hold up the end of the run), or
+        'oldest' (least recently modified first). With --bundle, the bundles
+        are written in this order too, by their total size (or oldest file).
+        Any order but 'name' means everything is planned first, even with
+        --recursive.
+    --verify
+        Checks every file that's written: its data is hashed (SHA-256) as it's
+        read from `origin`, and what was written is read back and compared
+        with it before it's put in place. When moving, the original is only
+        removed once its copy has been checked. (Files moved by renaming them
+        haven't been copied, but are read once for their digests.) Each
+        bucket's digests are kept next to it in the format sha256sum writes,
+        e.g. '2014/08/08.sha256', so they can be checked again later with
+        `sha256sum -c`. Copies go through userspace so that they can be
+        hashed, but the hashing happens on another thread, as they go.
+    --bandwidth rate
+        Writes no more than `rate` bytes per second to `destination`, across
+        all of the --jobs, e.g. '10M' (10 MB/s), '512K', or '1.5G'. Kernel
+        copies are held back a chunk (8 MB) at a time; reflinks and renames
+        write no data, so they aren't. With --bundle, each file's size counts
+        as it's added. The default is no limit.
+    --file-rate rate
+        Puts no more than `rate` files per second in place, e.g. '50'. The
+        default is no limit.
+    --throttle-schedule file
+        Takes the limits from an INI file, so that they can change with the
+        time of day. Each section is a rule giving the `days` (e.g. 'mon-fri')
+        and `hours` (e.g. '08:00-18:00') it applies to, and the `bandwidth`
+        and `files` limits (a rate as above, or 'unlimited'); the first rule
+        that applies is used, and anything it leaves out comes from
+        --bandwidth and --file-rate. The schedule is looked at again every 30
+        seconds while files are being written, and it is read again from the
+        file after a SIGHUP (e.g. `kill -HUP <pid>`), so the limits of a run
+        (or a --watch) can be changed while it's going.
+    --watch
+        Keeps running, and archives files as they arrive in `origin` instead of
+        reading it all once (files already there are archived first). On Linux
+        this uses inotify, so nothing is done while `origin` is idle; elsewhere
+        (or with --poll) `origin` is read once every window. A file is only
+        archived once whatever was writing it has closed it (or, when polling,
+        once it has stopped changing). Files that are ready within --window
+        seconds (1 by default) of each other are archived together. Stop it
+        with Control-C. Can't be used with --dry-run.
+    --prune
+        Instead of archiving, removes old date buckets from `destination` (which
+        can be given on its own). Give the same --flat, --delimiter, and
+        --granularity used to archive. The dates are read from the names of
+        the buckets, so nothing else is looked at, and a directory is removed
+        all at once when everything in it is going. Buckets are kept if any
+        of these keeps them (and at least one must be given):
+            --keep-days N    everything from the last N days
+            --keep-weeks N   the newest bucket of each of the last N weeks
+            --keep-months N  the newest bucket of each of the last N months
+        Use it with --dry-run to see what would be removed.
 
 GRANULARITY
     Different applications of archival may require different levels of what can
@@ -125,12 +326,9 @@ GRANULARITY
 '''.format(name=options['name']))
 
 def setup_logger(log, log_dest):
-    try:
-        from management_tools import loggers
-    except ImportError as e:
-        print "You need the 'Management Tools' module to be installed first."
-        print "https://github.com/univ-of-utah-marriott-library-apple/management_tools"
-        raise e
+    # These come from Management Tools if it's installed, or the standard
+    # library's logging module if not.
+    from archive_manager import loggers
 
     if not log:
         logger = loggers.stream_logger(1)
@@ -142,7 +340,16 @@ def setup_logger(log, log_dest):
     return logger
 
 if __name__ == '__main__':
-    parser = ArgumentParser(add_help=False)
+    # The version is all that's wanted, so don't bother with the rest.
+    if sys.argv[1:] in (['-v'], ['--version']):
+        version()
+        sys.exit(0)
+
+    import archive_manager.bundle
+    import archive_manager.scheduler
+    import archive_manager.throttle
+
+    parser = argument_parser()
     parser.add_argument('-h', '--help', action='store_true')
     parser.add_argument('-v', '--version', action='store_true')
     parser.add_argument('-n', '--no-log', action='store_true')
@@ -154,6 +361,29 @@ if __name__ == '__main__':
     parser.add_argument('--persist', action='store_true')
     parser.add_argument('--delimiter', default='.')
     parser.add_argument('--update-time', action='store_true')
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--incremental', action='store_true')
+    parser.add_argument('--recursive', action='store_true')
+    parser.add_argument('--dedup', action='store_true')
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--plan-out')
+    parser.add_argument('--stats-file')
+    parser.add_argument('--pipeline', action='store_true')
+    parser.add_argument('--bundle', choices=archive_manager.bundle.FORMATS)
+    parser.add_argument('--order', choices=archive_manager.scheduler.ORDERS, default='name')
+    parser.add_argument('--verify', action='store_true')
+    parser.add_argument('--bandwidth', type=archive_manager.throttle.rate)
+    parser.add_argument('--file-rate', type=archive_manager.throttle.rate)
+    parser.add_argument('--throttle-schedule')
+    parser.add_argument('--watch', action='store_true')
+    parser.add_argument('--window', type=float, default=1.0)
+    parser.add_argument('--poll', action='store_true')
+    parser.add_argument('--prune', action='store_true')
+    parser.add_argument('--keep-days', type=int)
+    parser.add_argument('--keep-weeks', type=int)
+    parser.add_argument('--keep-months', type=int)
+    parser.add_argument('--verify-manifest', action='store_const', const='verify', dest='manifest')
+    parser.add_argument('--rebuild-manifest', action='store_const', const='rebuild', dest='manifest')
     parser.add_argument('origin', nargs='?')
     parser.add_argument('destination', nargs='?')
     args = parser.parse_args()
@@ -164,12 +394,21 @@ if __name__ == '__main__':
         version()
     else:
         logger = setup_logger(log = not args.no_log, log_dest = args.log_dest)
-        if not args.origin:
+        if args.prune and not args.destination:
+            # Pruning only needs the destination.
+            args.origin, args.destination = None, args.origin
+        elif not args.origin:
             print("Error: must give an origin directory.")
             sys.exit(1)
         if not args.destination:
             print("Error: must give a destination directory.")
             sys.exit(1)
+        if args.prune and not (args.keep_days or args.keep_weeks or args.keep_months):
+            print("Error: must give --keep-days, --keep-weeks, or --keep-months to prune.")
+            sys.exit(1)
+        if args.watch and args.dry_run:
+            print("Error: can't --watch a dry run.")
+            sys.exit(1)
         try:
             main(
                 origin      = args.origin,
@@ -180,6 +419,22 @@ if __name__ == '__main__':
                 replace     = not args.no_replace,
                 persist     = args.persist,
                 update_time = args.update_time,
+                jobs        = max(1, args.jobs),
+                incremental = args.incremental,
+                manifest    = args.manifest,
+                recursive   = args.recursive,
+                dedup       = args.dedup,
+                dry_run     = args.dry_run,
+                plan_out    = args.plan_out,
+                stats_file  = args.stats_file,
+                pipeline    = args.pipeline,
+                bundle      = args.bundle,
+                retention   = (args.keep_days, args.keep_weeks, args.keep_months) if args.prune else None,
+                watch       = (max(0.1, args.window), args.poll) if args.watch else None,
+                order       = args.order,
+                verify      = args.verify,
+                throttle    = (args.bandwidth, args.file_rate, args.throttle_schedule)
+                              if args.bandwidth or args.file_rate or args.throttle_schedule else None,
                 logger      = logger
             )
         except KeyboardInterrupt:
@@ -187,7 +442,7 @@ if __name__ == '__main__':
                                        # to clear the entire line.
             logger.fatal("KeybaordInterrupt given. Forced to quit.")
         except:
-            message = "{errname}: {error}".format(errname=sys.exc_info()[0].__name__, error=' '.join(sys.exc_info()[1]))
+            message = "{errname}: {error}".format(errname=sys.exc_info()[0].__name__, error=sys.exc_info()[1])
             print(message)
             logger.error(message)
             sys.exit(3)
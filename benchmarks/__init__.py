@@ -0,0 +1,8 @@
+"""
+Benchmarks for Archive Manager. Run each one from the top of the repository
+as a module, e.g.:
+
+    python -m benchmarks.bucketing
+    python -m benchmarks.archivers --out results.json
+    python -m benchmarks.startup
+"""
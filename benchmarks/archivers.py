@@ -0,0 +1,220 @@
+"""
+Measures whole archival runs: nested() and flat(), copying and moving, against
+synthetic origin trees built in a temporary directory. Each tree holds many
+tiny files and a few huge sparse ones, with modification times spread so that
+every granularity (from years down to seconds) splits them up differently.
+
+For each run this reports files/s, MB/s, and how many filesystem calls were
+made (counted by wrapping the functions in `os` and friends for the length of
+the run, so reads and writes on already-open files aren't included). The
+results are also written as JSON, so that runs can be compared later.
+
+    python -m benchmarks.archivers [--tiny N] [--huge N] [--huge-size MB]
+                                   [--grain N ...] [--jobs N] [--out FILE]
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from archive_manager import archivers
+from archive_manager import formatting
+from archive_manager import scanner
+from archive_manager import transfer
+
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+# The functions which are counted as filesystem calls, by module.
+_CALLS = [
+    (os, ('stat', 'lstat', 'open', 'listdir', 'scandir', 'mkdir', 'rename', 'remove', 'unlink', 'link',
+          'utime', 'chmod', 'lseek', 'sendfile', 'copy_file_range')),
+    (builtins, ('open',)),
+    (scanner, ('_scandir',)),
+]
+try:
+    import fcntl
+    _CALLS.append((fcntl, ('ioctl',)))
+except ImportError:
+    pass
+
+# How far apart the files' modification times are spread: a few files at each
+# of these steps means every granularity sees a different number of buckets.
+_SPREAD = (1, 60, 60 * 60, 24 * 60 * 60, 31 * 24 * 60 * 60, 366 * 24 * 60 * 60)
+
+class Calls(object):
+    """
+    Counts calls to the functions in _CALLS while it's active (as a context
+    manager), by swapping each one out for a wrapper. Safe to use with --jobs.
+    """
+    def __init__(self):
+        self.counts   = {}
+        self.lock     = threading.Lock()
+        self.original = []
+
+    def __enter__(self):
+        for module, names in _CALLS:
+            for name in names:
+                function = getattr(module, name, None)
+                if function is not None:
+                    self.original.append((module, name, function))
+                    setattr(module, name, self._wrap(name, function))
+        return self
+
+    def __exit__(self, type, value, traceback):
+        while self.original:
+            module, name, function = self.original.pop()
+            setattr(module, name, function)
+
+    def _wrap(self, name, function):
+        counts = self.counts
+        lock   = self.lock
+        def wrapper(*args, **kwargs):
+            with lock:
+                counts[name] = counts.get(name, 0) + 1
+            return function(*args, **kwargs)
+        return wrapper
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+def build(origin, tiny, huge, huge_size, seed=0):
+    """
+    Fills a directory with synthetic files.
+
+    :param origin: the directory to fill (which must exist)
+    :param tiny: how many tiny (a few bytes) files to make
+    :param huge: how many huge sparse files to make
+    :param huge_size: how big each huge file is, in bytes
+    :return: the number of files and their total size in bytes
+    """
+    random.seed(seed)
+    now   = int(time.time())
+    total = 0
+    for index in range(tiny):
+        path = os.path.join(origin, 'tiny-{:07d}.txt'.format(index))
+        with open(path, 'w') as file:
+            file.write(str(index))
+        total += len(str(index))
+        # Cycle through the spreads so each granularity gets its share.
+        step  = _SPREAD[index % len(_SPREAD)]
+        mtime = now - step * random.randint(0, 11)
+        os.utime(path, (mtime, mtime))
+    for index in range(huge):
+        path = os.path.join(origin, 'huge-{:03d}.img'.format(index))
+        with open(path, 'wb') as file:
+            # Only the last byte is written; the rest is a hole.
+            file.seek(huge_size - 1)
+            file.write(b'\0')
+        total += huge_size
+        mtime = now - _SPREAD[index % len(_SPREAD)]
+        os.utime(path, (mtime, mtime))
+    return tiny + huge, total
+
+def run(root, layout, persist, grain, jobs, tiny, huge, huge_size):
+    """
+    Builds a fresh origin, archives it once, and measures it.
+
+    :return: a dictionary of the results
+    """
+    origin      = os.path.join(root, 'origin')
+    destination = os.path.join(root, 'destination')
+    for path in (origin, destination):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+    os.mkdir(origin)
+    files, _ = build(origin, tiny, huge, huge_size)
+
+    logger = logging.getLogger('benchmarks.archivers')
+    archive = archivers.flat if layout == 'flat' else archivers.nested
+    with Calls() as calls:
+        start  = time.time()
+        totals = archive(origin, destination, grain=grain, persist=persist, logger=logger, jobs=jobs)
+        elapsed = time.time() - start
+
+    return {
+        'layout':  layout,
+        'mode':    'copy' if persist else 'move',
+        'grain':   grain,
+        'jobs':    jobs,
+        'files':   totals.moving,
+        'bytes':   totals.moving_bytes,
+        'buckets': len(totals.buckets),
+        'seconds': elapsed,
+        'files_per_second': totals.moving / elapsed,
+        'mb_per_second':    totals.moving_bytes / 1e6 / elapsed,
+        'calls':   calls.total,
+        'calls_per_file':   float(calls.total) / max(files, 1),
+        'call_counts':      dict(calls.counts),
+    }
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Benchmark the archivers against synthetic origin trees.")
+    parser.add_argument('--tiny', type=int, default=5000, help="tiny files in each origin")
+    parser.add_argument('--huge', type=int, default=3, help="huge sparse files in each origin")
+    parser.add_argument('--huge-size', type=int, default=64, help="size of each huge file, in MB")
+    parser.add_argument('--grain', type=int, action='append', help="granularities to run (default: all six)")
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--out', default='benchmark-archivers.json', help="where to write the results as JSON")
+    args = parser.parse_args(arguments)
+
+    # Nothing from the archivers themselves should end up on the screen.
+    logger = logging.getLogger('benchmarks.archivers')
+    logger.addHandler(logging.NullHandler())
+    logger.setLevel(logging.ERROR)
+    logger.propagate = False
+
+    grains  = args.grain or list(range(1, 7))
+    started = time.time()
+    results = []
+    root    = tempfile.mkdtemp(prefix='archive_manager-benchmark-')
+    print("{} tiny + {} x {} MB sparse files, {} job(s), in {}".format(
+        args.tiny, args.huge, args.huge_size, args.jobs, root
+    ))
+    print("{:<7} {:<5} {:<8} {:>8} {:>10} {:>10} {:>9} {:>10}".format(
+        'layout', 'mode', 'grain', 'buckets', 'files/s', 'MB/s', 'calls', 'calls/file'
+    ))
+    try:
+        for layout in ('nested', 'flat'):
+            for persist in (True, False):
+                for grain in grains:
+                    result = run(root, layout, persist, grain, max(1, args.jobs),
+                                 args.tiny, args.huge, args.huge_size * 1024 * 1024)
+                    results.append(result)
+                    print("{:<7} {:<5} {:<8} {:>8} {:>10.0f} {:>10.1f} {:>9} {:>10.1f}".format(
+                        layout, result['mode'], formatting.granularity(grain, False), result['buckets'],
+                        result['files_per_second'], result['mb_per_second'],
+                        result['calls'], result['calls_per_file']
+                    ))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    with open(args.out, 'w') as out:
+        json.dump({
+            'benchmark':  'archivers',
+            'started':    started,
+            'python':     platform.python_version(),
+            'platform':   platform.platform(),
+            'strategies': [name for name, _ in transfer._STRATEGIES],
+            'parameters': {
+                'tiny':      args.tiny,
+                'huge':      args.huge,
+                'huge_size': args.huge_size * 1024 * 1024,
+                'jobs':      args.jobs,
+            },
+            'results':    results,
+        }, out, sort_keys=True, indent=2)
+        out.write('\n')
+    print("Results written to: " + args.out)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Measures the per-file cost of working out date buckets, comparing the original
+approach (datetime.fromtimestamp, strftime, split, and join for every file)
+with formatting.Bucketer's cached and batch lookups.
+
+    python -m benchmarks.bucketing [files]
+"""
+import os
+import random
+import sys
+import time
+
+from datetime import datetime
+
+from archive_manager import formatting
+
+def original(mtimes, grain):
+    date = formatting.date(grain)
+    return [os.path.join(*datetime.fromtimestamp(mtime).strftime(date).split('.')) for mtime in mtimes]
+
+def cached(mtimes, grain):
+    bucket = formatting.Bucketer(grain).bucket
+    return [bucket(mtime) for mtime in mtimes]
+
+def batch(mtimes, grain):
+    return formatting.Bucketer(grain).buckets(mtimes)
+
+def measure(function, mtimes, grain, repeat=3):
+    """
+    :return: the best time per file over `repeat` runs, in nanoseconds
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        function(mtimes, grain)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1e9 / len(mtimes)
+
+def main(count=200000):
+    # A year's worth of nightly runs, each of which writes its files within a
+    # few minutes (as backups and logs do).
+    random.seed(0)
+    end    = int(time.time())
+    nights = [end - day * 24 * 60 * 60 for day in range(365)]
+    mtimes = sorted(random.choice(nights) + random.uniform(0, 300) for _ in range(count))
+
+    print("{} files from 365 nightly runs".format(count))
+    print("{:<8} {:>12} {:>12} {:>12} {:>8}".format('grain', 'original', 'cached', 'batch', 'speedup'))
+    for grain in range(1, 7):
+        before = measure(original, mtimes, grain)
+        after  = measure(cached, mtimes, grain)
+        whole  = measure(batch, mtimes, grain)
+        print("{:<8} {:>9.0f} ns {:>9.0f} ns {:>9.0f} ns {:>7.1f}x".format(
+            formatting.granularity(grain, False), before, after, whole, before / min(after, whole)
+        ))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
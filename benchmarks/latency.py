@@ -0,0 +1,163 @@
+"""
+Measures how the archivers cope with a destination where every filesystem call
+is a round trip to a file server (SMB, NFS, AFP), without needing one: a
+latency shim adds a fixed delay to every call that touches the destination.
+
+Each origin is archived with one job, with --jobs, and with --jobs and
+--pipeline, and the results are written as JSON.
+
+    python -m benchmarks.latency [--files N] [--latency MS] [--jobs N]
+                                 [--grain N] [--out FILE]
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+from archive_manager import archivers
+from archive_manager import scanner
+
+from benchmarks.archivers import build, builtins
+
+# The functions which are slowed down, by module. For rename() and link(),
+# either path being in the destination counts.
+_CALLS = [
+    (os, ('stat', 'lstat', 'open', 'listdir', 'scandir', 'mkdir', 'rename', 'remove', 'unlink', 'link',
+          'utime', 'chmod')),
+    (builtins, ('open',)),
+    (scanner, ('_scandir',)),
+]
+
+class Latency(object):
+    """
+    Adds a delay to every call to the functions in _CALLS which is given a path
+    beneath `root`, while it's active (as a context manager). Calls on paths
+    elsewhere, and on open file descriptors, go through as normal.
+    """
+    def __init__(self, root, delay):
+        """
+        :param root: the directory which is 'remote'
+        :param delay: how long each call takes, in seconds
+        """
+        self.root     = os.path.join(os.path.abspath(root), '')
+        self.delay    = delay
+        self.calls    = 0
+        self.original = []
+
+    def __enter__(self):
+        for module, names in _CALLS:
+            for name in names:
+                function = getattr(module, name, None)
+                if function is not None:
+                    self.original.append((module, name, function))
+                    setattr(module, name, self._wrap(function))
+        return self
+
+    def __exit__(self, type, value, traceback):
+        while self.original:
+            module, name, function = self.original.pop()
+            setattr(module, name, function)
+
+    def _remote(self, path):
+        if not isinstance(path, (str, type(u''))):
+            return False
+        return os.path.join(os.path.abspath(path), '').startswith(self.root)
+
+    def _wrap(self, function):
+        def wrapper(*args, **kwargs):
+            if any(self._remote(arg) for arg in args[:2]):
+                self.calls += 1
+                time.sleep(self.delay)
+            return function(*args, **kwargs)
+        return wrapper
+
+def run(root, label, files, grain, delay, jobs, pipeline):
+    """
+    Builds a fresh origin, archives it once into a 'remote' destination, and
+    measures it.
+
+    :return: a dictionary of the results
+    """
+    origin      = os.path.join(root, 'origin')
+    destination = os.path.join(root, 'destination')
+    for path in (origin, destination):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+    os.mkdir(origin)
+    os.mkdir(destination)
+    build(origin, files, 0, 0)
+
+    logger = logging.getLogger('benchmarks.latency')
+    with Latency(destination, delay) as latency:
+        start   = time.time()
+        totals  = archivers.nested(origin, destination, grain=grain, persist=True, logger=logger,
+                                   jobs=jobs, pipeline=pipeline)
+        elapsed = time.time() - start
+
+    return {
+        'mode':    label,
+        'jobs':    jobs,
+        'pipeline': pipeline,
+        'files':   totals.moving,
+        'buckets': len(totals.buckets),
+        'seconds': elapsed,
+        'files_per_second': totals.moving / elapsed,
+        'remote_calls':     latency.calls,
+    }
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Benchmark the archivers against a high-latency destination.")
+    parser.add_argument('--files', type=int, default=500, help="files in each origin")
+    parser.add_argument('--latency', type=float, default=5, help="delay for each call to the destination, in ms")
+    parser.add_argument('--jobs', type=int, default=16)
+    parser.add_argument('--grain', type=int, default=3)
+    parser.add_argument('--out', default='benchmark-latency.json', help="where to write the results as JSON")
+    args = parser.parse_args(arguments)
+
+    logger = logging.getLogger('benchmarks.latency')
+    logger.addHandler(logging.NullHandler())
+    logger.setLevel(logging.ERROR)
+    logger.propagate = False
+
+    started = time.time()
+    results = []
+    root    = tempfile.mkdtemp(prefix='archive_manager-benchmark-')
+    print("{} files, {} ms per call to the destination, in {}".format(args.files, args.latency, root))
+    print("{:<18} {:>8} {:>10} {:>10} {:>13}".format('mode', 'buckets', 'seconds', 'files/s', 'remote calls'))
+    try:
+        for label, jobs, pipeline in (
+            ('serial', 1, False),
+            ('jobs', args.jobs, False),
+            ('jobs + pipeline', args.jobs, True),
+        ):
+            result = run(root, label, args.files, args.grain, args.latency / 1000.0, jobs, pipeline)
+            results.append(result)
+            print("{:<18} {:>8} {:>10.2f} {:>10.0f} {:>13}".format(
+                label, result['buckets'], result['seconds'], result['files_per_second'], result['remote_calls']
+            ))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    with open(args.out, 'w') as out:
+        json.dump({
+            'benchmark':  'latency',
+            'started':    started,
+            'python':     platform.python_version(),
+            'platform':   platform.platform(),
+            'parameters': {
+                'files':   args.files,
+                'latency': args.latency / 1000.0,
+                'jobs':    args.jobs,
+                'grain':   args.grain,
+            },
+            'results':    results,
+        }, out, sort_keys=True, indent=2)
+        out.write('\n')
+    print("Results written to: " + args.out)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Measures how long archiver.py takes to start up and finish when there's next to
+nothing to do, which is most of what a frequent cron or launchd job costs: a
+fresh interpreter is started for each run of each command (so nothing is
+already imported), and the best and median wall-clock times are reported.
+
+    python -m benchmarks.startup [--repeat N] [--out FILE]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# archiver.py, at the top of the repository.
+_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'archiver.py')
+
+def measure(command, repeat):
+    """
+    Runs a command over and over, throwing away its output.
+
+    :return: the time each run took, in seconds, in the order they were run
+    """
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.call(command, stdout=devnull, stderr=devnull, stdin=devnull)
+            times.append(time.time() - start)
+    return times
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Benchmark how quickly archiver.py starts up.")
+    parser.add_argument('--repeat', type=int, default=20, help="how many times to run each command")
+    parser.add_argument('--out', default='benchmark-startup.json', help="where to write the results as JSON")
+    args = parser.parse_args(arguments)
+
+    started = time.time()
+    results = []
+    root    = tempfile.mkdtemp(prefix='archive_manager-benchmark-')
+    origin      = os.path.join(root, 'origin')
+    destination = os.path.join(root, 'destination')
+    os.mkdir(origin)
+    os.mkdir(destination)
+    print("{} runs of each with {}".format(args.repeat, sys.executable))
+    print("{:<14} {:>10} {:>10}".format('command', 'best ms', 'median ms'))
+    try:
+        for label, command in (
+            ('import', [sys.executable, '-c', 'import archive_manager']),
+            ('--version', [sys.executable, _SCRIPT, '--version']),
+            ('empty origin', [sys.executable, _SCRIPT, '-n', origin, destination]),
+        ):
+            times = sorted(measure(command, args.repeat))
+            result = {
+                'command': label,
+                'best':    times[0],
+                'median':  times[len(times) // 2],
+                'times':   times,
+            }
+            results.append(result)
+            print("{:<14} {:>10.1f} {:>10.1f}".format(label, result['best'] * 1000, result['median'] * 1000))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    with open(args.out, 'w') as out:
+        json.dump({
+            'benchmark':  'startup',
+            'started':    started,
+            'python':     platform.python_version(),
+            'platform':   platform.platform(),
+            'parameters': {
+                'repeat': args.repeat,
+            },
+            'results':    results,
+        }, out, sort_keys=True, indent=2)
+        out.write('\n')
+    print("Results written to: " + args.out)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from datetime import datetime
+
+from archive_manager import retention
+
+NOW = datetime(2020, 1, 10, 12)
+
+def bucket(*parts):
+    start, end = retention.span(parts)
+    return retention.Bucket(start, end, [])
+
+class TestKeep(unittest.TestCase):
+
+    def kept(self, found, **rules):
+        kept = retention.keep(found, NOW, **rules)
+        return sorted(tuple(getattr(start, part) for part in ('year', 'month', 'day')) for start in kept)
+
+    def test_days(self):
+        found = [bucket(2020, 1, day) for day in range(1, 11)]
+        self.assertEqual(self.kept(found, days=2), [(2020, 1, 8), (2020, 1, 9), (2020, 1, 10)])
+
+    def test_weeks(self):
+        found = [bucket(2019, 12, day) for day in range(20, 32)] + [bucket(2020, 1, day) for day in range(1, 11)]
+        # This week so far, and the Sunday that ended last week.
+        self.assertEqual(self.kept(found, weeks=2), [(2020, 1, 5), (2020, 1, 10)])
+
+    def test_weeks_of_months(self):
+        # The month that's still being filled starts before the first week.
+        found = [bucket(2019, 11), bucket(2019, 12), bucket(2020, 1)]
+        self.assertEqual(self.kept(found, weeks=1), [(2020, 1, 1)])
+        self.assertEqual(self.kept(found, weeks=2), [(2020, 1, 1)])
+        self.assertEqual(self.kept(found, weeks=6), [(2019, 12, 1), (2020, 1, 1)])
+
+    def test_months(self):
+        found = [bucket(2019, 10, 31), bucket(2019, 11, 15), bucket(2019, 11, 30), bucket(2020, 1, 2)]
+        self.assertEqual(self.kept(found, months=3), [(2019, 11, 30), (2020, 1, 2)])
+
+    def test_months_of_months(self):
+        found = [bucket(2019, month) for month in range(9, 13)] + [bucket(2020, 1)]
+        self.assertEqual(self.kept(found, months=3), [(2019, 11, 1), (2019, 12, 1), (2020, 1, 1)])
+
+    def test_months_of_years(self):
+        found = [bucket(2018), bucket(2019), bucket(2020)]
+        self.assertEqual(self.kept(found, months=1), [(2020, 1, 1)])
+        # November and December are in 2019's bucket.
+        self.assertEqual(self.kept(found, months=3), [(2019, 1, 1), (2020, 1, 1)])
+
+class TestFlat(unittest.TestCase):
+
+    def setUp(self):
+        self.destination = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.destination)
+
+    def touch(self, *names):
+        for name in names:
+            open(os.path.join(self.destination, name), 'w').close()
+
+    def test_dot_delimiter(self):
+        self.touch('2020.01.05.a.txt', '2020.01.05.tar.gz', '2020.01.05.sha256', '2020.01.09.b.txt', 'notes.txt')
+        kept, removed, paths = retention.prune(self.destination, flat=True, days=2, now=NOW)
+        self.assertEqual((kept, removed), (1, 1))
+        self.assertEqual(paths, ['2020.01.05.a.txt', '2020.01.05.sha256', '2020.01.05.tar.gz'])
+        self.assertEqual(sorted(os.listdir(self.destination)), ['2020.01.09.b.txt', 'notes.txt'])
+
+    def test_other_delimiter(self):
+        # The bundles' and digest files' extensions have dots in them, which
+        # aren't the delimiter.
+        self.touch('2020-01-05-a.txt', '2020-01-05.tar.gz', '2020-01-05.sha256', '2020-01-06.zip',
+                   '2020-01-07.tar.zst', '2020-01-09-b.txt', '2020-01-09.zip')
+        kept, removed, paths = retention.prune(self.destination, flat=True, delimiter='-', days=2, dry_run=True,
+                                               now=NOW)
+        self.assertEqual((kept, removed), (1, 3))
+        self.assertEqual(paths, ['2020-01-05-a.txt', '2020-01-05.sha256', '2020-01-05.tar.gz', '2020-01-06.zip',
+                                 '2020-01-07.tar.zst'])
+
+class TestNested(unittest.TestCase):
+
+    def setUp(self):
+        self.destination = tempfile.mkdtemp()
+        for path in ('2019/12/30/a.txt', '2020/01/05/b.txt', '2020/01/09/c.txt'):
+            os.makedirs(os.path.join(self.destination, os.path.dirname(path)))
+            open(os.path.join(self.destination, path), 'w').close()
+        for name in ('2020/01/06.tar.gz', '2020/01/06.sha256'):
+            open(os.path.join(self.destination, name), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.destination)
+
+    def test_buckets(self):
+        found = retention.buckets(self.destination)
+        self.assertEqual([bucket.start.day for bucket in found], [30, 5, 6, 9])
+        self.assertEqual(found[2].paths, ['2020/01/06.sha256', '2020/01/06.tar.gz'])
+
+    def test_prune(self):
+        kept, removed, paths = retention.prune(self.destination, days=2, now=NOW)
+        self.assertEqual((kept, removed), (1, 3))
+        # The whole of 2019 goes at once.
+        self.assertEqual(paths, ['2019', '2020/01/05', '2020/01/06.sha256', '2020/01/06.tar.gz'])
+
+if __name__ == '__main__':
+    unittest.main()
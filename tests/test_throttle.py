@@ -0,0 +1,253 @@
+import os
+import shutil
+import signal
+import tempfile
+import time
+import unittest
+
+from datetime import datetime
+
+from archive_manager import throttle
+
+# A Monday.
+MONDAY = datetime(2024, 1, 8)
+
+SCHEDULE = """\
+[business hours]
+days      = mon-fri
+hours     = 08:00-18:00
+bandwidth = 10M
+files     = 50
+
+[overnight]
+hours     = 22:00-06:00
+files     = unlimited
+"""
+
+def at(when):
+    """
+    :return: the timestamp of a local datetime
+    """
+    return time.mktime(when.timetuple())
+
+class Clock(object):
+    """
+    A clock that only moves when it's told to, or when something sleeps.
+    """
+    def __init__(self, now=0.0):
+        self.now   = now
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+    def advance(self, seconds):
+        self.now += seconds
+
+class TestRate(unittest.TestCase):
+
+    def test_units(self):
+        self.assertEqual(throttle.rate('200'), 200)
+        self.assertEqual(throttle.rate('512k'), 512 * 1024)
+        self.assertEqual(throttle.rate('10M'), 10 * 1024 ** 2)
+        self.assertEqual(throttle.rate('1.5 GB/s'), 1.5 * 1024 ** 3)
+
+    def test_unlimited(self):
+        for text in ('unlimited', 'off', 'none', '0', ''):
+            self.assertIsNone(throttle.rate(text))
+
+    def test_bad(self):
+        self.assertRaises(ValueError, throttle.rate, '10 parsecs')
+
+class TestTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def bucket(self, rate, burst=None):
+        return throttle.TokenBucket(rate, burst, clock=self.clock, sleep=self.clock.sleep)
+
+    def test_unlimited(self):
+        bucket = self.bucket(None)
+        self.assertEqual(bucket.take(10 ** 12), 0.0)
+        self.assertEqual(self.clock.slept, [])
+
+    def test_starts_full(self):
+        bucket = self.bucket(100)
+        self.assertEqual(bucket.take(100), 0.0)
+        self.assertEqual(self.clock.slept, [])
+
+    def test_refill_rate(self):
+        bucket = self.bucket(100)
+        bucket.take(100)
+        # Empty now, so the next 50 have to wait for half a second's worth.
+        self.assertAlmostEqual(bucket.take(50), 0.5)
+        self.assertAlmostEqual(self.clock.now, 0.5)
+        # After a quarter of a second, 25 have come back.
+        self.clock.advance(0.25)
+        self.assertEqual(bucket.take(25), 0.0)
+        self.assertAlmostEqual(bucket.take(100), 1.0)
+
+    def test_burst_capacity(self):
+        bucket = self.bucket(100, burst=300)
+        self.assertEqual(bucket.take(300), 0.0)
+        # However long it's idle, it never holds more than the burst.
+        self.clock.advance(3600)
+        self.assertEqual(bucket.take(300), 0.0)
+        self.assertAlmostEqual(bucket.take(100), 1.0)
+
+    def test_more_than_the_burst(self):
+        bucket = self.bucket(100)
+        # A chunk bigger than the burst goes through, and is paid for after.
+        self.assertAlmostEqual(bucket.take(350), 2.5)
+        self.assertAlmostEqual(self.clock.now, 2.5)
+
+    def test_interrupted_sleep(self):
+        # A sleep cut short (e.g. by a signal) is carried on with.
+        def sleep(seconds):
+            self.clock.slept.append(seconds)
+            self.clock.advance(min(seconds, 0.3))
+        bucket = throttle.TokenBucket(100, clock=self.clock, sleep=sleep)
+        bucket.take(100)
+        self.assertAlmostEqual(bucket.take(100), 1.0)
+        self.assertAlmostEqual(self.clock.now, 1.0)
+        self.assertEqual(len(self.clock.slept), 4)
+
+    def test_set(self):
+        bucket = self.bucket(100)
+        bucket.take(100)
+        # The debt is kept at the new rate.
+        bucket.set(200)
+        self.assertAlmostEqual(bucket.take(200), 1.0)
+        bucket.set(None)
+        self.assertEqual(bucket.take(10 ** 6), 0.0)
+
+class TestSchedule(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path      = os.path.join(self.directory, 'schedule.ini')
+        self.write(SCHEDULE)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, text):
+        with open(self.path, 'w') as file:
+            file.write(text)
+
+    def test_load(self):
+        rules = throttle.Schedule.load(self.path).rules
+        self.assertEqual([rule.name for rule in rules], ['business hours', 'overnight'])
+        self.assertEqual(rules[0].days, set(range(5)))
+        self.assertEqual(rules[0].hours, (8 * 60, 18 * 60))
+        self.assertEqual(rules[1].days, None)
+        self.assertEqual(rules[1].bandwidth, False)
+
+    def test_limits(self):
+        schedule = throttle.Schedule.load(self.path)
+        default  = (1000, 5)
+        self.assertEqual(schedule.limits(MONDAY.replace(hour=9), default),
+                         ((10 * 1024 ** 2, 50), 'business hours'))
+        self.assertEqual(schedule.limits(MONDAY.replace(hour=18), default), (default, None))
+        # Around midnight; the bandwidth is left as it was given.
+        self.assertEqual(schedule.limits(MONDAY.replace(hour=23), default), ((1000, None), 'overnight'))
+        self.assertEqual(schedule.limits(MONDAY.replace(hour=5, minute=59), default), ((1000, None), 'overnight'))
+        # Saturday.
+        self.assertEqual(schedule.limits(datetime(2024, 1, 13, 9), default), (default, None))
+
+    def test_bad(self):
+        self.write("[rule]\ndays = someday\n")
+        self.assertRaises(ValueError, throttle.Schedule.load, self.path)
+        self.assertRaises(ValueError, throttle.Schedule.load, os.path.join(self.directory, 'missing.ini'))
+
+class TestThrottle(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path      = os.path.join(self.directory, 'schedule.ini')
+        with open(self.path, 'w') as file:
+            file.write(SCHEDULE)
+        self.clock = Clock(at(MONDAY.replace(hour=7, minute=59, second=50)))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def throttle(self, bandwidth=None, files=None, schedule=None):
+        return throttle.Throttle(bandwidth, files, schedule, clock=self.clock, sleep=self.clock.sleep)
+
+    def test_limits(self):
+        limited = self.throttle(bandwidth=100, files=2)
+        limited.transferred(100)
+        limited.transferred(50)
+        self.assertAlmostEqual(limited.waited, 0.5)
+        limited.operation()
+        limited.operation()
+        limited.operation()
+        self.assertAlmostEqual(limited.waited, 1.0)
+
+    def test_window_switching(self):
+        scheduled = self.throttle(bandwidth=100, schedule=self.path)
+        self.assertEqual(scheduled.limits, (100, None))
+        self.assertIsNone(scheduled.rule)
+        # Business hours start, but the schedule isn't looked at again yet.
+        self.clock.advance(20)
+        scheduled.check()
+        self.assertEqual(scheduled.limits, (100, None))
+        self.clock.advance(throttle.RECHECK)
+        scheduled.check()
+        self.assertEqual(scheduled.limits, (10 * 1024 ** 2, 50))
+        self.assertEqual(scheduled.rule, 'business hours')
+        # And end.
+        self.clock.now = at(MONDAY.replace(hour=18, minute=0, second=1))
+        scheduled.check()
+        self.assertEqual(scheduled.limits, (100, None))
+        self.assertIsNone(scheduled.rule)
+
+    def test_reload(self):
+        scheduled = self.throttle(schedule=self.path)
+        with open(self.path, 'w') as file:
+            file.write("[always]\nbandwidth = 1M\n")
+        scheduled.check()
+        self.assertIsNone(scheduled.rule)
+        scheduled.reload()
+        # Nothing changes until it's next checked.
+        self.assertIsNone(scheduled.rule)
+        scheduled.check()
+        self.assertEqual(scheduled.rule, 'always')
+        self.assertEqual(scheduled.limits, (1024 ** 2, None))
+
+    def test_bad_reload(self):
+        scheduled = self.throttle(schedule=self.path)
+        with open(self.path, 'w') as file:
+            file.write("[always]\nbandwidth = lots\n")
+        scheduled.reload()
+        scheduled.check()
+        # The old schedule is kept.
+        self.assertIsNotNone(scheduled.error)
+        self.clock.advance(throttle.RECHECK)
+        scheduled.check()
+        self.assertEqual(scheduled.rule, 'business hours')
+
+    @unittest.skipUnless(hasattr(signal, 'SIGHUP'), "SIGHUP is needed")
+    def test_sighup(self):
+        scheduled = self.throttle(schedule=self.path)
+        with open(self.path, 'w') as file:
+            file.write("[always]\nfiles = 7\n")
+        # The same handler archiver.py installs.
+        previous = signal.signal(signal.SIGHUP, lambda signum, frame: scheduled.reload())
+        try:
+            os.kill(os.getpid(), signal.SIGHUP)
+        finally:
+            signal.signal(signal.SIGHUP, previous)
+        self.assertTrue(scheduled.reloading)
+        scheduled.operation()
+        self.assertEqual(scheduled.rule, 'always')
+        self.assertEqual(scheduled.limits, (None, 7))
+
+if __name__ == '__main__':
+    unittest.main()